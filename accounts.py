@@ -0,0 +1,123 @@
+# accounts.py - in-memory account index over bank_details.csv
+#
+# The CSV backend used to parse the whole file with pandas and scan the
+# unique_id column as strings on every login, dashboard, deposit and
+# withdrawal. AccountRepository parses it once into plain rows with a
+# unique_id -> row dict, so a lookup is one os.stat() plus a dict get.
+# The file's (inode, mtime, size) is its version: a write by another
+# process (always a rename of a new file) changes it and the next access
+# reloads. Updates are written through to the file straight away.
+import csv
+import os
+import threading
+
+from metrics import timed
+
+
+def _to_int(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+class AccountRepository:
+    """unique_id -> account row of one accounts CSV, kept coherent with the file."""
+
+    def __init__(self, path, columns, balance_column="account_balance"):
+        self.path = path
+        self.default_columns = list(columns)
+        self.balance_column = balance_column
+        self._lock = threading.Lock()
+        self._version = None
+        self._columns = list(columns)
+        self._rows = []  # [value, ...] per account, in file order; the balance as an int
+        self._index = {}  # unique_id -> position in _rows (first row wins, as with pandas)
+
+    def _file_version(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def refresh(self):
+        """Reload if the file changed since it was last read or written here."""
+        version = self._file_version()
+        if version == self._version:
+            return
+        with self._lock:
+            if version != self._version:
+                self._load(version)
+
+    def _load(self, version):
+        columns, rows = list(self.default_columns), []
+        if version is not None:
+            with timed("csv_read"), open(self.path, newline="", encoding="utf-8") as f:
+                reader = csv.reader(f)
+                columns = next(reader, None) or columns
+                rows = [row for row in reader if row]
+        balance = columns.index(self.balance_column) if self.balance_column in columns else None
+        key = columns.index("unique_id")
+        index = {}
+        for i, row in enumerate(rows):
+            row.extend([""] * (len(columns) - len(row)))
+            if balance is not None:
+                row[balance] = _to_int(row[balance])
+            index.setdefault(row[key], i)
+        self._columns, self._rows, self._index, self._version = columns, rows, index, version
+
+    def get(self, unique_id):
+        """The account as a dict, or None."""
+        self.refresh()
+        i = self._index.get(str(unique_id))
+        return None if i is None else dict(zip(self._columns, self._rows[i]))
+
+    def __len__(self):
+        self.refresh()
+        return len(self._rows)
+
+    # The methods below change the file; callers hold the storage's write lock
+
+    def add(self, account):
+        """Append the account; False (and nothing written) when its unique_id is taken."""
+        self.refresh()
+        with self._lock:
+            if str(account["unique_id"]) in self._index:
+                return False
+            row = ["" if account.get(c) is None else account.get(c) for c in self._columns]
+            if self.balance_column in self._columns:
+                i = self._columns.index(self.balance_column)
+                row[i] = _to_int(row[i])
+            self._index[str(account["unique_id"])] = len(self._rows)
+            self._rows.append([v if isinstance(v, int) else str(v) for v in row])
+            self._save()
+            return True
+
+    def add_to_balance(self, unique_id, delta):
+        """New balance, or None when the account does not exist; never goes below zero.
+
+        Raises ValueError (and writes nothing) if the balance would be negative.
+        """
+        self.refresh()
+        with self._lock:
+            i = self._index.get(str(unique_id))
+            if i is None:
+                return None
+            col = self._columns.index(self.balance_column)
+            balance = self._rows[i][col] + delta
+            if balance < 0:
+                raise ValueError(balance)
+            self._rows[i][col] = balance
+            self._save()
+            return balance
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with timed("csv_write"), open(tmp_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(self._columns)
+            writer.writerows(self._rows)
+        os.replace(tmp_path, self.path)
+        # Our own write is already in memory; only someone else's forces a reload
+        self._version = self._file_version()
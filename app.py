@@ -1,26 +1,140 @@
 # app.py
+import json
+import logging
 import os
 import subprocess
 import threading
 import time
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session
-from storage import read_accounts, write_accounts, log_transaction, get_history
-from face_utils import load_models, recognize_from_image_b64
-from train import train_model
+from flask import Flask, Response, stream_with_context, render_template, request, jsonify, redirect, url_for, flash, session
+import storage
+from storage import AccountExists, AccountNotFound, InsufficientFunds, create_account, get_account, get_history
+from face_utils import (BURST_MAX_FRAMES, RECOGNIZER_MODE, decode_image_b64, load_embedder, load_models,
+                        models_ready, print_status, recognize_burst_b64, recognize_from_image_b64, warmup)
+from training_jobs import TrainingQueue
+from gallery import FaceGallery, load_gallery
+from inference import BATCHING_ENABLED, EMBEDDER_POOL_SIZE, BatchScheduler, EmbedderPool
+from model_store import generation, training_lock
+import metrics
+from streaming import StreamSessions, check_models, read_length_prefixed
+from enrollment import (MAX_IMAGES, MIN_IMAGES, add_image, discard_enrollment, discard_user, finish_enrollment,
+                        safe_user_id, staging_path, start_enrollment)
+
+# Hot-path debug output (face shapes, probabilities) shows with FACEATM_LOG_LEVEL=DEBUG
+logging.basicConfig(level=os.environ.get("FACEATM_LOG_LEVEL", "INFO").upper(), format="%(levelname)s %(name)s: %(message)s")
+log = logging.getLogger("faceatm")
 
 app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = 512 * 1024 * 1024  # 512 MB
+# Frames are uploaded as binary JPEGs (tens of KB each), not base64 JSON
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get("FACEATM_MAX_UPLOAD_MB", "16")) * 1024 * 1024
 import secrets
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", secrets.token_hex(16))
 
-# initial load - handle errors gracefully
-try:
-    embedder, recognizer, le = load_models()
-    print("✅ Face recognition models loaded successfully")
-except Exception as e:
-    embedder, recognizer, le = None, None, None
-    print(f"⚠️  Face recognition models not loaded: {e}")
-    print("💡 The app will start but face recognition features will be disabled")
+# Load the models at import time, i.e. in the gunicorn master when run with
+# --preload, so forked workers share those pages copy-on-write instead of
+# each unpickling its own copy (set FACEATM_PRELOAD=1)
+PRELOAD_MODELS = os.environ.get("FACEATM_PRELOAD", "0") == "1"
+
+# The live (embedder, recognizer, le, gallery), loaded by the first request
+# of each process. It is only ever replaced as a whole, so a request that took
+# a reference keeps a consistent model until it ends.
+models = None
+# Process that built `models`; the scheduler/pool threads do not survive a fork
+_models_pid = None
+# model_store.generation() the models were loaded at. Every request compares
+# it with the shared counter, so a publish or enrollment in any worker is
+# picked up by all of them on their next request.
+_models_generation = None
+_models_lock = threading.Lock()
+# Raw models loaded before forking (PRELOAD_MODELS), wrapped per process
+_preloaded = None
+_preloaded_generation = None
+# pid -> warmup timings, once /healthz has run an inference in that process
+_warmed = {}
+
+def load_raw_models(model_dir=None, embedder=None):
+    """load_models() plus the centroid gallery used for 1:1 claimed-id checks."""
+    embedder, recognizer, le = load_models(model_dir, embedder)
+    gallery = recognizer if isinstance(recognizer, FaceGallery) else load_gallery(model_dir, mapped=True)
+    return embedder, recognizer, le, gallery
+
+def load_live_models(model_dir=None, raw=None):
+    """load_raw_models() (or already loaded raw models) ready for concurrent requests."""
+    embedder, recognizer, le, gallery = raw or load_raw_models(model_dir)
+    if BATCHING_ENABLED and embedder is not None:
+        # Concurrent requests share forward passes through one scheduler
+        embedder = BatchScheduler(embedder)
+    elif EMBEDDER_POOL_SIZE > 0 and embedder is not None:
+        # Otherwise every request thread checks out a net of its own
+        embedder = EmbedderPool(load_embedder, EMBEDDER_POOL_SIZE, first=embedder)
+    return embedder, recognizer, le, gallery
+
+def get_models():
+    """The live models, loaded once per process on first use - handle errors gracefully."""
+    global models, _models_pid, _models_generation
+    pid = os.getpid()
+    if models is not None and _models_pid == pid and _models_generation == generation():
+        return models
+    with _models_lock:
+        gen = generation()
+        if models is None or _models_pid != pid:
+            try:
+                if _preloaded is None:
+                    print_status()
+                # Artifacts preloaded under an older generation are stale
+                raw = _preloaded if _preloaded is not None and _preloaded_generation == gen else None
+                models = load_live_models(raw=raw)
+                print("✅ Face recognition models loaded successfully")
+            except Exception as e:
+                models = (None, None, None, None)
+                print(f"⚠️  Face recognition models not loaded: {e}")
+                print("💡 The app will start but face recognition features will be disabled")
+            _models_pid = pid
+        elif _models_generation != gen:
+            models = reload_models()
+        _models_generation = gen
+    return models
+
+def reload_models(model_dir=None):
+    """The recognizer and gallery reloaded around this process's embedder; hold _models_lock."""
+    if models is None or models[0] is None:
+        return load_live_models(model_dir)
+    try:
+        live = load_raw_models(model_dir, embedder=models[0])
+        log.info("Reloaded models at generation %d", generation())
+        return live
+    except Exception as e:
+        print(f"⚠️  Could not reload models, keeping the previous ones: {e}")
+        return models
+
+if PRELOAD_MODELS:
+    print_status()
+    _preloaded_generation = generation()
+    _preloaded = load_raw_models()
+
+def swap_models(result):
+    """Load a freshly published model version and make it the live one.
+
+    Other workers see the new generation and reload on their next request.
+    """
+    global models, _models_pid, _models_generation
+    with _models_lock:
+        gen = generation()
+        if models is None or _models_pid != os.getpid():
+            models = load_live_models(result.get("model_dir"))
+            _models_pid = os.getpid()
+        else:
+            models = reload_models(result.get("model_dir"))
+        _models_generation = gen
+
+def _train_model():
+    # train.py (and sklearn with it) is only imported once a retrain is requested
+    from train import train_model
+    # Each worker collapses its own requests; the lock keeps two workers from rebuilding at once
+    with training_lock():
+        return train_model()
+
+training_queue = TrainingQueue(_train_model, on_done=swap_models)
+stream_sessions = StreamSessions()
 
 def start_nextjs_server():
     """Start the Next.js development server"""
@@ -35,6 +149,50 @@ def start_nextjs_server():
     except Exception as e:
         print(f"❌ Error starting Next.js server: {e}")
 
+def request_images(field):
+    """(images, params) from a raw image/* body, a multipart upload or a JSON body.
+
+    Binary uploads come back as bytes that go straight to cv2.imdecode, with
+    the other parameters taken from the query string / form fields. JSON
+    bodies keep the base64 strings in `field` (a single image or a list).
+    """
+    if request.mimetype.startswith("image/"):
+        return [request.get_data(cache=False)], request.args
+    if request.mimetype == "multipart/form-data":
+        return [f.read() for f in request.files.getlist(field)], request.values
+    data = request.get_json(silent=True) or {}
+    images = data.get(field)
+    if images is None:
+        return [], data
+    return (images if isinstance(images, list) else [images]), data
+
+def _flag(value, default=True):
+    if value is None:
+        return default
+    if isinstance(value, str):
+        return value.strip().lower() not in ("0", "false", "no", "off", "")
+    return bool(value)
+
+@app.before_request
+def start_timing():
+    request.started = time.perf_counter()
+    metrics.start_request()
+
+@app.after_request
+def record_timing(response):
+    timings = metrics.end_request()
+    started = getattr(request, "started", None)
+    if started is not None:
+        metrics.REQUESTS.observe(request.endpoint or "unmatched", time.perf_counter() - started)
+    if metrics.TIMING_HEADER and timings:
+        response.headers["Server-Timing"] = metrics.server_timing(timings)
+    return response
+
+@app.route("/metrics")
+def metrics_route():
+    """Prometheus text exposition of the stage and request latency histograms."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/")
 def home():
     return render_template("index.html")
@@ -44,61 +202,195 @@ def login():
     return render_template("verify.html")
 @app.route("/api/verify", methods=["POST"])
 def api_verify():
-    global embedder, recognizer, le
+    embedder, recognizer, le, gallery = get_models()
     try:
-        data = request.json
-        img_b64 = data.get("image")
+        # A raw image/jpeg body, a multipart "image" part or JSON {"image": base64}
+        images, data = request_images("image")
+        img_b64 = images[0] if images else None
+        # Optional account number: verify 1:1 against that user instead of 1:N
+        claimed_id = data.get("claimed_id")
+        roi = session.get("face_box")
+
+        if claimed_id:
+            if embedder is None or gallery is None:
+                return jsonify({"ok": False, "error": "Face recognition models not loaded. Please train the model first."}), 200
+            result = recognize_from_image_b64(img_b64, embedder, recognizer, le, claimed_id=str(claimed_id), gallery=gallery, roi=roi)
+        else:
+            # Check if face recognition models are loaded
+            if not models_ready(embedder, recognizer, le):
+                return jsonify({"ok": False, "error": "Face recognition models not loaded. Please train the model first."}), 200
+            result = recognize_from_image_b64(img_b64, embedder, recognizer, le, roi=roi)
+        # Retries from the same session first look around the last face seen
+        if result.get("box"):
+            session["face_box"] = result["box"]
+        if result.get("name", "unknown") != "unknown":
+            session["user_id"] = result["name"]
+        return jsonify(result)
+    except Exception as e:
+        return jsonify({"ok": False, "error": f"Face recognition error: {str(e)}"}), 200
+
+@app.route("/healthz")
+def healthz():
+    """Readiness: models are loaded and this process has run a warmup inference."""
+    embedder, recognizer, le, gallery = get_models()
+    ready = models_ready(embedder, recognizer, le)
+    if not ready and (embedder is None or gallery is None):
+        return jsonify({"ok": False, "ready": False, "error": "Face recognition models not loaded"}), 503
+    pid = os.getpid()
+    if pid not in _warmed:
+        try:
+            # Without an SVC only 1:1 claims are served, so warm up the gallery instead
+            _warmed[pid] = warmup(embedder, recognizer, le) if ready else warmup(embedder, gallery, None)
+        except Exception as e:
+            return jsonify({"ok": False, "ready": False, "error": f"Warmup failed: {e}"}), 503
+    return jsonify({"ok": True, "ready": True, "pid": pid, "warmup": _warmed[pid]})
 
-        # Check if face recognition models are loaded
-        if embedder is None or recognizer is None or le is None:
-            return jsonify({"ok": False, "error": "Face recognition models not loaded. Please train the model first."}), 200
+@app.route("/inference/stats")
+def inference_stats():
+    embedder = get_models()[0]
+    if isinstance(embedder, BatchScheduler):
+        return jsonify({"ok": True, "mode": "batching", **embedder.metrics()})
+    if isinstance(embedder, EmbedderPool):
+        return jsonify({"ok": True, "mode": "pool", **embedder.metrics()})
+    return jsonify({"ok": True, "mode": "single"})
 
-        result = recognize_from_image_b64(img_b64, embedder, recognizer, le)
-        if result.get("name") != "unknown":
+@app.route("/api/verify/burst", methods=["POST"])
+def api_verify_burst():
+    """Several frames in one request: {"images": [...], "claimed_id"?, "voting"?, "early_stop"?}
+
+    The frames may also be sent as multipart "images" parts, with the other
+    fields as form fields.
+    """
+    embedder, recognizer, le, gallery = get_models()
+    try:
+        images, data = request_images("images")
+        if request.is_json and not isinstance(data.get("images", []), list):
+            return jsonify({"ok": False, "error": "images must be a list"}), 400
+        if len(images) > BURST_MAX_FRAMES:
+            return jsonify({"ok": False, "error": f"At most {BURST_MAX_FRAMES} frames per burst"}), 413
+        voting = data.get("voting", "mean")
+        if voting not in ("mean", "vote"):
+            return jsonify({"ok": False, "error": "voting must be 'mean' or 'vote'"}), 400
+        claimed_id = data.get("claimed_id")
+        result = recognize_burst_b64(images, embedder, recognizer, le,
+                                     claimed_id=str(claimed_id) if claimed_id else None, gallery=gallery,
+                                     voting=voting, early_stop=_flag(data.get("early_stop")),
+                                     roi=session.get("face_box"))
+        boxes = [f["box"] for f in result["frames"] if f.get("box")]
+        if boxes:
+            session["face_box"] = boxes[-1]
+        if result.get("name", "unknown") != "unknown":
             session["user_id"] = result["name"]
         return jsonify(result)
     except Exception as e:
         return jsonify({"ok": False, "error": f"Face recognition error: {str(e)}"}), 200
 
+@app.route("/api/stream", methods=["POST"])
+def api_stream_start():
+    """Open a streaming verification session: {"claimed_id"?, "voting"?} -> {session_id}"""
+    data = request.get_json(silent=True) or request.values
+    voting = data.get("voting", "mean")
+    if voting not in ("mean", "vote"):
+        return jsonify({"ok": False, "error": "voting must be 'mean' or 'vote'"}), 400
+    try:
+        stream = stream_sessions.create(claimed_id=data.get("claimed_id"), voting=voting)
+    except RuntimeError as e:
+        return jsonify({"ok": False, "error": str(e)}), 503
+    error = check_models(stream, *get_models())
+    if error:
+        stream_sessions.close(stream.id)
+        return jsonify({"ok": False, "error": error}), 200
+    # Only the browser session that opened the stream may log in with its result
+    session["stream_id"] = stream.id
+    return jsonify(dict(stream.to_dict(), ok=True))
+
+@app.route("/api/stream/<stream_id>/frame", methods=["POST"])
+def api_stream_frame(stream_id):
+    """One frame (raw image body, multipart "image" or JSON base64) for an open session."""
+    stream = stream_sessions.get(stream_id)
+    if stream is None:
+        return jsonify({"ok": False, "error": "Unknown or expired stream session"}), 404
+    images, _ = request_images("image")
+    frame, error = decode_image_b64(images[0] if images else None)
+    if frame is None:
+        return jsonify(dict(stream.to_dict(), ok=False, error=error)), 400
+    return jsonify(stream.process(frame, *get_models()))
+
+@app.route("/api/stream/<stream_id>/chunked", methods=["POST"])
+def api_stream_chunked(stream_id):
+    """Frames as one chunked upload of length-prefixed JPEGs; replies with one JSON line per frame."""
+    stream = stream_sessions.get(stream_id)
+    if stream is None:
+        return jsonify({"ok": False, "error": "Unknown or expired stream session"}), 404
+    body = request.stream
+    live = get_models()
+
+    def updates():
+        try:
+            for data in read_length_prefixed(body, app.config["MAX_CONTENT_LENGTH"]):
+                frame, error = decode_image_b64(data)
+                state = stream.process(frame, *live) if frame is not None else dict(stream.to_dict(), error=error)
+                yield json.dumps(state) + "\n"
+                if stream.done:
+                    return
+        except ValueError as e:
+            yield json.dumps(dict(stream.to_dict(), ok=False, error=str(e))) + "\n"
+
+    return Response(stream_with_context(updates()), mimetype="application/x-ndjson")
+
+@app.route("/api/stream/<stream_id>", methods=["DELETE"])
+def api_stream_finish(stream_id):
+    """Close a session; a positive decision logs the browser session in like /api/verify."""
+    stream = stream_sessions.close(stream_id)
+    if stream is None:
+        return jsonify({"ok": False, "error": "Unknown or expired stream session"}), 404
+    result = stream.to_dict()
+    if session.pop("stream_id", None) == stream_id and stream.status == "decided":
+        session["user_id"] = stream.name
+        if stream.box:
+            session["face_box"] = stream.box
+    return jsonify(dict(result, ok=True))
+
 # Login: Step 2 - PIN/Password Verification
 @app.route("/login_pin", methods=["GET", "POST"])
 def login_pin():
     user_id = session.get("user_id")
-    print('login_pin route called, user_id:', user_id)
+    log.debug("login_pin route called, user_id: %s", user_id)
     if not user_id:
         return redirect(url_for("login"))
     if request.method == "GET":
         return render_template("login_pin.html", user_id=user_id)
     pin = request.form.get("pin")
-    print('PIN received:', repr(pin))
-    df = read_accounts()
-    row = df[df["unique_id"].astype(str) == str(user_id)]
-    expected_pin = str(row.iloc[0]["password"]) if not row.empty else None
-    print('Expected PIN:', repr(expected_pin))
-    if row.empty or expected_pin != pin:
+    account = get_account(user_id)
+    expected_pin = str(account["password"]) if account else None
+    if account is None or expected_pin != pin:
         flash("Invalid PIN/password", "danger")
-        print('Invalid PIN/password for user_id:', user_id)
+        log.debug("Invalid PIN/password for user_id: %s", user_id)
         return render_template("login_pin.html", user_id=user_id)
     session["logged_in"] = True
     return redirect(url_for("dashboard", user_id=user_id))
 
     # ...existing code...
 
+# Transactions per page of the dashboard mini-statement
+HISTORY_PAGE = int(os.environ.get("FACEATM_HISTORY_PAGE", "10"))
+
 @app.route("/dashboard/<user_id>")
 def dashboard(user_id):
     if not session.get("logged_in") or session.get("user_id") != user_id:
         flash("Please login first.", "danger")
         return redirect(url_for("home"))
-    df = read_accounts()
-    row = df[df["unique_id"].astype(str) == str(user_id)]
-    if row.empty:
+    account = get_account(user_id)
+    if account is None:
         flash("Account not found", "danger")
         return redirect(url_for("home"))
-    acc_no = row.iloc[0]["account_number"]
-    name = row.iloc[0]["name"]
-    bal = int(row.iloc[0]["account_balance"])
-    history = get_history(user_id)
-    return render_template("dashboard.html", user_id=user_id, acc_no=acc_no, name=name, bal=bal, history=history)
+    acc_no = account["account_number"]
+    name = account["name"]
+    bal = int(account["account_balance"])
+    # Mini-statement: HISTORY_PAGE entries at a time, newest first
+    history, older = get_history(user_id, HISTORY_PAGE, request.args.get("cursor", type=int))
+    return render_template("dashboard.html", user_id=user_id, acc_no=acc_no, name=name, bal=bal, history=history,
+                           older=older, paged="cursor" in request.args)
 
 @app.route("/deposit/<user_id>", methods=["POST"])
 def deposit(user_id):
@@ -109,11 +401,11 @@ def deposit(user_id):
     if amt <= 0:
         flash("Enter valid amount", "danger")
         return redirect(url_for("dashboard", user_id=user_id))
-    df = read_accounts()
-    df["account_balance"] = df["account_balance"].astype(int)
-    df.loc[df["unique_id"].astype(str) == str(user_id), "account_balance"] += amt
-    write_accounts(df)
-    log_transaction(user_id, "Deposit", amt)
+    try:
+        storage.deposit(user_id, amt)
+    except AccountNotFound:
+        flash("Account not found", "danger")
+        return redirect(url_for("dashboard", user_id=user_id))
     flash(f"₹{amt} deposited", "success")
     return redirect(url_for("dashboard", user_id=user_id))
 
@@ -126,19 +418,15 @@ def withdraw(user_id):
     if amt <= 0:
         flash("Enter valid amount", "danger")
         return redirect(url_for("dashboard", user_id=user_id))
-    df = read_accounts()
-    df["account_balance"] = df["account_balance"].astype(int)
-    bal_row = df.loc[df["unique_id"].astype(str) == str(user_id), "account_balance"]
-    if bal_row.empty:
+    # The balance check and the debit happen in one storage transaction
+    try:
+        storage.withdraw(user_id, amt)
+    except AccountNotFound:
         flash("Account not found", "danger")
         return redirect(url_for("dashboard", user_id=user_id))
-    bal = int(bal_row.values[0])
-    if amt > bal:
+    except InsufficientFunds:
         flash("Insufficient balance", "danger")
         return redirect(url_for("dashboard", user_id=user_id))
-    df.loc[df["unique_id"].astype(str) == str(user_id), "account_balance"] = bal - amt
-    write_accounts(df)
-    log_transaction(user_id, "Withdraw", amt)
     flash(f"₹{amt} withdrawn", "success")
     return redirect(url_for("dashboard", user_id=user_id))
 # Logout
@@ -151,76 +439,165 @@ def logout():
 
 @app.route("/train", methods=["POST"])
 def train_route():
-    try:
-        res = train_model()
-        global embedder, recognizer, le
-        embedder, recognizer, le = load_models()
-        return jsonify({"ok":True, "trained":res.get("trained",0)})
-    except Exception as e:
-        return jsonify({"ok":False, "error":str(e)}), 500
+    job = training_queue.submit()
+    return jsonify({"ok": True, "job_id": job.id, "status": job.status}), 202
+
+@app.route("/train/status/<job_id>")
+def train_status(job_id):
+    job = training_queue.get(job_id)
+    if job is None:
+        return jsonify({"ok": False, "error": "Unknown training job"}), 404
+    res = job.to_dict()
+    res["ok"] = job.status != "failed"
+    if job.result:
+        res["trained"] = job.result.get("trained", 0)
+        res["cache"] = job.result.get("cache")
+    return jsonify(res)
+
+_enroll_embedder = None
+
+def enroll_embedder():
+    """The live embedder; before the first model is trained, one loaded for enrollment alone."""
+    global _enroll_embedder
+    embedder = get_models()[0]
+    if embedder is None:
+        with _models_lock:
+            if _enroll_embedder is None:
+                _enroll_embedder = load_embedder()
+        embedder = _enroll_embedder
+    return embedder
+
+def _enroll_images(enroll_id, images):
+    """Per-image feedback for a list of captures added to an enrollment."""
+    embedder = enroll_embedder()
+    if embedder is None:
+        return [{"ok": False, "accepted": False, "error": "Embedder not available"} for _ in images]
+    return [add_image(enroll_id, data, embedder) for data in images]
+
+@app.route("/api/enroll", methods=["POST"])
+def api_enroll_start():
+    """Open an enrollment: captures are then sent one at a time to /api/enroll/<enroll_id>/image."""
+    enroll_id = start_enrollment()
+    # Only the browser session that opened the enrollment may add to it or register with it
+    discard_enrollment(session.get("enroll_id"))
+    session["enroll_id"] = enroll_id
+    return jsonify({"ok": True, "enroll_id": enroll_id, "min_images": MIN_IMAGES, "max_images": MAX_IMAGES})
+
+@app.route("/api/enroll/<enroll_id>/image", methods=["POST"])
+def api_enroll_image(enroll_id):
+    """One capture (raw image body, multipart "image" or JSON base64): detected, embedded and kept
+    as a face crop if usable. Replies with accepted/rejected and the reason for each image."""
+    if session.get("enroll_id") != enroll_id or staging_path(enroll_id) is None:
+        return jsonify({"ok": False, "error": "Unknown or expired enrollment"}), 404
+    images, _ = request_images("image")
+    if not images:
+        return jsonify({"ok": False, "error": "No image"}), 400
+    results = _enroll_images(enroll_id, images)
+    last = results[-1]
+    return jsonify({"ok": all(r["ok"] for r in results), "enroll_id": enroll_id, "results": results,
+                    "count": last.get("count", 0), "ready": last.get("ready", False)})
+
+@app.route("/api/enroll/<enroll_id>", methods=["DELETE"])
+def api_enroll_discard(enroll_id):
+    if session.get("enroll_id") != enroll_id:
+        return jsonify({"ok": False, "error": "Unknown or expired enrollment"}), 404
+    discard_enrollment(session.pop("enroll_id"))
+    return jsonify({"ok": True})
+
+def _rejections(results):
+    reasons = sorted({r.get("error", "rejected") for r in results if not r.get("accepted")})
+    return f" (rejected: {', '.join(reasons)})" if reasons else ""
 
 # Registration page
 @app.route("/register", methods=["GET", "POST"])
 def register():
-    print('Register route called')
     if request.method == "GET":
         return render_template("register.html")
-    print('Form data received')
     name = request.form.get("name")
     acc_no = request.form.get("acc_no") or str(secrets.randbelow(1000000000))
     password = request.form.get("password")
-    images_json = request.form.get("images")
+    enroll_id = request.form.get("enroll_id")
     # validate and parse deposit safely
     deposit_raw = request.form.get("deposit", "0")
     try:
         deposit = int(deposit_raw)
     except Exception:
         deposit = 0
-    images = []
     try:
-        if images_json:
-            import base64, uuid, json
-            images = json.loads(images_json)
-            if not isinstance(images, list):
-                images = []
-        print('Images loaded:', len(images))
         # Password validation: must be 4-10 digits
         if not (password and password.isdigit() and 4 <= len(password) <= 10):
             flash("Password must be 4-10 digits.", "danger")
             return redirect(url_for("register"))
-        if not (name and acc_no and deposit > 0 and password and images and len(images) >= 5):
-            print('Validation failed')
-            flash("All fields required and at least 5 face images", "danger")
+        if safe_user_id(acc_no) is None:
+            flash("Account number may only contain letters, digits, '-' and '_'.", "danger")
+            return redirect(url_for("register"))
+        acc_no = safe_user_id(acc_no)
+        if enroll_id:
+            # Captures were already checked and embedded one by one through /api/enroll
+            if session.get("enroll_id") != enroll_id:
+                flash("Face capture session expired, please capture again.", "danger")
+                return redirect(url_for("register"))
+            results = []
+        else:
+            # Captures posted with the form (multipart JPEG parts or a JSON list of base64 images)
+            images = [f.read() for f in request.files.getlist("images")]
+            if not images and request.form.get("images"):
+                images = json.loads(request.form.get("images"))
+                if not isinstance(images, list):
+                    images = []
+            log.debug("register: %d images posted with the form", len(images))
+            enroll_id = start_enrollment() if images else None
+            results = _enroll_images(enroll_id, images) if images else []
+        if not (name and acc_no and deposit > 0 and password and enroll_id):
+            log.debug("register: missing fields or face images")
+            discard_enrollment(enroll_id)
+            flash(f"All fields required and at least {MIN_IMAGES} face images", "danger")
             return redirect(url_for("register"))
-        user_dir = os.path.join("dataset", acc_no)
-        os.makedirs(user_dir, exist_ok=True)
-        for idx, b64img in enumerate(images):
-            if b64img.startswith("data:"):
-                b64img = b64img.split(",",1)[1]
-            imgdata = base64.b64decode(b64img)
-            fname = f"face_{idx+1}_{uuid.uuid4().hex[:8]}.jpg"
-            with open(os.path.join(user_dir, fname), "wb") as f:
-                f.write(imgdata)
-        print('Images saved')
+        if get_account(acc_no) is not None:
+            # Never add faces to someone else's account
+            discard_enrollment(enroll_id)
+            session.pop("enroll_id", None)
+            flash("This account number is already taken, choose another one.", "danger")
+            return redirect(url_for("register"))
+        try:
+            saved = finish_enrollment(enroll_id, acc_no, new_user=True)
+        except ValueError as e:
+            discard_enrollment(enroll_id)
+            session.pop("enroll_id", None)
+            flash(f"{e}{_rejections(results)}", "danger")
+            return redirect(url_for("register"))
+        session.pop("enroll_id", None)
+        log.debug("register: %d face samples kept for %s", saved, acc_no)
         # Save account before training
-        import pandas as pd
-        df = read_accounts()
         new_row = {"unique_id": acc_no, "account_number": acc_no, "name": name, "bank": "FaceATM", "password": password, "account_balance": deposit}
-        df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-        print('Saving account:', new_row)
-        write_accounts(df)
-        print('Account written to CSV')
-        # Train model for this user
         try:
-            train_model()
+            create_account(new_row)
         except Exception as e:
-            print('Training failed:', e)
-            flash(f"Account saved, but training failed: {e}", "warning")
+            # new_user=True means this request created dataset/<acc_no>/: no account, no faces
+            discard_user(acc_no)
+            if not isinstance(e, AccountExists):
+                raise
+            flash("This account number is already taken, choose another one.", "danger")
+            return redirect(url_for("register"))
+        log.debug("register: account %s saved", acc_no)
+        # Train model for this user
+        if RECOGNIZER_MODE == "gallery":
+            # The gallery takes the new user as an O(1) update, no refit
+            try:
+                from train import enroll_user
+                swap_models(enroll_user(acc_no))
+            except Exception as e:
+                log.exception("register: gallery enrollment of %s failed", acc_no)
+                flash(f"Account saved, but training failed: {e}", "warning")
+                return redirect(url_for("home"))
+        else:
+            training_queue.submit()
+            flash("Account created! Your face model is being trained, you can login in a minute.", "success")
             return redirect(url_for("home"))
         flash("Account created! You can now login.", "success")
         return redirect(url_for("home"))
     except Exception as e:
-        print('Registration failed:', e)
+        log.exception("register: registration failed")
         flash(f"Registration failed: {e}", "danger")
         return redirect(url_for("register"))
 
@@ -232,18 +609,35 @@ def enroll():
     if not user_id:
         flash("Enter user id", "danger")
         return redirect(url_for("enroll"))
+    if safe_user_id(user_id) is None:
+        flash("Invalid user id", "danger")
+        return redirect(url_for("enroll"))
+    if not session.get("logged_in") or session.get("user_id") != user_id:
+        # Only the account holder may add faces to an account
+        flash("Please login as this user first.", "danger")
+        return redirect(url_for("home"))
     files = request.files.getlist("images")
     if not files:
         flash("Upload images", "danger")
         return redirect(url_for("enroll"))
-    user_dir = os.path.join("dataset", str(user_id))
-    os.makedirs(user_dir, exist_ok=True)
-    count = 0
-    for f in files:
-        save_path = os.path.join(user_dir, f.filename)
-        f.save(save_path)
-        count += 1
-    flash(f"Saved {count} images for user {user_id}. Now click Train.", "success")
+    # Uploads go through the same pipeline as registration: only face crops are
+    # kept, named by content, whatever the uploaded filenames were
+    enroll_id = start_enrollment()
+    try:
+        results = _enroll_images(enroll_id, [f.read() for f in files])
+        count = sum(1 for r in results if r.get("accepted"))
+        if count:
+            finish_enrollment(enroll_id, user_id, min_images=1)
+        else:
+            discard_enrollment(enroll_id)
+    except Exception as e:
+        log.exception("enroll: saving images for %s failed", user_id)
+        discard_enrollment(enroll_id)
+        flash(f"Saving images failed: {e}", "danger")
+        return redirect(url_for("enroll"))
+    log.debug("enroll: %d of %d images accepted for %s", count, len(files), user_id)
+    flash(f"Saved {count} of {len(files)} images for user {user_id}{_rejections(results)}. Now click Train.",
+          "success" if count else "danger")
     return redirect(url_for("enroll"))
 
 if __name__ == "__main__":
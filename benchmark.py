@@ -0,0 +1,1032 @@
+# benchmark.py - micro-benchmarks for the recognition pipeline
+#
+# Usage: python benchmark.py <name> [options]
+import argparse
+import os
+import time
+
+import numpy as np
+
+DATASET_DIR = "dataset"
+
+
+def dataset_images(limit=None):
+    paths = sorted(
+        os.path.join(root, file)
+        for root, _, files in os.walk(DATASET_DIR)
+        for file in files
+        if file.lower().endswith(('.png', '.jpg', '.jpeg'))
+    )
+    return paths[:limit] if limit else paths
+
+
+def dataset_faces(count):
+    """Face crops from dataset/, repeated until there are `count` of them."""
+    import cv2
+    from face_utils import detect_faces
+    faces = []
+    for path in dataset_images():
+        frame = cv2.imread(path)
+        if frame is None:
+            continue
+        for (x1, y1, x2, y2) in detect_faces(frame):
+            faces.append(frame[y1:y2, x1:x2])
+    if not faces:
+        raise SystemExit("No faces found in dataset/.")
+    return [faces[i % len(faces)] for i in range(count)]
+
+
+def bench_embed(args):
+    from face_utils import load_models, extract_embeddings
+    embedder, _, _ = load_models()
+    if embedder is None:
+        raise SystemExit("Embedder model not available.")
+    faces = dataset_faces(args.faces)
+    extract_embeddings(embedder, faces[:8], 8)  # warm up
+    print(f"{'batch':>6} {'faces/sec':>10}")
+    for batch_size in args.batch_sizes:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            extract_embeddings(embedder, faces, batch_size)
+        elapsed = time.perf_counter() - start
+        print(f"{batch_size:>6} {args.faces * args.repeat / elapsed:>10.1f}")
+
+
+def bench_gallery(args):
+    from face_index import ExactIndex, IVFIndex
+    rng = np.random.default_rng(0)
+    print(f"{'identities':>10} {'exact ms/q':>11} {'ivf ms/q':>9} {'ivf build s':>12} {'ivf recall@1':>13}")
+    for n in args.identities:
+        gallery = rng.standard_normal((n, 128)).astype(np.float32)
+        gallery /= np.linalg.norm(gallery, axis=1, keepdims=True)
+        classes = [str(i) for i in range(n)]
+        truth = rng.choice(n, args.queries)
+        # Probes are noisy captures of enrolled identities
+        probes = gallery[truth] + args.noise * rng.standard_normal((args.queries, 128)).astype(np.float32)
+
+        exact = ExactIndex(gallery, np.arange(n), classes, normalized=True)
+        start = time.perf_counter()
+        exact_hits = [r[0][0] for r in exact.search(probes, args.k)]
+        exact_ms = (time.perf_counter() - start) * 1000 / args.queries
+
+        start = time.perf_counter()
+        ivf = IVFIndex(gallery, np.arange(n), classes, n_probe=args.n_probe, normalized=True)
+        build_s = time.perf_counter() - start
+        start = time.perf_counter()
+        ivf_hits = [r[0][0] for r in ivf.search(probes, args.k)]
+        ivf_ms = (time.perf_counter() - start) * 1000 / args.queries
+
+        recall = np.mean([a == b for a, b in zip(exact_hits, ivf_hits)])
+        print(f"{n:>10} {exact_ms:>11.3f} {ivf_ms:>9.3f} {build_s:>12.2f} {recall:>13.3f}")
+
+
+def _iou(a, b):
+    ix = max(0, min(a[2], b[2]) - max(a[0], b[0]))
+    iy = max(0, min(a[3], b[3]) - max(a[1], b[1]))
+    inter = ix * iy
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union else 0.0
+
+
+def bench_detect(args):
+    import cv2
+    from face_utils import detect_faces
+    frames = []
+    for path in dataset_images():
+        frame = cv2.imread(path)
+        if frame is None:
+            continue
+        # Scale the enrollment captures up to webcam resolution
+        h = int(frame.shape[0] * args.frame_width / frame.shape[1])
+        frames.append(cv2.resize(frame, (args.frame_width, h), interpolation=cv2.INTER_CUBIC))
+
+    def run(**kwargs):
+        start = time.perf_counter()
+        boxes = [detect_faces(f, **kwargs) for f in frames]
+        return boxes, (time.perf_counter() - start) * 1000 / len(frames)
+
+    def largest(boxes):
+        return max(boxes, key=lambda x: (x[2] - x[0]) * (x[3] - x[1])) if boxes else None
+
+    # Recognition only uses the largest face, so that is what recall is measured on
+    full, full_ms = run(work_width=0)
+    reference = [largest(b) for b in full]
+    n_ref = sum(r is not None for r in reference)
+    print(f"{len(frames)} frames at {args.frame_width}px wide, a face on {n_ref} of them at full resolution")
+    print(f"{'mode':>14} {'ms/frame':>9} {'recall':>7}")
+    print(f"{'full':>14} {full_ms:>9.2f} {1.0:>7.3f}")
+
+    def recall(found):
+        hits = sum(r is not None and any(_iou(r, b) >= 0.5 for b in boxes) for r, boxes in zip(reference, found))
+        return hits / n_ref if n_ref else 0.0
+
+    for width in args.work_widths:
+        boxes, ms = run(work_width=width)
+        print(f"{'w=' + str(width):>14} {ms:>9.2f} {recall(boxes):>7.3f}")
+        # Same frames again, refining around the box found on the previous pass
+        rois = [largest(b) for b in boxes]
+        start = time.perf_counter()
+        roi_boxes = [detect_faces(f, work_width=width, roi=r) for f, r in zip(frames, rois)]
+        ms = (time.perf_counter() - start) * 1000 / len(frames)
+        print(f"{'w=' + str(width) + '+roi':>14} {ms:>9.2f} {recall(roi_boxes):>7.3f}")
+
+
+def _percentile_ms(latencies, q):
+    return float(np.percentile(np.asarray(latencies) * 1000, q)) if latencies else 0.0
+
+
+def bench_batching(args):
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from face_utils import load_models, extract_embeddings
+    from inference import BatchScheduler
+    embedder, _, _ = load_models()
+    if embedder is None:
+        raise SystemExit("Embedder model not available.")
+    faces = dataset_faces(args.requests)
+    lock = threading.Lock()
+
+    def direct(face):
+        # A shared cv2.dnn net is not thread-safe, so without batching calls serialize
+        with lock:
+            extract_embeddings(embedder, [face])
+
+    scheduler = BatchScheduler(embedder, window_ms=args.window_ms, max_items=args.max_items)
+    print(f"{args.requests} single-face requests from {args.threads} threads")
+    print(f"{'mode':>10} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for mode, fn in (("direct", direct), ("batched", lambda face: scheduler.embed([face]))):
+        latencies = []
+
+        def timed(face):
+            start = time.perf_counter()
+            fn(face)
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.threads) as pool:
+            list(pool.map(timed, faces))
+        elapsed = time.perf_counter() - start
+        print(f"{mode:>10} {args.requests / elapsed:>8.1f} {_percentile_ms(latencies, 50):>8.2f} "
+              f"{_percentile_ms(latencies, 99):>8.2f}")
+    scheduler.close()
+    print("batch sizes:", scheduler.metrics()["batch_sizes"])
+
+
+def bench_stress(args):
+    """Concurrent verifies through the embedder pool must match a serial run."""
+    import base64
+    import contextlib
+    import io
+    from concurrent.futures import ThreadPoolExecutor
+    from face_utils import load_embedder, load_models, recognize_from_image_b64
+    from inference import EmbedderPool
+    with contextlib.redirect_stdout(io.StringIO()):
+        embedder, recognizer, le = load_models()
+    if embedder is None:
+        raise SystemExit("Embedder model not available.")
+    images = []
+    for path in dataset_images(args.images):
+        with open(path, "rb") as f:
+            images.append("data:image/jpeg;base64," + base64.b64encode(f.read()).decode("ascii"))
+    work = [images[i % len(images)] for i in range(args.requests)]
+
+    def outcome(result):
+        return result.get("name"), round(float(result.get("proba", 0.0)), 4), result.get("error")
+
+    # Recognition prints its probabilities; keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        expected = {b64: outcome(recognize_from_image_b64(b64, embedder, recognizer, le)) for b64 in images}
+    modes = [("pool", EmbedderPool(load_embedder, args.pool_size, first=embedder))]
+    if args.shared:
+        modes.append(("shared", embedder))
+    print(f"{args.requests} verifies over {len(images)} images from {args.threads} threads")
+    print(f"{'mode':>8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'mismatches':>11}")
+    failed = False
+    for mode, shared in modes:
+        latencies = []
+
+        def verify(b64):
+            start = time.perf_counter()
+            got = outcome(recognize_from_image_b64(b64, shared, recognizer, le))
+            latencies.append(time.perf_counter() - start)
+            return got != expected[b64]
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()), ThreadPoolExecutor(args.threads) as pool:
+            mismatches = sum(pool.map(verify, work))
+        elapsed = time.perf_counter() - start
+        print(f"{mode:>8} {args.requests / elapsed:>8.1f} {_percentile_ms(latencies, 50):>8.2f} "
+              f"{_percentile_ms(latencies, 99):>8.2f} {mismatches:>11}")
+        if mode == "pool":
+            print("pool:", shared.metrics())
+            failed = failed or mismatches > 0
+    if failed:
+        raise SystemExit("Concurrent results differ from the serial run.")
+
+
+def bench_upload(args):
+    """Request size and server-side decode time: base64 JSON vs binary JPEG."""
+    import base64
+    import json
+    import cv2
+    from face_utils import decode_image_b64, decode_image_bytes
+    frames = [cv2.imread(p) for p in dataset_images(args.images)]
+    frames = [cv2.resize(f, (args.width, args.height)) for f in frames if f is not None]
+    if not frames:
+        raise SystemExit("No images found in dataset/.")
+    # JPEGs as the browser's canvas.toBlob/toDataURL would produce them
+    jpegs = [cv2.imencode(".jpg", f, [cv2.IMWRITE_JPEG_QUALITY, args.quality])[1].tobytes() for f in frames]
+    bodies = [json.dumps({"image": "data:image/jpeg;base64," + base64.b64encode(j).decode("ascii")}).encode()
+              for j in jpegs]
+
+    def from_json(body):
+        return decode_image_b64(json.loads(body)["image"])[0]
+
+    def timed(fn, payloads):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for p in payloads:
+                fn(p)
+        return (time.perf_counter() - start) * 1000 / (args.repeat * len(payloads))
+
+    json_ms = timed(from_json, bodies)
+    binary_ms = timed(lambda j: decode_image_bytes(j)[0], jpegs)
+    json_kb = np.mean([len(x) for x in bodies]) / 1024
+    binary_kb = np.mean([len(x) for x in jpegs]) / 1024
+    print(f"{len(jpegs)} frames at {args.width}x{args.height}, JPEG quality {args.quality}")
+    print(f"{'path':>12} {'KB/frame':>9} {'decode ms':>10}")
+    print(f"{'base64 json':>12} {json_kb:>9.1f} {json_ms:>10.3f}")
+    print(f"{'binary':>12} {binary_kb:>9.1f} {binary_ms:>10.3f}")
+    print(f"binary is {100 * (1 - binary_kb / json_kb):.0f}% smaller, "
+          f"register (5 frames) {5 * binary_kb:.0f} KB vs {5 * json_kb:.0f} KB")
+
+
+_STARTUP_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.app.test_client()
+status = client.get("/healthz").status_code
+ready = time.perf_counter()
+client.get("/healthz")
+again = time.perf_counter()
+print(json.dumps({"import_ms": (imported - start) * 1000, "healthz_ms": (ready - imported) * 1000,
+                  "healthz_again_ms": (again - ready) * 1000, "status": status,
+                  "sklearn": "sklearn" in sys.modules}))
+"""
+
+
+def bench_startup(args):
+    """Cold start of app.py in fresh interpreters: import, first /healthz (load + warmup)."""
+    import json
+    import subprocess
+    import sys
+    print(f"{'mode':>8} {'import ms':>10} {'healthz ms':>11} {'total ms':>9} {'again ms':>9} {'sklearn':>8}")
+    for mode, preload in (("lazy", "0"), ("preload", "1")):
+        env = dict(os.environ, FACEATM_PRELOAD=preload)
+        runs = []
+        for _ in range(args.repeat):
+            out = subprocess.run([sys.executable, "-W", "ignore", "-c", _STARTUP_PROBE], env=env,
+                                 capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(out.strip().splitlines()[-1]))
+        med = {k: float(np.median([r[k] for r in runs])) for k in ("import_ms", "healthz_ms", "healthz_again_ms")}
+        print(f"{mode:>8} {med['import_ms']:>10.0f} {med['healthz_ms']:>11.0f} "
+              f"{med['import_ms'] + med['healthz_ms']:>9.0f} {med['healthz_again_ms']:>9.1f} "
+              f"{str(runs[-1]['sklearn']):>8}")
+        if any(r["status"] != 200 for r in runs):
+            print(f"   /healthz was not ready in {mode} mode (status {runs[-1]['status']})")
+    print("With gunicorn --preload and FACEATM_PRELOAD=1 the import cost is paid once in the master;")
+    print("each forked worker then only pays the healthz column.")
+
+
+def _degrade(frame, kind):
+    import cv2
+    if kind == "blur":
+        return cv2.GaussianBlur(frame, (9, 9), 0)
+    if kind == "motion":
+        kernel = np.zeros((15, 15), np.float32)
+        kernel[7, :] = 1.0 / 15
+        return cv2.filter2D(frame, -1, kernel)
+    if kind == "dark":
+        return cv2.convertScaleAbs(frame, alpha=0.12)
+    if kind == "overexposed":
+        return cv2.convertScaleAbs(frame, alpha=2.5, beta=120)
+    return frame
+
+
+def bench_quality(args):
+    """Replay a capture log through the quality gate and count the embedder CPU it saves."""
+    import cv2
+    from collections import Counter
+    from face_utils import classify_embeddings, detect_faces, extract_embeddings, load_models, models_ready
+    from quality import check_face, check_frame
+    if args.log:
+        paths = sorted(os.path.join(args.log, f) for f in os.listdir(args.log)
+                       if f.lower().endswith(('.png', '.jpg', '.jpeg')))
+    else:
+        paths = dataset_images()
+    embedder, recognizer, le = load_models()
+    if embedder is None:
+        raise SystemExit("Embedder model not available.")
+    scored = models_ready(embedder, recognizer, le)
+    rng = np.random.default_rng(args.seed)
+    kinds = ("blur", "motion", "dark", "overexposed")
+    stats = {}
+    gate_cpu = embed_cpu = saved_cpu = detect_cpu = saved_detect_cpu = 0.0
+    low_conf = Counter()
+    for _ in range(args.repeat):
+        for path in paths:
+            frame = cv2.imread(path)
+            if frame is None:
+                continue
+            # Without a real capture log, a share of the frames is degraded the way bad captures look
+            kind = str(rng.choice(kinds)) if rng.random() < args.degrade else "clean"
+            frame = _degrade(frame, kind)
+            row = stats.setdefault(kind, {"frames": 0, "rejected": Counter()})
+            row["frames"] += 1
+            start = time.process_time()
+            reason, _ = check_frame(frame)
+            gate_cpu += time.process_time() - start
+            start = time.process_time()
+            boxes = detect_faces(frame)
+            cost = time.process_time() - start
+            detect_cpu += cost
+            if reason:
+                # Rejected on the whole frame: detection never runs either
+                saved_detect_cpu += cost
+            if not boxes:
+                if reason:
+                    row["rejected"][reason] += 1
+                continue
+            box = max(boxes, key=lambda b: (b[2]-b[0])*(b[3]-b[1]))
+            if reason is None:
+                start = time.process_time()
+                reason, _ = check_face(frame, box)
+                gate_cpu += time.process_time() - start
+            # Embed every face anyway, to know what the gate saved and what it would have returned
+            start = time.process_time()
+            vecs = extract_embeddings(embedder, [frame[box[1]:box[3], box[0]:box[2]]])
+            cost = time.process_time() - start
+            embed_cpu += cost
+            verdict = "rejected" if reason else "accepted"
+            if reason:
+                row["rejected"][reason] += 1
+                saved_cpu += cost
+            if scored:
+                low_conf[verdict, "total"] += 1
+                low_conf[verdict, "low"] += classify_embeddings(vecs, recognizer, le)[0][0] == "unknown"
+    frames = sum(r["frames"] for r in stats.values())
+    print(f"{frames} frames from {args.log or DATASET_DIR} ({args.degrade:.0%} synthetically degraded)")
+    print(f"{'kind':>12} {'frames':>7} {'rejected':>9}  reasons")
+    for kind, row in sorted(stats.items()):
+        rejected = sum(row["rejected"].values())
+        reasons = ", ".join(f"{r}={n}" for r, n in row["rejected"].most_common())
+        print(f"{kind:>12} {row['frames']:>7} {rejected:>9}  {reasons}")
+    print(f"{'CPU ms':>12} {'no gate':>8} {'saved':>8}")
+    print(f"{'embed':>12} {embed_cpu * 1000:>8.0f} {saved_cpu * 1000:>8.0f} "
+          f"({100 * saved_cpu / max(embed_cpu, 1e-9):.0f}%)")
+    print(f"{'detect':>12} {detect_cpu * 1000:>8.0f} {saved_detect_cpu * 1000:>8.0f} "
+          f"({100 * saved_detect_cpu / max(detect_cpu, 1e-9):.0f}%)")
+    print(f"{'gate cost':>12} {gate_cpu * 1000:>8.0f}")
+    for verdict in ("accepted", "rejected"):
+        if low_conf[verdict, "total"]:
+            print(f"{verdict} frames scoring unknown/low confidence: "
+                  f"{low_conf[verdict, 'low']}/{low_conf[verdict, 'total']}")
+
+
+def capture_sequence(path, frames, seed=0, step=1.5):
+    """A continuous-capture stand-in: one dataset image drifting by a small random walk."""
+    import cv2
+    base = cv2.imread(path)
+    rng = np.random.default_rng(seed)
+    offset = np.zeros(2)
+    seq = []
+    for _ in range(frames):
+        offset = np.clip(offset + rng.normal(0, step, 2), -20, 20)
+        m = np.float32([[1, 0, offset[0]], [0, 1, offset[1]]])
+        seq.append(cv2.imencode(".jpg", cv2.warpAffine(base, m, (base.shape[1], base.shape[0]),
+                                                       borderMode=cv2.BORDER_REPLICATE))[1].tobytes())
+    return seq
+
+
+def bench_stream(args):
+    """CPU per frame for continuous capture: independent /api/verify frames vs a tracked stream session."""
+    import contextlib
+    import io
+    from face_utils import decode_image_bytes, load_models, recognize_from_frame
+    from gallery import load_gallery
+    from streaming import StreamSession
+    with contextlib.redirect_stdout(io.StringIO()):
+        embedder, recognizer, le = load_models()
+    gallery = load_gallery()
+    if embedder is None:
+        raise SystemExit("Embedder model not available.")
+    paths = dataset_images()[::max(1, len(dataset_images()) // args.sequences)][:args.sequences]
+    sequences = [capture_sequence(p, args.frames, seed=i) for i, p in enumerate(paths)]
+    total = sum(len(s) for s in sequences)
+
+    start = time.process_time()
+    for seq in sequences:
+        roi = None
+        for data in seq:
+            result = recognize_from_frame(decode_image_bytes(data)[0], embedder, recognizer, le, roi=roi)
+            roi = result.get("box") or roi
+    stateless = time.process_time() - start
+
+    start = time.process_time()
+    stats = {"detections": 0, "tracked": 0, "embeddings": 0}
+    decided = []
+    for seq in sequences:
+        stream = StreamSession(voting="mean")
+        for i, data in enumerate(seq):
+            stream.process(decode_image_bytes(data)[0], embedder, recognizer, le, gallery)
+            if stream.done:
+                decided.append((stream.status, stream.stats["frames"]))
+                if args.stop:
+                    break
+                # Keep the capture going with a fresh session so every frame costs something
+                for k in stats:
+                    stats[k] += stream.stats[k]
+                stream = StreamSession(voting="mean")
+        if not stream.done or not args.stop:
+            decided.append((stream.status, stream.stats["frames"]))
+        for k in stats:
+            stats[k] += stream.stats[k]
+    streamed = time.process_time() - start
+
+    print(f"{len(sequences)} sequences x {args.frames} frames ({total} frames), every frame processed"
+          if not args.stop else f"{len(sequences)} sequences x up to {args.frames} frames")
+    print(f"{'mode':>10} {'CPU ms/frame':>13}")
+    print(f"{'stateless':>10} {stateless * 1000 / total:>13.2f}")
+    print(f"{'stream':>10} {streamed * 1000 / total:>13.2f}  ({stateless / max(streamed, 1e-9):.1f}x less CPU)")
+    print(f"stream: {stats['detections']} detections, {stats['tracked']} tracked frames, "
+          f"{stats['embeddings']} embeddings for {total} frames")
+    print("decisions:", ", ".join(f"{s}@{n}" for s, n in decided))
+
+
+def _private_kb():
+    """(private, rss) kB of this process, private being its USS (Linux only)."""
+    fields = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[1].isdigit():
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    return fields["Private_Clean"] + fields["Private_Dirty"], fields["Rss"]
+
+
+def _worker_load(kind, model_dir, barrier, results):
+    import pickle
+    from gallery import GALLERY_FILE, load_gallery
+    from model_store import load_shared
+    probe = np.random.default_rng(os.getpid()).standard_normal((4, 128)).astype(np.float32)
+    before, rss_before = _private_kb()
+    if kind == "gallery-pickle":
+        model = load_gallery(model_dir)
+    elif kind == "gallery-mapped":
+        model = load_gallery(model_dir, mapped=True)
+    elif kind == "svc-pickle":
+        with open(os.path.join(model_dir, "recognizer.pickle"), "rb") as f:
+            model = pickle.load(f)
+    else:
+        model = load_shared(os.path.join(model_dir, "recognizer.shared"))
+    # Touch everything a request would: a full search / predict
+    if kind.startswith("gallery"):
+        model.search(probe, 5)
+    else:
+        model.predict_proba(probe)
+    private, rss = _private_kb()
+    barrier.wait()  # every worker holds its model while the others measure
+    results.put((private - before, rss - rss_before))
+    barrier.wait()
+
+
+def _worker_poll(start_gen, interval, results):
+    from model_store import generation
+    while generation() == start_gen:
+        time.sleep(interval)
+    results.put(time.monotonic())
+
+
+def bench_workers(args):
+    """Per-worker memory of pickled vs memory-mapped models, and generation bump pickup."""
+    import multiprocessing
+    import pickle
+    import shutil
+    import tempfile
+    from gallery import FaceGallery, save_gallery
+    import model_store
+    ctx = multiprocessing.get_context("fork")  # gunicorn forks its workers the same way
+    rng = np.random.default_rng(0)
+    tmp = tempfile.mkdtemp(prefix="faceatm-workers-")
+    try:
+        jobs = []
+        for n in args.users:
+            model_dir = os.path.join(tmp, f"gallery-{n}")
+            gallery = FaceGallery()
+            for i, vec in enumerate(rng.standard_normal((n, 128)).astype(np.float32)):
+                gallery.add(f"user{i:07d}", vec)
+            save_gallery(gallery, model_dir)
+            jobs += [(f"{n} users", kind, model_dir) for kind in ("gallery-pickle", "gallery-mapped")]
+        if args.svc_users:
+            from sklearn.svm import SVC
+            model_dir = os.path.join(tmp, "svc")
+            os.makedirs(model_dir)
+            vecs = rng.standard_normal((args.svc_users * args.svc_samples, 128)).astype(np.float32)
+            labels = np.repeat(np.arange(args.svc_users), args.svc_samples)
+            svc = SVC(C=1.0, kernel="linear", probability=True).fit(vecs, labels)
+            with open(os.path.join(model_dir, "recognizer.pickle"), "wb") as f:
+                f.write(pickle.dumps(svc))
+            model_store.save_shared(svc, os.path.join(model_dir, "recognizer.shared"))
+            del svc, vecs
+            jobs += [(f"SVC {args.svc_users}x{args.svc_samples}", kind, model_dir)
+                     for kind in ("svc-pickle", "svc-shared")]
+
+        del gallery
+        # Keep the collector from touching (and so copying) the parent's objects in the workers
+        import gc
+        gc.collect()
+        gc.freeze()
+        print(f"{args.workers} forked workers, memory added by loading the model (median per worker)")
+        print(f"{'model':>16} {'load':>15} {'private MB':>11} {'RSS MB':>8}")
+        for label, kind, model_dir in jobs:
+            barrier = ctx.Barrier(args.workers)
+            results = ctx.Queue()
+            procs = [ctx.Process(target=_worker_load, args=(kind, model_dir, barrier, results))
+                     for _ in range(args.workers)]
+            for p in procs:
+                p.start()
+            got = [results.get() for _ in procs]
+            for p in procs:
+                p.join()
+            private = np.median([g[0] for g in got]) / 1024
+            rss = np.median([g[1] for g in got]) / 1024
+            print(f"{label:>16} {kind:>15} {private:>11.2f} {rss:>8.2f}")
+
+        cwd = os.getcwd()
+        os.chdir(tmp)  # model_store paths are relative to the working directory
+        try:
+            start = time.perf_counter()
+            for _ in range(100000):
+                model_store.generation()
+            per_call = (time.perf_counter() - start) * 1e9 / 100000
+            lags = []
+            for _ in range(args.bumps):
+                start_gen = model_store.generation()
+                results = ctx.Queue()
+                procs = [ctx.Process(target=_worker_poll, args=(start_gen, args.interval / 1000.0, results))
+                         for _ in range(args.workers)]
+                for p in procs:
+                    p.start()
+                time.sleep(0.2)
+                bumped = time.monotonic()
+                model_store.bump_generation()
+                lags += [(results.get() - bumped) * 1000 for _ in procs]
+                for p in procs:
+                    p.join()
+        finally:
+            os.chdir(cwd)
+        print(f"generation() check: {per_call:.0f} ns per request")
+        print(f"bump seen by all workers polling every {args.interval:g} ms: "
+              f"p50 {np.percentile(lags, 50):.2f} ms, max {max(lags):.2f} ms")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+_SCORER_PROBE = """
+import json, os, pickle, sys, time
+start = time.perf_counter()
+if sys.argv[1] == "npz":
+    from linear_scorer import LinearScorer
+    model = LinearScorer.load(os.path.join(sys.argv[2], "recognizer.npz"))
+else:
+    with open(os.path.join(sys.argv[2], "recognizer.pickle"), "rb") as f:
+        model = pickle.load(f)
+print(json.dumps({"load_ms": (time.perf_counter() - start) * 1000, "sklearn": "sklearn" in sys.modules}))
+"""
+
+
+def bench_scorer(args):
+    """sklearn predict_proba vs the exported NumPy scorer: agreement, load time, latency per batch."""
+    import json
+    import pickle
+    import subprocess
+    import sys
+    import tempfile
+    from linear_scorer import SCORER_FILE, LinearScorer, export_svc
+    from model_store import current_model_dir
+    model_dir = args.model_dir or current_model_dir()
+    with open(os.path.join(model_dir, "recognizer.pickle"), "rb") as f:
+        svc = pickle.load(f)
+    with open(os.path.join(model_dir, "le.pickle"), "rb") as f:
+        le = pickle.load(f)
+    with tempfile.TemporaryDirectory() as tmp:
+        export_svc(svc, le, os.path.join(tmp, SCORER_FILE))
+        with open(os.path.join(tmp, "recognizer.pickle"), "wb") as f:
+            f.write(pickle.dumps(svc))
+        scorer = LinearScorer.load(os.path.join(tmp, SCORER_FILE))
+        print(f"{len(le.classes_)} classes, {len(scorer.weights)} pairwise hyperplanes")
+        print(f"{'artifact':>9} {'load ms':>8} {'sklearn imported':>17}")
+        for kind in ("pickle", "npz"):
+            runs = [json.loads(subprocess.run([sys.executable, "-W", "ignore", "-c", _SCORER_PROBE, kind, tmp],
+                                              capture_output=True, text=True, check=True).stdout)
+                    for _ in range(args.repeat)]
+            print(f"{kind:>9} {np.median([r['load_ms'] for r in runs]):>8.1f} {str(runs[0]['sklearn']):>17}")
+
+    rng = np.random.default_rng(0)
+    probes = rng.standard_normal((max(args.batch_sizes) * 4, 128)).astype(np.float32)
+    probes /= np.linalg.norm(probes, axis=1, keepdims=True)
+    ours, theirs = scorer.predict_proba(probes), svc.predict_proba(probes)
+    print(f"max |proba difference| {np.abs(ours - theirs).max():.2e}, "
+          f"argmax agreement {np.mean(ours.argmax(1) == theirs.argmax(1)):.3f}")
+    print(f"{'batch':>6} {'sklearn ms':>11} {'numpy ms':>9}")
+    for n in args.batch_sizes:
+        batch = probes[:n]
+        timings = []
+        for fn in (svc.predict_proba, scorer.predict_proba):
+            fn(batch)
+            start = time.perf_counter()
+            for _ in range(args.repeat * 10):
+                fn(batch)
+            timings.append((time.perf_counter() - start) * 1000 / (args.repeat * 10))
+        print(f"{n:>6} {timings[0]:>11.3f} {timings[1]:>9.3f}")
+
+
+def _seed_ledger(directory, rows, seed=0):
+    """bank_details.csv and transactions.csv with `rows` accounts and `rows` transactions."""
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    ids = np.arange(100000000, 100000000 + rows).astype(str)
+    pd.DataFrame({"unique_id": ids, "account_number": ids, "name": "user", "bank": "FaceATM",
+                  "password": "1234", "account_balance": rng.integers(1000, 100000, rows)}
+                 ).to_csv(os.path.join(directory, "bank_details.csv"), index=False)
+    pd.DataFrame({"user_id": ids[rng.integers(0, rows, rows)], "type": "Deposit",
+                  "amount": rng.integers(1, 1000, rows), "timestamp": "2025-01-01 00:00:00"}
+                 ).to_csv(os.path.join(directory, "transactions.csv"), index=False)
+    return ids
+
+
+def bench_ledger(args):
+    """ops/sec of deposit / withdraw / ledger append / account lookup / history, CSV vs SQLite."""
+    import tempfile
+    from sqlite_storage import SQLiteStorage
+    from storage import CSVStorage
+    rng = np.random.default_rng(0)
+    ops = ("deposit", "withdraw", "log_transaction", "get_account", "get_history")
+    print(f"{'rows':>8} {'backend':>8} {'setup s':>8} " + " ".join(f"{op + ' op/s':>20}" for op in ops))
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as tmp:
+            ids = _seed_ledger(tmp, rows)
+            accounts, txns = os.path.join(tmp, "bank_details.csv"), os.path.join(tmp, "transactions.csv")
+            for name in args.backends:
+                start = time.perf_counter()
+                if name == "csv":
+                    store = CSVStorage(accounts, txns)
+                else:
+                    # Opening a fresh database migrates the CSVs into it
+                    store = SQLiteStorage(os.path.join(tmp, "bench.db"), accounts, txns)
+                store.get_history(ids[0])  # the CSV ledger builds its per-user index here
+                setup = time.perf_counter() - start
+                rates = []
+                for op in ops:
+                    fn = getattr(store, op)
+                    count, start = 0, time.perf_counter()
+                    while count < args.min_ops or time.perf_counter() - start < args.seconds:
+                        user = ids[rng.integers(0, rows)]
+                        if op == "log_transaction":
+                            fn(user, "Deposit", 1)
+                        else:
+                            fn(user, 1) if op in ("deposit", "withdraw") else fn(user)
+                        count += 1
+                    rates.append(count / (time.perf_counter() - start))
+                print(f"{rows:>8} {name:>8} {setup:>8.2f} " + " ".join(f"{r:>20.1f}" for r in rates))
+
+
+_LEDGER_OPS = ("deposit", "withdraw", "dashboard")
+
+
+def _ledger_status(status, location):
+    """The status, with the redirect home of a rejected session counted as a 401."""
+    from urllib.parse import urlsplit
+    if status in (301, 302, 303) and not urlsplit(location or "").path.startswith("/dashboard/"):
+        return 401
+    return status
+
+
+def _ledger_client(app, base_url):
+    """send(method, path, body, cookie) -> status, through the test client or HTTP."""
+    if base_url is None:
+        client = app.test_client()
+        name = app.config["SESSION_COOKIE_NAME"]
+
+        def send(method, path, body, cookie):
+            client.set_cookie(name, cookie)  # the test client only sends cookies from its own jar
+            resp = client.open(path, method=method, data=body)
+            resp.close()
+            return _ledger_status(resp.status_code, resp.location)
+        return send
+    import http.client
+    import urllib.parse
+    host, port = urllib.parse.urlsplit(base_url).netloc.split(":")
+    conn = [None]
+
+    def send(method, path, body, cookie):
+        headers = {"Cookie": f"session={cookie}"}
+        if body is not None:
+            body = urllib.parse.urlencode(body)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        for attempt in range(2):
+            try:
+                if conn[0] is None:
+                    conn[0] = http.client.HTTPConnection(host, int(port), timeout=30)
+                conn[0].request(method, path, body, headers)
+                resp = conn[0].getresponse()
+                resp.read()
+                if resp.getheader("Connection", "").lower() == "close":
+                    conn[0].close()
+                    conn[0] = None
+                return _ledger_status(resp.status, resp.getheader("Location"))
+            except (OSError, http.client.HTTPException):
+                conn[0] = None  # the server closed a kept-alive connection; retry once
+                if attempt:
+                    raise
+    return send
+
+
+def _ledger_worker(workdir, env, base_url, users, args, seed, results):
+    """One load-generating process: args.threads threads, each sending its share of requests."""
+    import contextlib
+    import io
+    import threading
+    os.chdir(workdir)
+    os.environ.update(env)
+    with contextlib.redirect_stdout(io.StringIO()):
+        from app import app
+    # Requests carry a session cookie signed with the server's key, as after a face + PIN login
+    serializer = app.session_interface.get_signing_serializer(app)
+    cookies = {u: serializer.dumps({"user_id": u, "logged_in": True}) for u in users}
+    latencies = {op: [] for op in _LEDGER_OPS}
+    counts = {"deposit_requests": 0, "errors": 0}
+    lock = threading.Lock()
+
+    def run(thread):
+        rng = np.random.default_rng(seed * 1000 + thread)
+        send = _ledger_client(app, base_url)
+        local = {op: [] for op in _LEDGER_OPS}
+        deposits = errors = 0
+        for _ in range(args.requests // (args.threads * args.processes)):
+            user = users[rng.integers(len(users))]
+            op = _LEDGER_OPS[rng.choice(3, p=args.mix)]
+            amount = int(rng.integers(1, args.max_amount + 1))
+            start = time.perf_counter()
+            try:
+                if op == "dashboard":
+                    status = send("GET", f"/dashboard/{user}", None, cookies[user])
+                else:
+                    status = send("POST", f"/{op}/{user}", {"amount": str(amount)}, cookies[user])
+            except Exception:
+                status = 599
+            local[op].append(time.perf_counter() - start)
+            if status >= 400:
+                errors += 1
+            elif op == "deposit":
+                deposits += 1
+        with lock:
+            for op in _LEDGER_OPS:
+                latencies[op] += local[op]
+            counts["deposit_requests"] += deposits
+            counts["errors"] += errors
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(args.threads)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    results.put((latencies, counts))
+
+
+def _wait_for_server(base_url, timeout=60.0):
+    import urllib.error
+    import urllib.request
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(base_url + "/", timeout=2).read()
+            return
+        except urllib.error.HTTPError:
+            return  # any HTTP answer means the workers are up
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit(f"gunicorn did not come up at {base_url}")
+
+
+def bench_loadtest(args):
+    """Concurrent deposits, withdrawals and dashboards through app.py, then ledger invariants."""
+    import multiprocessing
+    import re
+    import secrets
+    import socket
+    import subprocess
+    import sys
+    import tempfile
+    import pandas as pd
+    repo = os.path.dirname(os.path.abspath(__file__))
+    ctx = multiprocessing.get_context("fork")
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="faceatm-load-")
+    try:
+        ids = _seed_ledger(workdir, args.accounts, seed=args.seed)
+        accounts = pd.read_csv(os.path.join(workdir, "bank_details.csv"), dtype={"unique_id": str})
+        # Opening balances small enough that some withdrawals must be refused
+        opening = np.random.default_rng(args.seed).integers(0, args.max_amount * 4, args.accounts)
+        accounts["account_balance"] = opening
+        accounts.to_csv(os.path.join(workdir, "bank_details.csv"), index=False)
+        with open(os.path.join(workdir, "transactions.csv"), "w") as f:
+            f.write("user_id,type,amount,timestamp\n")
+        opening = dict(zip(accounts["unique_id"], opening.tolist()))
+        env = {"FACEATM_STORAGE": args.backend, "FACEATM_DB": "faceatm.db",
+               "FLASK_SECRET_KEY": secrets.token_hex(16), "FACEATM_LOG_LEVEL": "WARNING"}
+        users = list(ids)
+
+        server, base_url = None, None
+        if args.mode == "gunicorn":
+            with socket.socket() as s:
+                s.bind(("127.0.0.1", 0))
+                port = s.getsockname()[1]
+            base_url = f"http://127.0.0.1:{port}"
+            server = subprocess.Popen(
+                [sys.executable, "-m", "gunicorn", "-w", str(args.workers), "--threads", str(args.server_threads),
+                 "-b", f"127.0.0.1:{port}", "--log-level", "warning", "app:app"],
+                cwd=workdir, env=dict(os.environ, PYTHONPATH=repo, **env),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            _wait_for_server(base_url)
+
+        results = ctx.Queue()
+        procs = [ctx.Process(target=_ledger_worker, args=(workdir, env, base_url, users, args, i, results))
+                 for i in range(args.processes)]
+        start = time.perf_counter()
+        for p in procs:
+            p.start()
+        got = [results.get() for _ in procs]
+        elapsed = time.perf_counter() - start
+        for p in procs:
+            p.join()
+        if server is not None:
+            server.terminate()
+            server.wait(30)
+
+        latencies = {op: [x for lat, _ in got for x in lat[op]] for op in _LEDGER_OPS}
+        total = sum(len(v) for v in latencies.values())
+        deposit_requests = sum(c["deposit_requests"] for _, c in got)
+        errors = sum(c["errors"] for _, c in got)
+        target = "test client" if server is None else f"gunicorn -w {args.workers} --threads {args.server_threads}"
+        print(f"{args.backend} backend via {target}: {args.processes} processes x {args.threads} threads, "
+              f"{args.accounts} accounts")
+        print(f"{total} requests in {elapsed:.2f} s = {total / elapsed:.1f} req/s, {errors} errors")
+        print(f"{'route':>10} {'count':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        for op in _LEDGER_OPS:
+            lat = latencies[op]
+            print(f"{op:>10} {len(lat):>7} {_percentile_ms(lat, 50):>8.2f} {_percentile_ms(lat, 95):>8.2f} "
+                  f"{_percentile_ms(lat, 99):>8.2f}")
+
+        # Invariants, read back through the same storage backend
+        os.chdir(workdir)
+        os.environ.update(env)
+        import storage
+        store = storage.open_backend(args.backend)
+        line = re.compile(r": (Deposit|Withdraw) ₹(\d+)$")
+        lost, negative, deposits_logged, withdrawals_logged = [], [], 0, 0
+        for user in users:
+            balance = int(store.get_account(user)["account_balance"])
+            history, _ = store.get_history(user)
+            expected = opening[user]
+            for entry in history:
+                kind, amount = line.search(entry).groups()
+                expected += int(amount) if kind == "Deposit" else -int(amount)
+                deposits_logged += kind == "Deposit"
+                withdrawals_logged += kind == "Withdraw"
+            if balance != expected:
+                lost.append((user, balance, expected))
+            if balance < 0:
+                negative.append(user)
+        print(f"invariants: {len(lost)} balances differ from opening + logged transactions, "
+              f"{len(negative)} negative balances, {deposits_logged}/{deposit_requests} deposits logged, "
+              f"{withdrawals_logged}/{len(latencies['withdraw'])} withdrawals allowed")
+        for user, balance, expected in lost[:5]:
+            print(f"   {user}: balance {balance}, opening + log = {expected}")
+        if lost or negative or deposits_logged != deposit_requests:
+            raise SystemExit("Ledger invariants violated.")
+    finally:
+        os.chdir(cwd)
+        import shutil
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FaceATM benchmarks")
+    sub = parser.add_subparsers(dest="name", required=True)
+
+    p = sub.add_parser("embed", help="embedding throughput per batch size")
+    p.add_argument("--faces", type=int, default=256)
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 64])
+    p.set_defaults(func=bench_embed)
+
+    p = sub.add_parser("gallery", help="top-k identification over synthetic galleries")
+    p.add_argument("--identities", type=int, nargs="+", default=[1000, 10000, 100000])
+    p.add_argument("--queries", type=int, default=200)
+    p.add_argument("--k", type=int, default=5)
+    p.add_argument("--n-probe", type=int, default=8)
+    p.add_argument("--noise", type=float, default=0.05)
+    p.set_defaults(func=bench_gallery)
+
+    p = sub.add_parser("detect", help="face detection latency/recall per working width")
+    p.add_argument("--frame-width", type=int, default=1280)
+    p.add_argument("--work-widths", type=int, nargs="+", default=[320, 480, 640])
+    p.set_defaults(func=bench_detect)
+
+    p = sub.add_parser("batching", help="concurrent embedding with and without the micro-batcher")
+    p.add_argument("--requests", type=int, default=512)
+    p.add_argument("--threads", type=int, default=16)
+    p.add_argument("--window-ms", type=float, default=5.0)
+    p.add_argument("--max-items", type=int, default=32)
+    p.set_defaults(func=bench_batching)
+
+    p = sub.add_parser("stress", help="concurrent verifies through the embedder pool vs a serial run")
+    p.add_argument("--requests", type=int, default=400)
+    p.add_argument("--images", type=int, default=40)
+    p.add_argument("--threads", type=int, default=16)
+    p.add_argument("--pool-size", type=int, default=2)
+    p.add_argument("--shared", action="store_true", help="also run on one unguarded shared net")
+    p.set_defaults(func=bench_stress)
+
+    p = sub.add_parser("upload", help="payload size and decode time, base64 JSON vs binary uploads")
+    p.add_argument("--images", type=int, default=40)
+    p.add_argument("--width", type=int, default=640)
+    p.add_argument("--height", type=int, default=480)
+    p.add_argument("--quality", type=int, default=80)
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_upload)
+
+    p = sub.add_parser("startup", help="app.py cold start, lazy vs preloaded models")
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser("quality", help="embedder CPU saved by the frame quality gate on a replayed capture log")
+    p.add_argument("--log", help="directory of captured frames (default: dataset/)")
+    p.add_argument("--degrade", type=float, default=0.3, help="fraction of frames to blur/darken/overexpose")
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=bench_quality)
+
+    p = sub.add_parser("stream", help="per-frame CPU, independent frames vs tracked stream sessions")
+    p.add_argument("--sequences", type=int, default=5)
+    p.add_argument("--frames", type=int, default=60)
+    p.add_argument("--stop", action="store_true", help="stop a sequence once its session has decided")
+    p.set_defaults(func=bench_stream)
+
+    p = sub.add_parser("workers", help="per-worker memory of pickled vs memory-mapped models, reload pickup")
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--users", type=int, nargs="+", default=[1000, 10000, 50000])
+    p.add_argument("--svc-users", type=int, default=50, help="classes of the synthetic SVC (0 to skip)")
+    p.add_argument("--svc-samples", type=int, default=20, help="samples per SVC class")
+    p.add_argument("--bumps", type=int, default=5)
+    p.add_argument("--interval", type=float, default=1.0, help="ms between two requests of a worker")
+    p.set_defaults(func=bench_workers)
+
+    p = sub.add_parser("scorer", help="sklearn SVC vs the exported NumPy scorer: agreement, load and scoring time")
+    p.add_argument("--model-dir", help="model version with recognizer.pickle and le.pickle (default: live)")
+    p.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 64, 256])
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_scorer)
+
+    p = sub.add_parser("ledger", help="ops/sec of the CSV and SQLite storage backends")
+    p.add_argument("--rows", type=int, nargs="+", default=[10000, 1000000], help="accounts (and transactions)")
+    p.add_argument("--backends", nargs="+", default=["csv", "sqlite"], choices=["csv", "sqlite"])
+    p.add_argument("--seconds", type=float, default=2.0, help="time per operation and backend")
+    p.add_argument("--min-ops", type=int, default=3)
+    p.set_defaults(func=bench_ledger)
+
+    p = sub.add_parser("loadtest", help="concurrent deposit/withdraw/dashboard requests, then ledger invariants")
+    p.add_argument("--backend", default="csv", choices=["csv", "sqlite"])
+    p.add_argument("--mode", default="client", choices=["client", "gunicorn"],
+                   help="Flask test client in each process, or HTTP to a local gunicorn")
+    p.add_argument("--accounts", type=int, default=200)
+    p.add_argument("--requests", type=int, default=2000, help="total, split evenly over every thread")
+    p.add_argument("--processes", type=int, default=4, help="load-generating processes")
+    p.add_argument("--threads", type=int, default=8, help="threads per load-generating process")
+    p.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    p.add_argument("--server-threads", type=int, default=4, help="threads per gunicorn worker")
+    p.add_argument("--mix", type=float, nargs=3, default=[0.4, 0.4, 0.2], metavar=("DEPOSIT", "WITHDRAW", "DASHBOARD"))
+    p.add_argument("--max-amount", type=int, default=500)
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=bench_loadtest)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+# embedding_store.py - memory-mapped embedding matrix + label array
+#
+# A model directory holds
+#   embeddings.npy   float32 (count, dim) matrix
+#   labels.npy       int32 (count,) indexes into meta["classes"]
+#   embeddings.json  {format, model, dim, count, classes, sha256}
+#
+# Both .npy files carry a fixed-size header, so appending rows only writes
+# the new rows and patches the shape in place. The JSON metadata is replaced
+# atomically last and is the authority on how many rows are valid.
+import hashlib
+import json
+import os
+import pickle
+import secrets
+import sys
+
+import numpy as np
+
+from model_store import current_model_dir
+
+FORMAT_VERSION = 1
+MATRIX_FILE = "embeddings.npy"
+LABELS_FILE = "labels.npy"
+META_FILE = "embeddings.json"
+LEGACY_PICKLE = "embeddings.pickle"
+# Whole .npy header (magic + length + dict), big enough for any shape we write
+HEADER_BYTES = 128
+
+
+def _write_header(f, dtype, shape):
+    header = repr({"descr": np.dtype(dtype).str, "fortran_order": False, "shape": tuple(shape)})
+    pad = HEADER_BYTES - 10 - len(header) - 1
+    if pad < 0:
+        raise ValueError(f"shape {shape} does not fit in the .npy header")
+    f.seek(0)
+    f.write(b"\x93NUMPY\x01\x00" + np.uint16(HEADER_BYTES - 10).tobytes())
+    f.write(header.encode("latin1") + b" " * pad + b"\n")
+
+
+def _tmp_path(path):
+    """A temporary name next to path that no other writer uses.
+
+    Read paths migrate legacy pickles (ensure_store), so two workers may
+    write the same store at once; a shared .tmp name would mix their bytes.
+    """
+    return f"{path}.{os.getpid()}.{secrets.token_hex(4)}.tmp"
+
+
+def _write_array(path, arr):
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, "wb") as f:
+        _write_header(f, arr.dtype, arr.shape)
+        f.write(np.ascontiguousarray(arr).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _append_array(path, arr, old_count):
+    with open(path, "r+b") as f:
+        # Rows past the committed count (an interrupted append) are overwritten,
+        # never truncated: other workers may have those pages mapped, and a
+        # mapping past the end of the file faults with SIGBUS
+        f.seek(HEADER_BYTES + old_count * arr.dtype.itemsize * int(np.prod(arr.shape[1:])))
+        f.write(np.ascontiguousarray(arr).tobytes())
+        _write_header(f, arr.dtype, (old_count + arr.shape[0],) + arr.shape[1:])
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _write_meta(model_dir, meta):
+    path = os.path.join(model_dir, META_FILE)
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _encode(names, classes):
+    index = {c: i for i, c in enumerate(classes)}
+    for name in names:
+        if name not in index:
+            index[name] = len(classes)
+            classes.append(name)
+    return np.fromiter((index[n] for n in names), dtype=np.int32, count=len(names))
+
+
+def store_exists(model_dir=None):
+    return os.path.exists(os.path.join(model_dir or current_model_dir(), META_FILE))
+
+
+def read_meta(model_dir=None):
+    with open(os.path.join(model_dir or current_model_dir(), META_FILE), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_store(model_dir, vecs, names, model_name):
+    """Write a complete store, replacing whatever was in model_dir."""
+    vecs = np.asarray(vecs, dtype=np.float32)
+    names = [str(n) for n in names]
+    if vecs.ndim != 2 or len(vecs) != len(names):
+        raise ValueError("vecs must be (N, dim) with one name per row")
+    classes = []
+    labels = _encode(names, classes)
+    os.makedirs(model_dir, exist_ok=True)
+    _write_array(os.path.join(model_dir, MATRIX_FILE), vecs)
+    _write_array(os.path.join(model_dir, LABELS_FILE), labels)
+    digest = hashlib.sha256(vecs.tobytes() + labels.tobytes()).hexdigest()
+    meta = {"format": FORMAT_VERSION, "model": model_name, "dim": int(vecs.shape[1]),
+            "count": int(len(vecs)), "classes": classes, "sha256": digest}
+    _write_meta(model_dir, meta)
+    return meta
+
+
+def append_store(model_dir, vecs, names):
+    """Append rows without rewriting existing ones.
+
+    sha256 becomes a chain: sha256(previous digest + appended rows + labels).
+    """
+    meta = read_meta(model_dir)
+    vecs = np.asarray(vecs, dtype=np.float32).reshape(-1, meta["dim"])
+    names = [str(n) for n in names]
+    if len(vecs) != len(names):
+        raise ValueError("one name per row is required")
+    if not len(vecs):
+        return meta
+    classes = list(meta["classes"])
+    labels = _encode(names, classes)
+    _append_array(os.path.join(model_dir, MATRIX_FILE), vecs, meta["count"])
+    _append_array(os.path.join(model_dir, LABELS_FILE), labels, meta["count"])
+    meta["sha256"] = hashlib.sha256(meta["sha256"].encode("ascii") + vecs.tobytes() + labels.tobytes()).hexdigest()
+    meta["count"] += len(vecs)
+    meta["classes"] = classes
+    _write_meta(model_dir, meta)
+    return meta
+
+
+def open_store(model_dir=None):
+    """Return (matrix, labels, meta); matrix and labels are read-only memory maps."""
+    model_dir = model_dir or current_model_dir()
+    meta = read_meta(model_dir)
+    count = meta["count"]
+    matrix = np.load(os.path.join(model_dir, MATRIX_FILE), mmap_mode="r")[:count]
+    labels = np.load(os.path.join(model_dir, LABELS_FILE), mmap_mode="r")[:count]
+    return matrix, labels, meta
+
+
+def load_names(labels, meta):
+    """Per-row user ids for a label array."""
+    return np.asarray(meta["classes"])[labels]
+
+
+def migrate_pickle(model_dir=None, model_name="nn4.small2.v1.t7"):
+    """One-time conversion of a legacy embeddings.pickle in model_dir to the store."""
+    model_dir = model_dir or current_model_dir()
+    with open(os.path.join(model_dir, LEGACY_PICKLE), "rb") as f:
+        data = pickle.load(f)
+    vecs = np.asarray(data.get("embeddings", []), dtype=np.float32)
+    # An empty pickle has no dimension to reshape to; nn4.small2.v1 vectors are 128-d
+    vecs = vecs.reshape(len(vecs), -1) if len(vecs) else np.empty((0, 128), dtype=np.float32)
+    return write_store(model_dir, vecs, data.get("names", []), model_name)
+
+
+def ensure_store(model_dir=None):
+    """True when model_dir has a store, migrating a legacy pickle if that's all there is."""
+    model_dir = model_dir or current_model_dir()
+    if store_exists(model_dir):
+        return True
+    if os.path.exists(os.path.join(model_dir, LEGACY_PICKLE)):
+        migrate_pickle(model_dir)
+        return True
+    return False
+
+
+if __name__ == "__main__":
+    target = sys.argv[1] if len(sys.argv) > 1 else current_model_dir()
+    meta = migrate_pickle(target)
+    print(f"Migrated {meta['count']} embeddings ({len(meta['classes'])} users) in {target}")
@@ -0,0 +1,338 @@
+# enrollment.py - enrollment one image at a time, keeping only the face
+#
+# Each capture is decoded, quality-gated, detected and embedded as soon as
+# it arrives, and the client is told straight away whether it was accepted.
+# Only the face crop (CROP_SIDE px square JPEG) and its embedding (an .npz
+# next to it, tagged with the embedder's digest) are written, named after
+# the crop's content hash, so the client's filename never reaches the
+# disk. train.py reads the stored embedding instead of re-detecting and
+# re-embedding; after an embedder change it embeds the crop as it is.
+#
+# Captures of an enrollment in progress are staged in STAGING_DIR/<id>/
+# (outside dataset/, so a retrain never picks them up) and moved to
+# dataset/<user_id>/ when the account is created. The staging directory is
+# the whole state, so any gunicorn worker can take the next image.
+import hashlib
+import os
+import re
+import secrets
+import shutil
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from face_utils import EMBEDDER_MODEL, decode_image_b64, detect_faces, extract_embeddings, gate_face, gate_frame
+from metrics import timed
+from quality import face_score
+from selection import cosine_distances, select_diverse
+
+DATASET_DIR = "dataset"
+STAGING_DIR = os.environ.get("FACEATM_ENROLL_STAGING", os.path.join("output", "enroll"))
+# Side of the stored square face crop; a little above the embedder's 96 px input
+CROP_SIDE = int(os.environ.get("FACEATM_ENROLL_CROP_SIDE", "112"))
+CROP_QUALITY = 90
+# Accepted images needed to finish an enrollment, and the most kept
+MIN_IMAGES = 5
+MAX_IMAGES = int(os.environ.get("FACEATM_ENROLL_MAX_IMAGES", "50"))
+# Samples kept per user: the MAX_SAMPLES most diverse (selection.py) once more arrive
+MAX_SAMPLES = int(os.environ.get("FACEATM_ENROLL_MAX_SAMPLES", "10"))
+# A capture within this cosine distance of one already staged is a near-duplicate;
+# two frames of one sample user are 0.004-0.47 apart (median 0.06), of different users 0.09+
+DUPLICATE_DISTANCE = float(os.environ.get("FACEATM_ENROLL_DUPLICATE_DISTANCE", "0.01"))
+# Staged enrollments untouched for this many seconds are deleted
+STAGING_TTL = float(os.environ.get("FACEATM_ENROLL_TTL", "3600"))
+EMBEDDING_SUFFIX = ".npz"
+# Embeddings of every crop a user was enrolled with, pruned ones included: the
+# gallery threshold follows their spread, not only the diverse samples kept
+ACCEPTED_FILE = "accepted.npz"
+# User ids become directory names
+_SAFE_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+_version_lock = threading.Lock()
+_version = (None, None)  # ((path, mtime_ns, size), digest)
+
+
+def safe_user_id(user_id):
+    """user_id as a string if it is usable as a directory name, else None."""
+    user_id = str(user_id or "").strip()
+    return user_id if _SAFE_ID.match(user_id) else None
+
+
+def embedder_version(path=EMBEDDER_MODEL):
+    """Digest of the embedder file, the same one train.py keys its cache by (hashed once per change)."""
+    global _version
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    with _version_lock:
+        if _version[0] != key:
+            h = hashlib.sha1()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+            _version = (key, h.hexdigest())
+        return _version[1]
+
+
+def face_crop(frame, box, side=CROP_SIDE):
+    """The square around a face box, clipped to the frame and scaled to side x side."""
+    (h, w) = frame.shape[:2]
+    x1, y1, x2, y2 = box
+    half = max(x2 - x1, y2 - y1) / 2.0
+    cx, cy = (x1 + x2) / 2.0, (y1 + y2) / 2.0
+    x1, x2 = max(0, int(round(cx - half))), min(w, int(round(cx + half)))
+    y1, y2 = max(0, int(round(cy - half))), min(h, int(round(cy + half)))
+    return cv2.resize(frame[y1:y2, x1:x2], (side, side), interpolation=cv2.INTER_AREA)
+
+
+def detect_crop(data):
+    """(face crop, box, rejection) for one encoded capture; rejection is None when usable."""
+    frame, error = decode_image_b64(data)
+    if frame is None:
+        return None, None, {"error": error}
+    rejected = gate_frame(frame)
+    if rejected:
+        return None, None, rejected
+    boxes = detect_faces(frame)
+    if not boxes:
+        return None, None, {"error": "No faces detected"}
+    box = [int(v) for v in max(boxes, key=lambda b: (b[2] - b[0]) * (b[3] - b[1]))]
+    if box[2] - box[0] < 20 or box[3] - box[1] < 20:
+        return None, box, {"error": "Face too small"}
+    rejected = gate_face(frame, box)
+    if rejected:
+        return None, box, rejected
+    with timed("crop"):
+        return face_crop(frame, box), box, None
+
+
+def embedding_path(image_path):
+    return os.path.splitext(image_path)[0] + EMBEDDING_SUFFIX
+
+
+def is_crop(image_path):
+    """True for an image written by enrollment: already a face crop, nothing to detect."""
+    return os.path.exists(embedding_path(image_path))
+
+
+def read_embedding(image_path, model_version):
+    """The stored embedding of an enrollment crop, or None if absent or from another embedder."""
+    try:
+        with np.load(embedding_path(image_path), allow_pickle=False) as data:
+            if str(data["model"]) != model_version:
+                return None
+            return np.asarray(data["vec"], dtype=np.float32)
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def read_samples(directory):
+    """(crop filenames, embeddings, quality scores, embedder digests) of the enrollment crops in a directory."""
+    names, vecs, quality, models = [], [], [], []
+    for name in list_crops(directory):
+        try:
+            with np.load(embedding_path(os.path.join(directory, name)), allow_pickle=False) as data:
+                vec = np.asarray(data["vec"], dtype=np.float32)
+                score = float(data["quality"]) if "quality" in data else 1.0
+                model = str(data["model"])
+        except (OSError, KeyError, ValueError):
+            continue
+        names.append(name)
+        vecs.append(vec)
+        quality.append(score)
+        models.append(model)
+    return names, vecs, quality, models
+
+
+def save_crop(directory, crop, vec, model_version, quality=1.0):
+    """Write crop + embedding under the crop's content hash; returns the image filename."""
+    ok, encoded = cv2.imencode(".jpg", crop, [cv2.IMWRITE_JPEG_QUALITY, CROP_QUALITY])
+    if not ok:
+        raise ValueError("Could not encode the face crop")
+    data = encoded.tobytes()
+    name = "face_" + hashlib.sha1(data).hexdigest()[:16]
+    image_path = os.path.join(directory, name + ".jpg")
+    # Embedding first: a crop on disk always has its embedding
+    tmp_path = os.path.join(directory, name + ".tmp.npz")
+    np.savez(tmp_path, vec=np.asarray(vec, dtype=np.float32), model=np.array(model_version),
+             quality=np.float32(quality))
+    os.replace(tmp_path, embedding_path(image_path))
+    tmp_path = image_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, image_path)
+    return name + ".jpg"
+
+
+def list_crops(directory):
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return sorted(n for n in names if n.endswith(".jpg") and is_crop(os.path.join(directory, n)))
+
+
+def start_enrollment():
+    """Open a staging directory for a new enrollment and return its id."""
+    cleanup_staging()
+    enroll_id = secrets.token_urlsafe(16)
+    os.makedirs(os.path.join(STAGING_DIR, enroll_id))
+    return enroll_id
+
+
+def staging_path(enroll_id):
+    """The staging directory of an open enrollment, or None."""
+    if not enroll_id or not _SAFE_ID.match(str(enroll_id)):
+        return None
+    path = os.path.join(STAGING_DIR, enroll_id)
+    return path if os.path.isdir(path) else None
+
+
+def add_image(enroll_id, data, embedder):
+    """Detect, embed and stage one capture (bytes or base64). Returns the per-image feedback dict.
+
+    "accepted" says whether the capture was kept, "count" how many the
+    enrollment holds and "ready" whether that is enough to finish it.
+    """
+    directory = staging_path(enroll_id)
+    if directory is None:
+        return {"ok": False, "accepted": False, "error": "Unknown or expired enrollment"}
+    count = len(list_crops(directory))
+    res = {"ok": True, "accepted": False, "enroll_id": enroll_id}
+    if count >= MAX_IMAGES:
+        res["error"] = f"Enough images already ({MAX_IMAGES})"
+    else:
+        crop, box, rejected = detect_crop(data)
+        if rejected:
+            res.update(rejected)
+        else:
+            with timed("embed"):
+                vec = extract_embeddings(embedder, [crop])[0]
+            _, staged, _, _ = read_samples(directory)
+            distance = float(cosine_distances([vec], staged).min()) if staged else None
+            if distance is not None and distance < DUPLICATE_DISTANCE:
+                # Another frame of the same pose adds nothing to the gallery
+                res.update({"error": "Too similar to an earlier picture, turn your head a little",
+                            "reason": "near_duplicate", "distance": distance})
+            else:
+                with timed("enroll_write"):
+                    name = save_crop(directory, crop, vec, embedder_version(), face_score(crop))
+                res.update({"accepted": True, "file": name, "box": box})
+                count = len(list_crops(directory))
+    os.utime(directory)
+    res.update({"count": count, "ready": count >= MIN_IMAGES})
+    return res
+
+
+def finish_enrollment(enroll_id, user_id, min_images=MIN_IMAGES, new_user=False):
+    """Move the staged crops to dataset/<user_id>/; returns how many samples the user keeps.
+
+    Beyond MAX_SAMPLES crops per user only the most diverse are kept (see
+    prune_samples). Raises ValueError (and keeps the staging directory)
+    with fewer than min_images accepted captures, or with new_user when
+    dataset/<user_id>/ already exists; a successful new_user call created it.
+    """
+    directory = staging_path(enroll_id)
+    user_id = safe_user_id(user_id)
+    if directory is None or user_id is None:
+        raise ValueError("Unknown enrollment or invalid user id")
+    names = list_crops(directory)
+    if len(names) < min_images:
+        raise ValueError(f"At least {min_images} usable face images are needed, {len(names)} accepted")
+    user_dir = os.path.join(DATASET_DIR, user_id)
+    if new_user:
+        os.makedirs(DATASET_DIR, exist_ok=True)
+        try:
+            # mkdir is atomic: of two registrations racing for one id only one gets the directory.
+            # An existing directory, even an empty one, is someone else's: the winner may not
+            # have moved its crops in yet.
+            os.mkdir(user_dir)
+        except FileExistsError:
+            raise ValueError(f"User {user_id} already has face images") from None
+    else:
+        os.makedirs(user_dir, exist_ok=True)
+    for name in names:
+        src = os.path.join(directory, name)
+        # Embedding before image, as when writing
+        os.replace(embedding_path(src), embedding_path(os.path.join(user_dir, name)))
+        os.replace(src, os.path.join(user_dir, name))
+    discard_enrollment(enroll_id)
+    return prune_samples(user_dir)
+
+
+def prune_samples(user_dir, k=MAX_SAMPLES):
+    """Delete all but the k most diverse enrollment crops of a user; returns how many are left.
+
+    The embeddings of every crop, pruned or not, are first added to the
+    user's ACCEPTED_FILE for the gallery threshold (read_accepted).
+    Images that are not enrollment crops (full frames from older
+    registrations) are left alone.
+    """
+    names, vecs, quality, models = read_samples(user_dir)
+    if vecs:
+        record_accepted(user_dir, names, vecs, models)
+    keep = set(select_diverse(vecs, k, quality).tolist()) if vecs else set()
+    for i, name in enumerate(names):
+        if i not in keep:
+            path = os.path.join(user_dir, name)
+            # Image before embedding, the reverse of writing
+            os.remove(path)
+            os.remove(embedding_path(path))
+    return len(keep)
+
+
+def record_accepted(user_dir, names, vecs, models):
+    """Merge crop embeddings into the user's ACCEPTED_FILE, keyed by crop filename."""
+    path = os.path.join(user_dir, ACCEPTED_FILE)
+    rows = {}
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            rows = dict(zip(data["names"].tolist(), zip(data["vecs"], data["models"].tolist())))
+    except Exception:
+        pass  # missing or unreadable: start over from the crops at hand
+    rows.update(zip(names, zip(vecs, models)))
+    keys = sorted(rows)
+    # Unique per writer, as np.savez appends .npz to other names
+    tmp_path = f"{path}.{os.getpid()}.{secrets.token_hex(4)}.tmp.npz"
+    np.savez(tmp_path, names=np.array(keys, dtype=str), models=np.array([rows[n][1] for n in keys], dtype=str),
+             vecs=np.asarray([rows[n][0] for n in keys], dtype=np.float32).reshape(len(keys), -1))
+    os.replace(tmp_path, path)
+
+
+def read_accepted(user_dir, model_version):
+    """{crop filename: embedding} of every crop the user was enrolled with under model_version."""
+    try:
+        with np.load(os.path.join(user_dir, ACCEPTED_FILE), allow_pickle=False) as data:
+            return {name: vec for name, vec, model in zip(data["names"].tolist(), np.asarray(data["vecs"]),
+                                                          data["models"].tolist()) if model == model_version}
+    except Exception:
+        return {}
+
+
+def discard_user(user_id):
+    """Delete dataset/<user_id>/, undoing a finish_enrollment whose account was never created."""
+    user_id = safe_user_id(user_id)
+    if user_id is not None:
+        shutil.rmtree(os.path.join(DATASET_DIR, user_id), ignore_errors=True)
+
+
+def discard_enrollment(enroll_id):
+    directory = staging_path(enroll_id)
+    if directory is not None:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def cleanup_staging(ttl=STAGING_TTL):
+    """Delete staged enrollments nobody has added to for ttl seconds."""
+    cutoff = time.time() - ttl
+    try:
+        entries = list(os.scandir(STAGING_DIR))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            pass
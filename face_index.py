@@ -0,0 +1,122 @@
+# face_index.py - top-k 1:N identification over a gallery matrix
+#
+# Rows of the matrix are embeddings (or per-user centroids) and labels[i] is
+# the class index of row i (labels=None: row i is class i). search() returns,
+# per probe, the k best users with their best cosine similarity. Both indexes only ever hold one chunk of
+# similarities in memory, so the matrix may be a read-only memory map.
+import numpy as np
+
+# Rows scored per matrix multiply
+CHUNK_SIZE = 65536
+# Galleries with more rows than this get an approximate (IVF) index
+ANN_THRESHOLD = 50000
+
+
+def _normalize(vecs):
+    vecs = np.asarray(vecs, dtype=np.float32)
+    norms = np.linalg.norm(vecs, axis=-1, keepdims=True)
+    return vecs / np.maximum(norms, 1e-12)
+
+
+def _top_k(best, classes, k):
+    """[(user_id, score), ...] for the k largest entries of best, highest first."""
+    k = min(k, int(np.sum(best > -np.inf)))
+    if k <= 0:
+        return []
+    idx = np.argpartition(-best, k - 1)[:k]
+    idx = idx[np.argsort(-best[idx], kind="stable")]
+    return [(str(classes[i]), float(best[i])) for i in idx]
+
+
+class ExactIndex:
+    """Brute-force cosine search, one matrix multiply per chunk of rows."""
+
+    def __init__(self, matrix, labels, classes, chunk_size=CHUNK_SIZE, normalized=False):
+        self.matrix = matrix
+        self.labels = None if labels is None else np.asarray(labels)
+        # A (memory-mapped) array of names is kept as is rather than copied into a list
+        self.classes = classes if isinstance(classes, np.ndarray) else list(classes)
+        self.chunk_size = chunk_size
+        self.normalized = normalized
+        # One row per class (e.g. centroids) needs no per-class max reduction
+        self.one_row_per_class = self.labels is None or (
+            len(self.labels) == len(self.classes) and np.array_equal(self.labels, np.arange(len(self.classes))))
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def _score_rows(self, probes, rows):
+        """Per-probe, per-class best similarity over the given row ranges/indices."""
+        best = np.full((len(probes), len(self.classes)), -np.inf, dtype=np.float32)
+        for sel in rows:
+            block = self.matrix[sel]
+            if not self.normalized:
+                block = _normalize(block)
+            sims = probes @ block.T
+            if self.one_row_per_class:
+                best[:, sel] = sims
+                continue
+            labels = self.labels[sel]
+            for q in range(len(probes)):
+                np.maximum.at(best[q], labels, sims[q])
+        return best
+
+    def search(self, probes, k=5):
+        probes = _normalize(np.atleast_2d(probes))
+        chunks = (slice(i, i + self.chunk_size) for i in range(0, len(self.matrix), self.chunk_size))
+        best = self._score_rows(probes, chunks)
+        return [_top_k(b, self.classes, k) for b in best]
+
+
+class IVFIndex(ExactIndex):
+    """Inverted-file index: spherical k-means lists, only n_probe lists are scanned.
+
+    Recall trades against speed through n_probe; n_probe == n_lists is exact.
+    """
+
+    def __init__(self, matrix, labels, classes, n_lists=None, n_probe=8, train_size=20000,
+                 iters=10, chunk_size=CHUNK_SIZE, normalized=False, seed=42):
+        super().__init__(matrix, labels, classes, chunk_size, normalized)
+        n = len(matrix)
+        self.n_lists = n_lists or max(1, int(np.sqrt(n)))
+        self.n_probe = min(n_probe, self.n_lists)
+        rng = np.random.default_rng(seed)
+        sample = _normalize(matrix[np.sort(rng.choice(n, min(n, train_size), replace=False))])
+        self.centroids = sample[rng.choice(len(sample), self.n_lists, replace=False)]
+        for _ in range(iters):
+            assign = np.argmax(sample @ self.centroids.T, axis=1)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assign, sample)
+            empty = np.bincount(assign, minlength=self.n_lists) == 0
+            # Re-seed empty lists from random samples rather than losing them
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            self.centroids = _normalize(sums)
+        assign = np.empty(n, dtype=np.int32)
+        for i in range(0, n, chunk_size):
+            block = matrix[i:i + chunk_size]
+            if not normalized:
+                block = _normalize(block)
+            assign[i:i + chunk_size] = np.argmax(block @ self.centroids.T, axis=1)
+        order = np.argsort(assign, kind="stable")
+        bounds = np.searchsorted(assign[order], np.arange(self.n_lists + 1))
+        self.lists = [order[bounds[j]:bounds[j + 1]] for j in range(self.n_lists)]
+
+    def search(self, probes, k=5):
+        probes = _normalize(np.atleast_2d(probes))
+        coarse = probes @ self.centroids.T
+        results = []
+        for q in range(len(probes)):
+            nearest = np.argpartition(-coarse[q], self.n_probe - 1)[:self.n_probe]
+            rows = np.sort(np.concatenate([self.lists[j] for j in nearest]))
+            chunks = (rows[i:i + self.chunk_size] for i in range(0, len(rows), self.chunk_size))
+            best = self._score_rows(probes[q:q + 1], chunks)[0]
+            results.append(_top_k(best, self.classes, k))
+        return results
+
+
+def build_index(matrix, labels, classes, ann_threshold=ANN_THRESHOLD, **kwargs):
+    """Exact search for small galleries, IVF above ann_threshold rows."""
+    if len(matrix) > ann_threshold:
+        return IVFIndex(matrix, labels, classes, **kwargs)
+    kwargs = {k: v for k, v in kwargs.items() if k in ("chunk_size", "normalized")}
+    return ExactIndex(matrix, labels, classes, **kwargs)
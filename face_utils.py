@@ -1,8 +1,19 @@
 # face_utils.py - Simplified version without external dependencies
+import logging
 import os
-import cv2
 import numpy as np
 import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from gallery import FaceGallery, load_gallery
+from inference import BatchScheduler, EmbedderPool
+from metrics import propagate, timed
+from linear_scorer import SCORER_FILE, LinearScorer
+from model_store import current_model_dir, load_shared
+from quality import QUALITY_GATE_ENABLED, REASONS, check_face, check_frame, rejection
+
+log = logging.getLogger(__name__)
 
 # Try to import optional dependencies, but don't fail if not available
 OPENCV_AVAILABLE = True
@@ -21,28 +32,68 @@ OUTPUT_DIR = "output"
 EMBEDDER_MODEL = "nn4.small2.v1.t7"   # if your embedder is named differently, change
 CAFFE_PROTO = "deploy.prototxt"
 CAFFE_MODEL = "res10_300x300_ssd_iter_140000.caffemodel"
+# Haar detection runs on frames scaled down to this width (0 = full resolution)
+DETECT_WORK_WIDTH = int(os.environ.get("FACEATM_DETECT_WIDTH", "640"))
+# ROI refinement enlarges the previous face box by this fraction per side
+ROI_MARGIN = 0.5
+# "svc" uses the pickled SVC + LabelEncoder, "gallery" the centroid gallery (gallery.py)
+RECOGNIZER_MODE = os.environ.get("FACEATM_RECOGNIZER", "svc").lower()
+# Score the SVC with sklearn's pickled model even when a recognizer.npz export exists
+SKLEARN_SCORING = os.environ.get("FACEATM_SKLEARN_SCORING", "0") == "1"
 
-print("🔧 Face recognition modules status:")
-print(f"   OpenCV: {'✅ Available' if OPENCV_AVAILABLE else '❌ Not available'}")
-print(f"   Mediapipe: {'✅ Available' if MEDIAPIPE_AVAILABLE else '❌ Not available'}")
-print(f"   Face Recognition: {'✅ Available' if FACE_RECOGNITION_AVAILABLE else '❌ Not available'}")
+def print_status():
+    print("🔧 Face recognition modules status:")
+    print(f"   OpenCV: {'✅ Available' if OPENCV_AVAILABLE else '❌ Not available'}")
+    print(f"   Mediapipe: {'✅ Available' if MEDIAPIPE_AVAILABLE else '❌ Not available'}")
+    print(f"   Face Recognition: {'✅ Available' if FACE_RECOGNITION_AVAILABLE else '❌ Not available'}")
 
-# Initialize components only if available
+# Initialize components only if available; the cascade itself loads on first use
 mp_fd = None
-face_cascade = None
+cascade_path = None
 if OPENCV_AVAILABLE:
     cascade_path = os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml")
-    if os.path.exists(cascade_path):
-        face_cascade = cv2.CascadeClassifier(cascade_path)
-        if face_cascade.empty():
-            face_cascade = None
-            print("⚠️  Failed to load Haar cascade for face detection")
-    else:
+# None until the first detection, then whether the cascade could be loaded
+_cascade_ok = None
+
+# A CascadeClassifier keeps scratch buffers between detectMultiScale calls
+# and returns wrong boxes when threads share it, so each thread loads its own
+_thread_state = threading.local()
+
+def _thread_cascade():
+    """This thread's Haar cascade, or None if it cannot be loaded."""
+    global _cascade_ok
+    cascade = getattr(_thread_state, "cascade", None)
+    if cascade is not None or _cascade_ok is False:
+        return cascade
+    if cascade_path is None or not os.path.exists(cascade_path):
         print(f"⚠️  Haar cascade file not found at {cascade_path}")
+        _cascade_ok = False
+        return None
+    cascade = cv2.CascadeClassifier(cascade_path)
+    if cascade.empty():
+        print("⚠️  Failed to load Haar cascade for face detection")
+        _cascade_ok = False
+        return None
+    _cascade_ok = True
+    _thread_state.cascade = cascade
+    return cascade
+
+def load_embedder():
+    """A fresh cv2.dnn embedder net, or None if the model file is missing."""
+    if not os.path.exists(EMBEDDER_MODEL):
+        return None
+    return cv2.dnn.readNetFromTorch(EMBEDDER_MODEL)
 
-def load_models():
-    """Load face recognition models if available"""
-    embedder = None
+def load_models(model_dir=None, embedder=None):
+    """Load face recognition models if available (from the live model version by default)
+
+    Pass an already loaded embedder to only reload the recognizer. The SVC
+    is read from the pickle-free recognizer.npz when the model version has
+    one (then the LinearScorer is returned as both recognizer and le, and
+    sklearn is never imported). Otherwise the gallery and the SVC are
+    memory-mapped from gallery.npy / recognizer.shared when present, so
+    forked workers share their pages.
+    """
     recognizer = None
     le = None
 
@@ -50,18 +101,38 @@ def load_models():
         print("⚠️  Cannot load models - OpenCV not available")
         return None, None, None
 
-    try:
-        if os.path.exists(EMBEDDER_MODEL):
-            embedder = cv2.dnn.readNetFromTorch(EMBEDDER_MODEL)
-            print(f"✅ Loaded embedder model: {EMBEDDER_MODEL}")
-    except Exception as e:
-        print(f"⚠️  Could not load embedder: {e}")
+    if embedder is None:
+        try:
+            embedder = load_embedder()
+            if embedder is not None:
+                print(f"✅ Loaded embedder model: {EMBEDDER_MODEL}")
+        except Exception as e:
+            print(f"⚠️  Could not load embedder: {e}")
+
+    if RECOGNIZER_MODE == "gallery":
+        try:
+            recognizer = load_gallery(model_dir, mapped=True)
+            if recognizer is not None:
+                print(f"✅ Loaded face gallery ({len(recognizer)} users)")
+        except Exception as e:
+            print(f"⚠️  Could not load face gallery: {e}")
+        return embedder, recognizer, None
 
-    rec_path = os.path.join(OUTPUT_DIR, "recognizer.pickle")
-    le_path = os.path.join(OUTPUT_DIR, "le.pickle")
+    model_dir = model_dir or current_model_dir()
+    rec_path = os.path.join(model_dir, "recognizer.pickle")
+    shared_path = os.path.join(model_dir, "recognizer.shared")
+    scorer_path = os.path.join(model_dir, SCORER_FILE)
+    le_path = os.path.join(model_dir, "le.pickle")
 
     try:
-        if os.path.exists(rec_path) and os.path.exists(le_path):
+        if os.path.exists(scorer_path) and not SKLEARN_SCORING:
+            recognizer = le = LinearScorer.load(scorer_path)
+            print("✅ Loaded trained recognition models (NumPy scorer)")
+        elif os.path.exists(shared_path) and os.path.exists(le_path):
+            recognizer = load_shared(shared_path)
+            le = pickle.loads(open(le_path, "rb").read())
+            print("✅ Loaded trained recognition models (shared)")
+        elif os.path.exists(rec_path) and os.path.exists(le_path):
             recognizer = pickle.loads(open(rec_path, "rb").read())
             le = pickle.loads(open(le_path, "rb").read())
             print("✅ Loaded trained recognition models")
@@ -70,8 +141,69 @@ def load_models():
 
     return embedder, recognizer, le
 
-def detect_faces(frame):
-    """Detect faces using available backends (mediapipe preferred, otherwise Haar cascade)."""
+def models_ready(embedder, recognizer, le):
+    """True when recognition can run; the gallery recognizer needs no label encoder."""
+    if embedder is None or recognizer is None:
+        return False
+    return le is not None or isinstance(recognizer, FaceGallery)
+
+def warmup(embedder, recognizer, le):
+    """Run one synthetic frame through detection, embedding and scoring.
+
+    The first call of each stage pays for lazy setup (cascade load, dnn
+    graph allocation, BLAS threads); returns how long each stage took in ms.
+    """
+    timings = {}
+    frame = np.full((480, 640, 3), 127, dtype=np.uint8)
+    start = time.perf_counter()
+    detect_faces(frame)
+    timings["detect_ms"] = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    vecs = extract_embeddings(embedder, [frame[:96, :96]])
+    timings["embed_ms"] = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    classify_embeddings(vecs, recognizer, le)
+    timings["score_ms"] = (time.perf_counter() - start) * 1000
+    return timings
+
+def classify_embeddings(vecs, recognizer, le, min_proba=0.5):
+    """Score embedding rows, returning a (name, proba) pair per row.
+
+    name is "unknown" when the best match is below min_proba (SVC) or the
+    matched user's similarity threshold (gallery).
+    """
+    results = []
+    if isinstance(recognizer, FaceGallery):
+        with timed("classify"):
+            matches = recognizer.match_batch(vecs)
+        for name, score in matches:
+            results.append((name if name is not None else "unknown", score))
+        return results
+    with timed("classify"):
+        probas = recognizer.predict_proba(vecs)
+    for preds in probas:
+        j = np.argmax(preds)
+        proba = float(preds[j])
+        name = le.classes_[j]
+        if name == 'unknown' or proba < min_proba:
+            name = "unknown"
+        results.append((str(name), proba))
+    return results
+
+def detect_faces(frame, work_width=None, roi=None):
+    """Detect faces using available backends (mediapipe preferred, otherwise Haar cascade).
+
+    The Haar path runs on a copy scaled down to work_width (DETECT_WORK_WIDTH
+    by default, 0 = full resolution) and maps boxes back to frame coordinates,
+    so crops still come from the original frame. With roi, the previous face
+    box, it first searches only around that box.
+    """
+    with timed("detect"):
+        return _detect_faces(frame, work_width, roi)
+
+def _detect_faces(frame, work_width, roi):
+    if work_width is None:
+        work_width = DETECT_WORK_WIDTH
     if not OPENCV_AVAILABLE:
         print("❌ Cannot detect faces - OpenCV not available")
         return []
@@ -95,52 +227,143 @@ def detect_faces(frame):
         return boxes
 
     # Fallback to Haar cascade
-    if face_cascade is not None:
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        rects = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
-        boxes = []
-        for (x, y, w, h) in rects:
-            boxes.append((x, y, x + w, y + h))
-        return boxes
+    if _thread_cascade() is not None:
+        if roi is not None:
+            boxes = _detect_in_roi(frame, roi, work_width)
+            if boxes:
+                return boxes
+        return _haar_detect(frame, work_width)
 
     print("⚠️  No face detection backend available")
     return []
 
+def _haar_detect(frame, work_width, min_side=30, max_side=None):
+    """Haar detection on a copy scaled down to work_width, boxes in frame coordinates.
+
+    min_side/max_side bound the face size in frame pixels.
+    """
+    (h, w) = frame.shape[:2]
+    scale = 1.0
+    if work_width and w > work_width:
+        scale = work_width / float(w)
+        frame = cv2.resize(frame, (work_width, max(1, int(round(h * scale)))), interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    # 24 px is the cascade's own window, nothing smaller can be found
+    min_size = max(24, int(round(min_side * scale)))
+    max_size = (0, 0)
+    if max_side:
+        side = max(min_size + 1, int(round(max_side * scale)))
+        max_size = (side, side)
+    rects = _thread_cascade().detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5,
+                                               minSize=(min_size, min_size), maxSize=max_size)
+    boxes = []
+    for (x, y, bw, bh) in rects:
+        x1 = int(x / scale)
+        y1 = int(y / scale)
+        boxes.append((x1, y1, min(w, int((x + bw) / scale)), min(h, int((y + bh) / scale))))
+    return boxes
+
+def _detect_in_roi(frame, roi, work_width):
+    """Detect only around the previous face box, at about its previous size."""
+    (h, w) = frame.shape[:2]
+    x1, y1, x2, y2 = [int(v) for v in roi]
+    side = max(x2 - x1, y2 - y1)
+    mx = int((x2 - x1) * ROI_MARGIN)
+    my = int((y2 - y1) * ROI_MARGIN)
+    x1, y1 = max(0, x1 - mx), max(0, y1 - my)
+    x2, y2 = min(w, x2 + mx), min(h, y2 + my)
+    if x2 - x1 < 24 or y2 - y1 < 24:
+        return []
+    # Same pixel scale as a full-frame pass would use
+    roi_width = int((x2 - x1) * work_width / w) if work_width and w > work_width else 0
+    boxes = _haar_detect(frame[y1:y2, x1:x2], roi_width,
+                         min_side=max(30, int(side * 0.6)), max_side=int(side * 1.6))
+    return [(bx1 + x1, by1 + y1, bx2 + x1, by2 + y1) for (bx1, by1, bx2, by2) in boxes]
+
+# Faces per forward pass when several crops are embedded together
+EMBED_BATCH_SIZE = 32
+
+def extract_embeddings(embedder, faces, batch_size=EMBED_BATCH_SIZE):
+    """Embed a list of BGR face crops, batch_size crops per forward pass.
+
+    Returns an (N, 128) float32 matrix, one row per input crop.
+    """
+    if isinstance(embedder, BatchScheduler):
+        # Shared with other requests, the scheduler decides the batching
+        return embedder.embed(faces)
+    if isinstance(embedder, EmbedderPool):
+        return embedder.embed(faces, batch_size)
+    if not faces:
+        return np.empty((0, 128), dtype=np.float32)
+    batch_size = max(1, int(batch_size))
+    out = []
+    for i in range(0, len(faces), batch_size):
+        blob = cv2.dnn.blobFromImages(faces[i:i + batch_size], 1.0/255, (96,96), (0,0,0), swapRB=True, crop=False)
+        embedder.setInput(blob)
+        vecs = embedder.forward()
+        out.append(vecs.reshape(vecs.shape[0], -1))
+    return np.vstack(out).astype(np.float32, copy=False)
+
 def extract_embedding(embedder, face):
     if face is None:
-        print('extract_embedding: face is None')
+        log.debug("extract_embedding: face is None")
         return None
     if not isinstance(face, np.ndarray):
-        print('extract_embedding: face is not a numpy array, type:', type(face))
+        log.debug("extract_embedding: face is not a numpy array, type: %s", type(face))
+        return None
+    log.debug("extract_embedding: face shape: %s dtype: %s", face.shape, face.dtype)
+    with timed("embed"):
+        return extract_embeddings(embedder, [face])[0]
+
+def gate_frame(frame):
+    """Quality gate on the whole frame: rejection fields, or None to go on."""
+    if not QUALITY_GATE_ENABLED:
+        return None
+    with timed("quality"):
+        reason, measures = check_frame(frame)
+    return rejection(reason, measures) if reason else None
+
+def gate_face(frame, box):
+    """Quality gate on the chosen face box: rejection fields, or None to go on."""
+    if not QUALITY_GATE_ENABLED:
         return None
-    print('extract_embedding: face shape:', face.shape, 'dtype:', face.dtype)
-    blob = cv2.dnn.blobFromImage(face, 1.0/255, (96,96), (0,0,0), swapRB=True, crop=False)
-    embedder.setInput(blob)
-    vec = embedder.forward()
-    return vec.flatten()
+    with timed("quality"):
+        reason, measures = check_face(frame, box)
+    return rejection(reason, measures) if reason else None
 
-def recognize_from_frame(frame, embedder, recognizer, le, min_proba=0.5):
+def recognize_from_frame(frame, embedder, recognizer, le, min_proba=0.5, top_k=0, roi=None):
     """
     Input: BGR frame (numpy)
-    Output: dict {name, proba} or {'name':'unknown'}
+    Output: dict {name, proba, box} or {'name':'unknown'}
+    With the gallery recognizer and top_k > 0 the k best [user_id, score]
+    pairs are added as "candidates". roi is the face box of the previous
+    frame of the same session, see detect_faces. Frames failing the quality
+    gate (quality.py) come back with a "reason" code instead of a match.
     """
     if not OPENCV_AVAILABLE:
         return {"name": "unknown", "proba": 0.0, "error": "OpenCV not available"}
 
-    boxes = detect_faces(frame)
+    rejected = gate_frame(frame)
+    if rejected:
+        return dict({"name": "unknown", "proba": 0.0}, **rejected)
+    boxes = detect_faces(frame, roi=roi)
     if not boxes:
         return {"name": "unknown", "proba": 0.0, "error": "No faces detected"}
 
     # Take largest face
-    boxes = sorted(boxes, key=lambda b: (b[2]-b[0])*(b[3]-b[1]), reverse=True)
-    startX, startY, endX, endY = boxes[0]
-    face = frame[startY:endY, startX:endX]
-    (fH, fW) = face.shape[:2]
+    with timed("crop"):
+        boxes = sorted(boxes, key=lambda b: (b[2]-b[0])*(b[3]-b[1]), reverse=True)
+        startX, startY, endX, endY = boxes[0]
+        face = frame[startY:endY, startX:endX]
+        (fH, fW) = face.shape[:2]
 
     if fH < 20 or fW < 20:
         return {"name": "unknown", "proba": 0.0, "error": "Face too small"}
+    rejected = gate_face(frame, boxes[0])
+    if rejected:
+        return dict({"name": "unknown", "proba": 0.0, "box": [int(startX), int(startY), int(endX), int(endY)]}, **rejected)
 
-    if embedder is None or recognizer is None or le is None:
+    if not models_ready(embedder, recognizer, le):
         return {"name": "unknown", "proba": 0.0, "error": "Models not loaded"}
 
     try:
@@ -148,40 +371,270 @@ def recognize_from_frame(frame, embedder, recognizer, le, min_proba=0.5):
         if vec is None:
             return {"name": "unknown", "proba": 0.0, "error": "Could not extract embedding"}
 
-        preds = recognizer.predict_proba([vec])[0]
-        print('Face verification: prediction probabilities:', preds)
-        print('Face verification: label mapping:', le.classes_)
-        j = np.argmax(preds)
-        proba = float(preds[j])
-        name = le.classes_[j]
+        candidates = None
+        if isinstance(recognizer, FaceGallery):
+            name, proba = classify_embeddings([vec], recognizer, le)[0]
+            log.debug("Face verification: gallery match: %s %s", name, proba)
+            if top_k > 0:
+                candidates = [[n, s] for n, s in recognizer.search(vec, top_k)[0]]
+        else:
+            with timed("classify"):
+                preds = recognizer.predict_proba([vec])[0]
+            log.debug("Face verification: prediction probabilities: %s", preds)
+            log.debug("Face verification: label mapping: %s", le.classes_)
+            j = np.argmax(preds)
+            proba = float(preds[j])
+            name = le.classes_[j]
 
         if name == 'unknown' or proba < min_proba:
-            return {"name": "unknown", "proba": proba, "error": "Low confidence or unknown"}
-        return {"name": str(name), "proba": proba}
+            result = {"name": "unknown", "proba": proba, "error": "Low confidence or unknown"}
+        else:
+            result = {"name": str(name), "proba": proba}
+        if candidates is not None:
+            result["candidates"] = candidates
+        result["box"] = [int(startX), int(startY), int(endX), int(endY)]
+        return result
 
     except Exception as e:
         return {"name": "unknown", "proba": 0.0, "error": f"Recognition error: {str(e)}"}
 
-def recognize_from_image_b64(b64data, embedder, recognizer, le, min_proba=0.5):
-    """Process base64 image data for face recognition"""
+def verify_claim_from_frame(frame, embedder, gallery, claimed_id, roi=None):
+    """
+    1:1 verification: compare the largest face only against claimed_id's centroid.
+    Cost does not depend on how many users are enrolled.
+    Output: dict {name, proba, score, threshold, threshold_source, mode}
+    """
+    claimed_id = str(claimed_id)
+    result = {"name": "unknown", "proba": 0.0, "claimed_id": claimed_id, "mode": "1:1"}
     if not OPENCV_AVAILABLE:
-        return {"error": "OpenCV not available"}
+        return dict(result, error="OpenCV not available")
+    if embedder is None or gallery is None:
+        return dict(result, error="Models not loaded")
+    centroid = gallery.centroid(claimed_id)
+    if centroid is None:
+        return dict(result, error="Unknown account")
+
+    rejected = gate_frame(frame)
+    if rejected:
+        return dict(result, **rejected)
+    boxes = detect_faces(frame, roi=roi)
+    if not boxes:
+        return dict(result, error="No faces detected")
+    with timed("crop"):
+        startX, startY, endX, endY = max(boxes, key=lambda b: (b[2]-b[0])*(b[3]-b[1]))
+        face = frame[startY:endY, startX:endX]
+    if face.shape[0] < 20 or face.shape[1] < 20:
+        return dict(result, error="Face too small")
+    box = [int(startX), int(startY), int(endX), int(endY)]
+    rejected = gate_face(frame, box)
+    if rejected:
+        return dict(result, box=box, **rejected)
+
+    try:
+        with timed("embed"):
+            vec = extract_embeddings(embedder, [face])[0]
+    except Exception as e:
+        return dict(result, error=f"Recognition error: {str(e)}")
+    with timed("classify"):
+        score = float(np.dot(vec / max(np.linalg.norm(vec), 1e-12), centroid))
+        threshold = gallery.threshold_for(claimed_id)
+    result.update({
+        "box": box,
+        "proba": score,
+        "score": score,
+        "threshold": threshold,
+        "threshold_source": gallery.threshold_source(claimed_id),
+    })
+    if score < threshold:
+        result["error"] = "Face does not match account"
+    else:
+        result["name"] = claimed_id
+    return result
 
+def decode_image_bytes(data):
+    """Decode encoded JPEG/PNG bytes into a BGR frame without copying them. Returns (frame, error)."""
+    if not data:
+        return None, "no image"
+    with timed("imdecode"):
+        frame = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if frame is None:
+        return None, "invalid image"
+    return frame, None
+
+def decode_image_b64(b64data):
+    """Decode a base64 (or data URL) JPEG/PNG into a BGR frame. Returns (frame, error).
+
+    Raw bytes (a binary upload) skip the base64 step.
+    """
     import base64
+    if isinstance(b64data, (bytes, bytearray, memoryview)):
+        return decode_image_bytes(b64data)
     if not b64data:
-        return {"error":"no image"}
-    if b64data.startswith("data:"):
-        b64data = b64data.split(",",1)[1]
+        return None, "no image"
     try:
-        imgdata = base64.b64decode(b64data)
+        with timed("b64_decode"):
+            if b64data.startswith("data:"):
+                b64data = b64data.split(",",1)[1]
+            imgdata = base64.b64decode(b64data)
     except Exception as e:
-        return {"error":f"invalid base64: {e}"}
+        return None, f"invalid base64: {e}"
+    return decode_image_bytes(imgdata)
+
+def recognize_from_image_b64(b64data, embedder, recognizer, le, min_proba=0.5, claimed_id=None, gallery=None, roi=None):
+    """Process base64 image data (or raw image bytes) for face recognition
+
+    With claimed_id the frame is verified 1:1 against that user in gallery
+    instead of identified among everyone. roi is passed on to detect_faces.
+    """
+    if not OPENCV_AVAILABLE:
+        return {"error": "OpenCV not available"}
 
     try:
-        nparr = np.frombuffer(imgdata, np.uint8)
-        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        frame, error = decode_image_b64(b64data)
         if frame is None:
-            return {"error":"invalid image"}
-        return recognize_from_frame(frame, embedder, recognizer, le, min_proba=min_proba)
+            return {"error": error}
+        if claimed_id:
+            return verify_claim_from_frame(frame, embedder, gallery, claimed_id, roi=roi)
+        return recognize_from_frame(frame, embedder, recognizer, le, min_proba=min_proba, roi=roi)
     except Exception as e:
         return {"error": f"Image processing error: {str(e)}"}
+
+# Frames decoded/detected concurrently in a burst (OpenCV releases the GIL)
+BURST_WORKERS = 4
+# With early stopping, frames are handled this many at a time
+BURST_WAVE = 2
+# Most frames one burst may carry; every frame costs a decode and a detection
+BURST_MAX_FRAMES = int(os.environ.get("FACEATM_BURST_MAX_FRAMES", "10"))
+_burst_pool = ThreadPoolExecutor(max_workers=BURST_WORKERS, thread_name_prefix="burst")
+
+def _largest_face_b64(b64data, roi=None):
+    """Decode + detect for one burst frame: (face crop, box, rejection).
+
+    rejection is None for a usable face, otherwise a dict with "error" (and
+    "reason"/"quality" when the quality gate turned the frame away).
+    """
+    try:
+        frame, error = decode_image_b64(b64data)
+    except Exception as e:
+        return None, None, {"error": f"Image processing error: {str(e)}"}
+    if frame is None:
+        return None, None, {"error": error}
+    rejected = gate_frame(frame)
+    if rejected:
+        return None, None, rejected
+    boxes = detect_faces(frame, roi=roi)
+    if not boxes:
+        return None, None, {"error": "No faces detected"}
+    with timed("crop"):
+        x1, y1, x2, y2 = max(boxes, key=lambda b: (b[2]-b[0])*(b[3]-b[1]))
+        face = frame[y1:y2, x1:x2]
+    if x2 - x1 < 20 or y2 - y1 < 20:
+        return None, None, {"error": "Face too small"}
+    box = [int(x1), int(y1), int(x2), int(y2)]
+    rejected = gate_face(frame, box)
+    if rejected:
+        return None, box, rejected
+    return face, box, None
+
+def score_frames(vecs, recognizer, le, gallery, claimed_id, min_proba):
+    """Per-frame score rows over candidate classes, plus those classes and their thresholds."""
+    if claimed_id:
+        centroid = gallery.centroid(claimed_id)
+        vecs = vecs / np.maximum(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12)
+        return (vecs @ centroid)[:, None], [str(claimed_id)], np.array([gallery.threshold_for(claimed_id)])
+    if isinstance(recognizer, FaceGallery):
+        classes = [str(c) for c in recognizer.classes_]
+        return recognizer.similarities(vecs), classes, recognizer.class_thresholds()
+    classes = [str(c) for c in le.classes_]
+    thresholds = np.array([np.inf if c == "unknown" else min_proba for c in classes])
+    return recognizer.predict_proba(vecs), classes, thresholds
+
+def decide_frames(scores, thresholds, voting, min_votes):
+    """Aggregate per-frame score rows into (class index or None, score)."""
+    if not len(scores):
+        return None, 0.0
+    if voting == "vote":
+        # Each frame votes for its best class if it clears that class's threshold
+        best = scores.argmax(axis=1)
+        votes = np.bincount(best[scores[np.arange(len(best)), best] >= thresholds[best]],
+                            minlength=scores.shape[1])
+        j = int(votes.argmax())
+        score = float(scores[:, j].mean())
+        if votes[j] >= min_votes and votes[j] * 2 > len(scores):
+            return j, score
+        return None, score
+    mean = scores.mean(axis=0)
+    j = int(mean.argmax())
+    return (j if mean[j] >= thresholds[j] else None), float(mean[j])
+
+def recognize_burst_b64(images, embedder, recognizer, le, min_proba=0.5, claimed_id=None, gallery=None,
+                        voting="mean", early_stop=True, min_votes=2, roi=None):
+    """
+    Verify several frames of the same person in one call.
+
+    images are base64 strings or raw encoded image bytes.
+
+    Frames are decoded and detected in parallel and all crops of a wave go
+    through the embedder in one batch. voting="mean" averages the per-frame
+    scores, voting="vote" needs a majority of frames (at least min_votes)
+    to agree. With early_stop the burst is processed BURST_WAVE frames at a
+    time and stops as soon as the aggregate decision is reached; otherwise
+    every frame is embedded in a single batch.
+    Output: dict {name, proba, frames: [{index, name, score, box | error, reason?}], frames_used}
+    """
+    result = {"name": "unknown", "proba": 0.0, "voting": voting, "frames": [], "frames_used": 0}
+    if claimed_id:
+        result.update({"claimed_id": str(claimed_id), "mode": "1:1"})
+        if embedder is None or gallery is None:
+            return dict(result, error="Models not loaded")
+        if gallery.centroid(claimed_id) is None:
+            return dict(result, error="Unknown account")
+    elif not models_ready(embedder, recognizer, le):
+        return dict(result, error="Models not loaded")
+    if not images:
+        return dict(result, error="no image")
+    if len(images) > BURST_MAX_FRAMES:
+        return dict(result, error=f"At most {BURST_MAX_FRAMES} frames per burst")
+
+    wave = BURST_WAVE if early_stop else len(images)
+    all_scores = []
+    classes, thresholds = None, None
+    j, score = None, 0.0
+    for start in range(0, len(images), wave):
+        chunk = images[start:start + wave]
+        detected = list(_burst_pool.map(propagate(lambda b64: _largest_face_b64(b64, roi)), chunk))
+        faces = [face for face, _, _ in detected if face is not None]
+        rows = []
+        if faces:
+            with timed("embed"):
+                vecs = extract_embeddings(embedder, faces)
+            with timed("classify"):
+                rows, classes, thresholds = score_frames(vecs, recognizer, le, gallery, claimed_id, min_proba)
+        k = 0
+        for i, (face, box, rejected) in enumerate(detected, start=start):
+            if face is None:
+                result["frames"].append(dict({"index": i, "name": "unknown", "score": 0.0}, **rejected))
+                continue
+            row = rows[k]
+            k += 1
+            all_scores.append(row)
+            best = int(row.argmax())
+            name = classes[best] if row[best] >= thresholds[best] else "unknown"
+            result["frames"].append({"index": i, "name": name, "score": float(row[best]), "box": box})
+        result["frames_used"] = start + len(chunk)
+        if all_scores:
+            j, score = decide_frames(np.vstack(all_scores), thresholds, voting, min_votes)
+            if early_stop and j is not None:
+                break
+
+    result["proba"] = score
+    if j is None:
+        result["error"] = "No faces detected" if not all_scores else "Low confidence or unknown"
+        reasons = [f["reason"] for f in result["frames"] if f.get("reason")]
+        if not all_scores and reasons:
+            # Nothing usable: tell the client what to fix before the next burst
+            result["reason"] = max(set(reasons), key=reasons.count)
+            result["error"] = REASONS[result["reason"]]
+    else:
+        result["name"] = classes[j]
+    return result
@@ -0,0 +1,290 @@
+# gallery.py - centroid gallery matcher, an alternative to the SVC recognizer
+import os
+import pickle
+
+import numpy as np
+
+from face_index import build_index
+from embedding_store import ensure_store, load_names, open_store
+from model_store import current_model_dir
+
+GALLERY_FILE = "gallery.pickle"
+# The same gallery as one structured array, sorted by name, that every
+# gunicorn worker maps read-only instead of unpickling its own copy
+GALLERY_ARRAY_FILE = "gallery.npy"
+# Cosine similarity a probe needs to reach a user's centroid to be accepted.
+# nn4.small2.v1 embeddings of different people still score 0.8-0.9 against
+# each other. The value is the highest impostor similarity to a claimed
+# user's centroid among the 7 sample users (0.901), rounded up, and it
+# rejects 5 of their 40 genuine frames. Fitted on those same users, it says
+# little about new ones: set the same way from 6 users, the floor let no
+# claim by or for the 7th through (0 of 480); from 5, 15 of 2640 passed.
+DEFAULT_THRESHOLD = 0.91
+# Per-user thresholds follow the spread of the user's samples within these bounds;
+# the floor is the impostor-calibrated default, a wide spread never lowers it
+MIN_THRESHOLD = DEFAULT_THRESHOLD
+MAX_THRESHOLD = 0.95
+
+
+def normalize(vecs):
+    vecs = np.asarray(vecs, dtype=np.float32)
+    norms = np.linalg.norm(vecs, axis=-1, keepdims=True)
+    return vecs / np.maximum(norms, 1e-12)
+
+
+class FaceGallery:
+    """Per-user centroids of L2-normalized embeddings matched by cosine similarity.
+
+    Each user is stored as the running sum and count of their normalized
+    embeddings, so adding or removing a user never refits anything else.
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD):
+        self.threshold = threshold
+        self.sums = {}
+        self.counts = {}
+        self.thresholds = {}
+        self._matrix = None
+        self._names = None
+        self._index = None
+
+    def __len__(self):
+        return len(self.sums)
+
+    def __contains__(self, name):
+        return str(name) in self.sums
+
+    @property
+    def classes_(self):
+        return np.array(sorted(self.sums))
+
+    def add(self, name, vecs, spread=None):
+        """Add embeddings for `name`, creating the user if needed.
+
+        The user's threshold follows the spread of `spread` around the
+        centroid, by default of vecs. Pass every accepted sample when vecs
+        is a diverse subset of them: picking the most distant samples
+        makes the user look looser than they are.
+        """
+        name = str(name)
+        vecs = normalize(np.atleast_2d(vecs))
+        if len(vecs) == 0:
+            return
+        spread = vecs if spread is None or not len(spread) else normalize(np.atleast_2d(spread))
+        self.sums[name] = self.sums.get(name, 0) + vecs.sum(axis=0)
+        self.counts[name] = self.counts.get(name, 0) + len(vecs)
+        centroid = normalize(self.sums[name])
+        if max(self.counts[name], len(spread)) >= 2:
+            # Accept anything about as close as the user's own spread of samples
+            sims = spread @ centroid
+            self.thresholds[name] = float(np.clip(sims.mean() - 2 * sims.std(),
+                                                  MIN_THRESHOLD, MAX_THRESHOLD))
+        self._matrix = None
+
+    def remove(self, name):
+        name = str(name)
+        self.sums.pop(name, None)
+        self.counts.pop(name, None)
+        self.thresholds.pop(name, None)
+        self._matrix = None
+
+    def centroid(self, name):
+        name = str(name)
+        if name not in self.sums:
+            return None
+        return normalize(self.sums[name])
+
+    def threshold_for(self, name):
+        return self.thresholds.get(str(name), self.threshold)
+
+    def threshold_source(self, name):
+        return "user" if str(name) in self.thresholds else "default"
+
+    def class_thresholds(self):
+        """threshold_for() of every user, in classes_ order."""
+        return np.array([self.threshold_for(n) for n in self.classes_], dtype=np.float32)
+
+    def _centroids(self):
+        if self._matrix is None:
+            self._names = sorted(self.sums)
+            if self._names:
+                self._matrix = normalize(np.stack([self.sums[n] for n in self._names]))
+            else:
+                self._matrix = np.empty((0, 0), dtype=np.float32)
+            self._index = None
+        return self._names, self._matrix
+
+    def _search_index(self):
+        names, matrix = self._centroids()
+        if self._index is None:
+            self._index = build_index(matrix, np.arange(len(names)), names, normalized=True)
+        return self._index
+
+    def search(self, vecs, k=5):
+        """Top-k [(user_id, score), ...] per probe row, best first.
+
+        Large galleries go through an approximate IVF index (face_index.py).
+        """
+        if not self.sums:
+            return [[] for _ in range(len(np.atleast_2d(vecs)))]
+        return self._search_index().search(vecs, k)
+
+    def similarities(self, vecs):
+        """Cosine similarity of each probe to every centroid, columns in classes_ order."""
+        _, matrix = self._centroids()
+        return normalize(np.atleast_2d(vecs)) @ matrix.T
+
+    def match(self, vec):
+        """Return (name, score) of the closest user, name is None below that user's threshold."""
+        return self.match_batch(np.atleast_2d(vec))[0]
+
+    def match_batch(self, vecs):
+        """match() for every row of vecs."""
+        results = []
+        for hits in self.search(vecs, 1):
+            if not hits:
+                results.append((None, 0.0))
+                continue
+            name, score = hits[0]
+            if score < self.threshold_for(name):
+                results.append((None, score))
+            else:
+                results.append((name, score))
+        return results
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_matrix"] = None
+        state["_names"] = None
+        state["_index"] = None
+        return state
+
+    @classmethod
+    def from_embeddings(cls, vecs, names, threshold=DEFAULT_THRESHOLD, spread=None):
+        """Gallery of the given samples; spread maps users to the samples their threshold follows (see add)."""
+        gallery = cls(threshold)
+        vecs = np.asarray(vecs, dtype=np.float32)
+        names = np.asarray(names).astype(str)
+        spread = spread or {}
+        for name in np.unique(names):
+            gallery.add(name, vecs[names == name], spread.get(name))
+        return gallery
+
+
+class MappedGallery(FaceGallery):
+    """Read-only FaceGallery over a memory-mapped gallery.npy.
+
+    Rows hold a user's name, normalized centroid and own threshold (NaN for
+    the default) and are sorted by name, so a lookup is a binary search. The
+    pages are shared by every process mapping the file; only the search
+    index built on first use is private.
+    """
+
+    def __init__(self, path, threshold=DEFAULT_THRESHOLD):
+        super().__init__(threshold)
+        self.path = path
+        self.rows = np.load(path, mmap_mode="r")
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, name):
+        return self._row(name) is not None
+
+    @property
+    def classes_(self):
+        return self.rows["name"]
+
+    def _row(self, name):
+        names = self.rows["name"]
+        i = int(np.searchsorted(names, str(name)))
+        return i if i < len(names) and names[i] == str(name) else None
+
+    def add(self, *args, **kwargs):
+        raise TypeError("MappedGallery is read-only; update the FaceGallery and save_gallery() it")
+
+    def remove(self, name):
+        raise TypeError("MappedGallery is read-only; update the FaceGallery and save_gallery() it")
+
+    def centroid(self, name):
+        i = self._row(name)
+        return None if i is None else np.array(self.rows["centroid"][i])
+
+    def threshold_for(self, name):
+        i = self._row(name)
+        value = np.nan if i is None else float(self.rows["threshold"][i])
+        return self.threshold if np.isnan(value) else value
+
+    def threshold_source(self, name):
+        i = self._row(name)
+        return "default" if i is None or np.isnan(self.rows["threshold"][i]) else "user"
+
+    def class_thresholds(self):
+        thresholds = np.array(self.rows["threshold"])
+        thresholds[np.isnan(thresholds)] = self.threshold
+        return thresholds
+
+    def _centroids(self):
+        return self.rows["name"], self.rows["centroid"]
+
+    def _search_index(self):
+        if self._index is None:
+            names, matrix = self._centroids()
+            self._index = build_index(matrix, None, names, normalized=True)
+        return self._index
+
+    def search(self, vecs, k=5):
+        if not len(self.rows):
+            return [[] for _ in range(len(np.atleast_2d(vecs)))]
+        return self._search_index().search(vecs, k)
+
+    def __getstate__(self):
+        return {"path": self.path, "threshold": self.threshold}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["threshold"])
+
+
+def gallery_array(gallery):
+    """The gallery as the structured array stored in gallery.npy."""
+    names = sorted(gallery.sums)
+    width = max([len(n) for n in names] + [1])
+    rows = np.zeros(len(names), dtype=[("name", f"U{width}"), ("centroid", "f4", (128,)), ("threshold", "f4")])
+    for i, name in enumerate(names):
+        rows[i] = (name, gallery.centroid(name), gallery.thresholds.get(name, np.nan))
+    return rows
+
+
+def load_gallery(model_dir=None, mapped=False):
+    """The gallery of a model directory, or None.
+
+    mapped=True returns a read-only MappedGallery when gallery.npy exists.
+    """
+    model_dir = model_dir or current_model_dir()
+    array_path = os.path.join(model_dir, GALLERY_ARRAY_FILE)
+    if mapped and os.path.exists(array_path):
+        return MappedGallery(array_path)
+    path = os.path.join(model_dir, GALLERY_FILE)
+    if not os.path.exists(path):
+        # Models trained before the gallery existed still have their embeddings
+        if not ensure_store(model_dir):
+            return None
+        matrix, labels, meta = open_store(model_dir)
+        return FaceGallery.from_embeddings(matrix, load_names(labels, meta))
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def save_gallery(gallery, model_dir=None):
+    model_dir = model_dir or current_model_dir()
+    os.makedirs(model_dir, exist_ok=True)
+    path = os.path.join(model_dir, GALLERY_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(pickle.dumps(gallery))
+    os.replace(tmp_path, path)
+    # np.save would append ".npy" to a name not ending in it
+    array_path = os.path.join(model_dir, GALLERY_ARRAY_FILE)
+    tmp_path = array_path + ".tmp.npy"
+    np.save(tmp_path, gallery_array(gallery))
+    os.replace(tmp_path, array_path)
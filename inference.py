@@ -0,0 +1,173 @@
+# inference.py - shared embedder scheduling for concurrent requests
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import numpy as np
+
+# Collect crops from concurrent requests for up to this long...
+BATCH_WINDOW_MS = float(os.environ.get("FACEATM_BATCH_WINDOW_MS", "5"))
+# ...or until this many crops are waiting, then run one forward pass
+BATCH_MAX_ITEMS = int(os.environ.get("FACEATM_BATCH_MAX", "32"))
+# Route recognition through the scheduler (set FACEATM_BATCHING=1)
+BATCHING_ENABLED = os.environ.get("FACEATM_BATCHING", "0") == "1"
+# Independent cv2.dnn nets for request threads (0 = share a single net)
+EMBEDDER_POOL_SIZE = int(os.environ.get("FACEATM_EMBEDDER_POOL", "2"))
+
+
+class BatchScheduler:
+    """Micro-batches embedder calls from many request threads.
+
+    Requests submit their face crops and wait on a Future. A single worker
+    thread owns the cv2.dnn net: it takes the first waiting request, keeps
+    collecting for up to window_ms or max_items crops, runs them through
+    one batched forward pass and hands every request back its own rows.
+    Pass the scheduler wherever an embedder is expected;
+    face_utils.extract_embeddings routes through it.
+    """
+
+    def __init__(self, embedder, window_ms=BATCH_WINDOW_MS, max_items=BATCH_MAX_ITEMS):
+        self.embedder = embedder
+        self.window = window_ms / 1000.0
+        self.max_items = max(1, int(max_items))
+        self._queue = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "items": 0, "batches": 0, "max_queue_depth": 0}
+        # batch size (in crops) -> number of forward passes of that size
+        self._batch_sizes = {}
+        self._thread = threading.Thread(target=self._run, name="embed-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, faces):
+        """Queue crops for embedding; the Future resolves to an (N, 128) matrix."""
+        future = Future()
+        if not faces:
+            future.set_result(np.empty((0, 128), dtype=np.float32))
+            return future
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("BatchScheduler is closed")
+            self._stats["requests"] += 1
+            self._queue.put((list(faces), future))
+            self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], self._queue.qsize())
+        return future
+
+    def embed(self, faces, timeout=None):
+        return self.submit(faces).result(timeout)
+
+    def close(self):
+        """Stop accepting work; crops already queued are still embedded."""
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(None)
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["queue_depth"] = self._queue.qsize()
+            stats["batch_sizes"] = dict(sorted(self._batch_sizes.items()))
+        stats["mean_batch_size"] = stats["items"] / stats["batches"] if stats["batches"] else 0.0
+        return stats
+
+    def _collect(self, first):
+        batch = [first]
+        count = len(first[0])
+        deadline = time.monotonic() + self.window
+        while count < self.max_items:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)  # let the run loop see the shutdown
+                break
+            batch.append(item)
+            count += len(item[0])
+        return batch, count
+
+    def _run(self):
+        from face_utils import extract_embeddings
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch, count = self._collect(first)
+            faces = [face for item in batch for face in item[0]]
+            try:
+                vecs = extract_embeddings(self.embedder, faces, batch_size=max(count, 1))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            with self._lock:
+                self._stats["items"] += count
+                self._stats["batches"] += 1
+                self._batch_sizes[count] = self._batch_sizes.get(count, 0) + 1
+            i = 0
+            for item_faces, future in batch:
+                future.set_result(vecs[i:i + len(item_faces)])
+                i += len(item_faces)
+
+
+class EmbedderPool:
+    """A bounded set of cv2.dnn nets handed out to one thread at a time.
+
+    A cv2.dnn.Net keeps its input between setInput and forward, so two
+    request threads sharing one net can read each other's results. Each
+    checkout gets a net nobody else is using; at most `size` forward passes
+    run at once and further requests wait for a free net.
+
+    OpenCV's thread count is process-wide, so it is set once to
+    cpu_count // size, keeping size concurrent passes from oversubscribing
+    the CPU.
+    """
+
+    def __init__(self, factory, size=EMBEDDER_POOL_SIZE, first=None, threads_per_net=None):
+        import cv2
+        self.size = max(1, int(size))
+        if threads_per_net is None:
+            threads_per_net = max(1, (os.cpu_count() or 1) // self.size)
+        cv2.setNumThreads(threads_per_net)
+        self.threads_per_net = threads_per_net
+        self._nets = queue.LifoQueue()
+        nets = [first] if first is not None else []
+        while len(nets) < self.size:
+            nets.append(factory())
+        for net in nets:
+            self._nets.put(net)
+        self._lock = threading.Lock()
+        self._stats = {"checkouts": 0, "waits": 0}
+
+    @contextmanager
+    def checkout(self, timeout=None):
+        try:
+            net = self._nets.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                self._stats["waits"] += 1
+            net = self._nets.get(timeout=timeout)
+        with self._lock:
+            self._stats["checkouts"] += 1
+        try:
+            yield net
+        finally:
+            self._nets.put(net)
+
+    def embed(self, faces, batch_size=None):
+        from face_utils import EMBED_BATCH_SIZE, extract_embeddings
+        with self.checkout() as net:
+            return extract_embeddings(net, faces, batch_size or EMBED_BATCH_SIZE)
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update({"size": self.size, "idle": self._nets.qsize(), "threads_per_net": self.threads_per_net})
+        return stats
@@ -0,0 +1,241 @@
+# ledger.py - append-only transaction log with a per-user offset index
+#
+# transactions.csv is only ever appended to: one os.write() of one CSV line
+# on a descriptor opened with O_APPEND, so an append costs the same however
+# long the ledger is, and appends from several gunicorn workers never
+# interleave. fsync is batched: at most FSYNC_EVERY appends or FSYNC_MS
+# milliseconds of appends are lost if the machine (not just the process)
+# dies.
+#
+# The index maps each user to the byte offsets of their lines. It is kept
+# in memory, brought up to date by scanning only the bytes appended since
+# it was last updated (by this or any other process), and saved next to
+# the log as an .npz snapshot; a missing or stale snapshot is rebuilt from
+# the log itself. The snapshot records the log's inode and a digest of its
+# first bytes, so a log that was replaced (restored from a backup,
+# rewritten by hand) is never read through another log's offsets.
+import atexit
+import csv
+import hashlib
+import io
+import os
+import secrets
+import threading
+from array import array
+
+import numpy as np
+
+TXN_HEADER = "user_id,type,amount,timestamp\n"
+# fsync after this many appends...
+FSYNC_EVERY = int(os.environ.get("FACEATM_LEDGER_FSYNC_EVERY", "64"))
+# ...or this long after the first unsynced append
+FSYNC_MS = float(os.environ.get("FACEATM_LEDGER_FSYNC_MS", "100"))
+# Save the index snapshot once this many bytes (and a quarter of the log) are not covered by it
+SNAPSHOT_BYTES = 1 << 20
+# Bytes read per step while indexing the log
+SCAN_CHUNK = 1 << 20
+# Leading log bytes whose digest identifies the log in the snapshot
+HEAD_BYTES = 4096
+
+
+class TransactionLog:
+    """Appends to and reads per-user pages from one CSV transaction log."""
+
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or path + ".idx.npz"
+        self._lock = threading.Lock()
+        self._fd = None
+        self._fd_pid = None
+        self._unsynced = 0
+        self._timer = None
+        # user_id -> array of line offsets, oldest first
+        self._offsets = {}
+        self._indexed = 0  # log bytes covered by _offsets
+        self._saved = 0  # log bytes covered by the snapshot on disk
+        self._inode = None  # inode of the log _offsets point into
+        self._load_index()
+        atexit.register(self.close)
+
+    # -- appending --------------------------------------------------------
+
+    def _descriptor(self):
+        if self._fd is None or self._fd_pid != os.getpid():
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            size = os.fstat(fd).st_size
+            if size == 0:
+                os.write(fd, TXN_HEADER.encode())
+            elif _last_byte(self.path, size) != b"\n":
+                os.write(fd, b"\n")  # logs written by pandas may lack the final newline
+            self._fd, self._fd_pid = fd, os.getpid()
+        return self._fd
+
+    def append(self, user_id, txn_type, amount, timestamp):
+        buf = io.StringIO()
+        csv.writer(buf, lineterminator="\n").writerow([user_id, txn_type, amount, timestamp])
+        line = buf.getvalue().encode()
+        with self._lock:
+            os.write(self._descriptor(), line)
+            self._unsynced += 1
+            if self._unsynced >= FSYNC_EVERY:
+                self._sync_locked()
+            elif self._timer is None:
+                self._timer = threading.Timer(FSYNC_MS / 1000.0, self.sync)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def sync(self):
+        with self._lock:
+            self._sync_locked()
+
+    def _sync_locked(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._unsynced and self._fd is not None and self._fd_pid == os.getpid():
+            os.fsync(self._fd)
+        self._unsynced = 0
+
+    def close(self):
+        self.sync()
+        with self._lock:
+            if self._indexed > self._saved:
+                try:
+                    self._save_index()
+                except OSError:
+                    pass  # the next process rebuilds from the last snapshot
+
+    # -- reading ----------------------------------------------------------
+
+    def history(self, user_id, limit=None, cursor=None):
+        """(entries newest first, next cursor or None) for one user.
+
+        entries are (timestamp, type, amount) tuples; the cursor counts the
+        user's entries, and passing next_cursor back returns the page
+        before this one.
+        """
+        with self._lock:
+            self._catch_up()
+            offsets = self._offsets.get(str(user_id), ())
+            end = len(offsets) if cursor is None else max(0, min(int(cursor), len(offsets)))
+            start = 0 if limit is None else max(0, end - int(limit))
+            page = list(offsets[start:end])
+        entries = []
+        if page:
+            with open(self.path, "rb") as f:
+                for offset in reversed(page):
+                    f.seek(offset)
+                    row = next(csv.reader([f.readline().decode()]))
+                    entries.append((row[3], row[1], row[2]))
+        return entries, (start if start > 0 else None)
+
+    def count(self, user_id):
+        with self._lock:
+            self._catch_up()
+            return len(self._offsets.get(str(user_id), ()))
+
+    def _catch_up(self):
+        """Index whatever was appended since the last look, by any process."""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return
+        size = st.st_size
+        if size < self._indexed or (self._inode is not None and st.st_ino != self._inode):
+            # The log was replaced or truncated: start over
+            self._reset()
+        self._inode = st.st_ino
+        if size > self._indexed:
+            self._scan(self._indexed, size)
+            # Snapshots get rarer as the log grows, keeping their cost per append constant
+            if self._indexed - self._saved >= max(SNAPSHOT_BYTES, self._saved // 4):
+                self._save_index()
+
+    def _scan(self, start, end):
+        pos = start  # offset of the first byte not yet split into lines
+        carry = b""
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                data = f.read(min(SCAN_CHUNK, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                lines = (carry + data).split(b"\n")
+                carry = lines.pop()  # an unfinished line waits for the next chunk
+                for line in lines:
+                    if line.strip() and not (pos == 0 and line.startswith(b"user_id,")):
+                        user = line.split(b",", 1)[0]
+                        if user.startswith(b'"'):
+                            user = next(csv.reader([line.decode()]))[0].encode()
+                        self._offsets.setdefault(user.decode(), array("q")).append(pos)
+                    pos += len(line) + 1
+        # A line still being written is indexed once its newline is there
+        self._indexed = pos
+
+    # -- index snapshot ---------------------------------------------------
+
+    def _load_index(self):
+        try:
+            with np.load(self.index_path, allow_pickle=False) as data:
+                size = int(data["size"])
+                inode, head = int(data["inode"]), str(data["head"])
+                users, starts, offsets = data["users"], data["starts"], data["offsets"]
+            st = os.stat(self.path)
+            # Another log (new inode, or rewritten in place) than the one the snapshot indexed
+            if st.st_size < size or st.st_ino != inode or _head_digest(self.path, size) != head:
+                return self._reset()
+            self._offsets = {str(u): array("q", offsets[starts[i]:starts[i + 1]].tobytes())
+                             for i, u in enumerate(users)}
+        except Exception:
+            # Any unreadable snapshot (truncated zip, missing or mangled arrays) is rebuilt from the log
+            return self._reset()
+        self._indexed = self._saved = size
+        self._inode = inode
+
+    def _reset(self):
+        self._offsets, self._indexed, self._saved, self._inode = {}, 0, 0, None
+
+    def rebuild(self):
+        """Drop the index and re-create it from the log."""
+        with self._lock:
+            self._reset()
+            self._catch_up()
+            self._save_index()
+
+    def _save_index(self):
+        users = sorted(self._offsets)
+        lengths = [len(self._offsets[u]) for u in users]
+        starts = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        offsets = np.frombuffer(b"".join(self._offsets[u].tobytes() for u in users), dtype=np.int64)
+        inode = self._inode if self._inode is not None else os.stat(self.path).st_ino
+        head = _head_digest(self.path, self._indexed)
+        # Unique per writer: workers saving at the same time never write into one file
+        tmp_path = f"{self.index_path}.{os.getpid()}.{secrets.token_hex(4)}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez(f, size=np.int64(self._indexed), inode=np.int64(inode), head=np.array(head),
+                         users=np.array(users, dtype=str), starts=starts, offsets=offsets)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.index_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        self._saved = self._indexed
+
+
+def _head_digest(path, size):
+    """sha1 of the first min(size, HEAD_BYTES) bytes of the log."""
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read(min(size, HEAD_BYTES))).hexdigest()
+
+
+def _last_byte(path, size):
+    with open(path, "rb") as f:
+        f.seek(size - 1)
+        return f.read(1)
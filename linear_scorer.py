@@ -0,0 +1,125 @@
+# linear_scorer.py - the linear SVC recognizer as plain NumPy arrays
+#
+# train.py fits sklearn's SVC(kernel="linear", probability=True), which is
+# one-vs-one: one hyperplane per pair of classes, each with Platt sigmoid
+# parameters, and class probabilities coupled from the pairwise ones (Wu,
+# Lin & Weng, the method libsvm uses). export_svc() saves exactly those
+# arrays to an .npz; LinearScorer computes predict_proba() for a whole
+# batch of probes with a few matrix operations and one batched solve, so
+# serving processes load the recognizer without pickle or sklearn.
+#
+# The probabilities are the exact optimum of libsvm's coupling problem,
+# while sklearn stops libsvm's iterative solver at a tolerance: they agree
+# to about 2e-3 with more than two classes and 1e-2 with two, and a probe
+# scored within that of a tie can get the other argmax
+# (tests/test_linear_scorer.py).
+import os
+
+import numpy as np
+
+SCORER_FILE = "recognizer.npz"
+# libsvm clips pairwise probabilities to [MIN_PROB, 1 - MIN_PROB]
+MIN_PROB = 1e-7
+
+
+def export_svc(recognizer, le, path):
+    """Save a fitted linear SVC (with probability=True) and its LabelEncoder to path."""
+    if recognizer.kernel != "linear" or not hasattr(recognizer, "probA_") or not len(recognizer.probA_):
+        raise ValueError("Only linear SVCs fitted with probability=True can be exported")
+    weights = np.asarray(recognizer.coef_, dtype=np.float32)
+    bias = np.asarray(recognizer.intercept_, dtype=np.float64)
+    if len(recognizer.classes_) == 2:
+        # sklearn flips the sign of a binary SVC; pairs here follow libsvm (positive -> first class)
+        weights, bias = -weights, -bias
+    labels = le.classes_[recognizer.classes_]
+    tmp_path = path + ".tmp.npz"  # np.savez appends .npz to other names
+    np.savez(tmp_path, weights=weights, bias=bias, prob_a=np.asarray(recognizer.probA_, dtype=np.float64),
+             prob_b=np.asarray(recognizer.probB_, dtype=np.float64), classes=np.asarray(labels).astype(str))
+    os.replace(tmp_path, path)
+
+
+class LinearScorer:
+    """predict_proba() of an exported linear SVC, with the labels it was trained on.
+
+    classes_ holds the user ids, so the scorer also stands in for the
+    LabelEncoder wherever face_utils reads le.classes_.
+    """
+
+    def __init__(self, weights, bias, prob_a, prob_b, classes):
+        self.weights = weights
+        self.bias = bias
+        self.prob_a = prob_a
+        self.prob_b = prob_b
+        self.classes_ = classes
+        k = len(classes)
+        # Pair p compares classes first[p] < second[p], in libsvm's order
+        self.first, self.second = np.triu_indices(k, 1)
+        if len(self.first) != len(weights):
+            raise ValueError(f"{len(weights)} hyperplanes for {k} classes")
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["weights"], data["bias"], data["prob_a"], data["prob_b"], data["classes"])
+
+    def decision_function(self, vecs):
+        """One-vs-one decision values, (n, n_pairs)."""
+        vecs = np.atleast_2d(np.asarray(vecs, dtype=np.float32))
+        return vecs @ self.weights.T + self.bias
+
+    def pairwise_proba(self, vecs):
+        """r[n, i, j]: probability of class i over class j for each probe."""
+        f = self.decision_function(vecs) * self.prob_a + self.prob_b
+        pair = np.clip(1.0 / (1.0 + np.exp(np.clip(f, -500, 500))), MIN_PROB, 1 - MIN_PROB)
+        r = np.zeros((len(pair), len(self.classes_), len(self.classes_)))
+        r[:, self.first, self.second] = pair
+        r[:, self.second, self.first] = 1 - pair
+        return r
+
+    def predict_proba(self, vecs):
+        r = self.pairwise_proba(vecs)
+        if len(self.classes_) == 2:
+            # With two classes the coupling optimum is the pairwise probability itself,
+            # as upstream libsvm returns it. sklearn's copy still iterates toward it from
+            # (0.5, 0.5) and stops up to ~5e-3 short.
+            return np.stack([r[:, 0, 1], r[:, 1, 0]], axis=1)
+        return _couple(r)
+
+
+def _couple(r):
+    """Class probabilities from a batch of pairwise probability matrices.
+
+    libsvm's multiclass_probability() minimizes
+    sum_i sum_j!=i (r[j,i] p[i] - r[i,j] p[j])^2 subject to sum(p) = 1 by
+    coordinate descent, stopping once the optimality error is below
+    0.005 / k. Here the same quadratic problem is solved exactly, one
+    (k+1)x(k+1) KKT system per probe in a single batched solve, so the
+    probabilities match sklearn's to within that stopping tolerance.
+    """
+    n, k, _ = r.shape
+    kkt = np.zeros((n, k + 1, k + 1))
+    q = kkt[:, :k, :k]
+    q[...] = -r.transpose(0, 2, 1) * r
+    idx = np.arange(k)
+    q[:, idx, idx] = (r ** 2).sum(axis=1) - r[:, idx, idx] ** 2
+    kkt[:, k, :k] = 1
+    kkt[:, :k, k] = 1
+    rhs = np.zeros((n, k + 1, 1))
+    rhs[:, k] = 1
+    p = np.linalg.solve(kkt, rhs)[:, :k, 0]
+    # The exact optimum can dip a hair below zero where libsvm's iterates cannot
+    p = np.clip(p, 0, None)
+    return p / p.sum(axis=1, keepdims=True)
+
+if __name__ == "__main__":
+    # Export the SVC of an existing model version: python linear_scorer.py [model_dir]
+    import pickle
+    import sys
+    from model_store import current_model_dir
+    model_dir = sys.argv[1] if len(sys.argv) > 1 else current_model_dir()
+    with open(os.path.join(model_dir, "recognizer.pickle"), "rb") as f:
+        recognizer = pickle.load(f)
+    with open(os.path.join(model_dir, "le.pickle"), "rb") as f:
+        le = pickle.load(f)
+    export_svc(recognizer, le, os.path.join(model_dir, SCORER_FILE))
+    print(f"✅ Exported {len(le.classes_)} classes to {os.path.join(model_dir, SCORER_FILE)}")
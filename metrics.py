@@ -0,0 +1,121 @@
+# metrics.py - per-stage latency histograms in the Prometheus text format
+#
+# Code under measurement wraps a stage in `with timed("detect"):`. Every
+# observation goes into a process-wide histogram (served by /metrics) and,
+# between start_request() and end_request(), into the current request's
+# list of stage timings (used for the optional Server-Timing header).
+# Each gunicorn worker keeps its own histograms.
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the latency buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Add a Server-Timing header with the stage durations to every response
+TIMING_HEADER = os.environ.get("FACEATM_TIMING_HEADER", "0") == "1"
+
+
+class Histogram:
+    """A Prometheus histogram with a single label."""
+
+    def __init__(self, name, help_text, label, buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # label value -> [per-bucket counts (last one is +Inf), sum, count]
+        self._series = {}
+
+    def observe(self, value, seconds):
+        with self._lock:
+            series = self._series.get(value)
+            if series is None:
+                series = self._series[value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            i = 0
+            while i < len(self.buckets) and seconds > self.buckets[i]:
+                i += 1
+            series[0][i] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {v: (list(s[0]), s[1], s[2]) for v, s in self._series.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for value, (counts, total, count) in sorted(self.snapshot().items()):
+            label = f'{self.label}="{_escape(value)}"'
+            cumulative = 0
+            for bound, n in zip(self.buckets + ("+Inf",), counts):
+                cumulative += n
+                le = bound if isinstance(bound, str) else repr(float(bound))
+                lines.append(f'{self.name}_bucket{{{label},le="{le}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label}}} {total!r}")
+            lines.append(f"{self.name}_count{{{label}}} {count}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+STAGES = Histogram("faceatm_stage_seconds", "Time spent in each recognition or ledger stage.", "stage")
+REQUESTS = Histogram("faceatm_request_seconds", "Request latency per endpoint.", "endpoint")
+
+_local = threading.local()
+
+
+def observe(stage, seconds):
+    STAGES.observe(stage, seconds)
+    timings = getattr(_local, "timings", None)
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def start_request():
+    _local.timings = []
+
+
+def end_request():
+    """The (stage, seconds) pairs recorded since start_request()."""
+    timings = getattr(_local, "timings", None) or []
+    _local.timings = None
+    return timings
+
+
+def propagate(fn):
+    """Wrap fn so stages it times on another thread count toward this request."""
+    timings = getattr(_local, "timings", None)
+
+    def run(*args, **kwargs):
+        saved = getattr(_local, "timings", None)
+        _local.timings = timings
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.timings = saved
+    return run
+
+
+def server_timing(timings):
+    """Server-Timing header value; repeated stages are summed, durations in ms."""
+    totals = {}
+    for stage, seconds in timings:
+        totals[stage] = totals.get(stage, 0.0) + seconds
+    return ", ".join(f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in totals.items())
+
+
+def render():
+    return "\n".join(STAGES.render() + REQUESTS.render()) + "\n"
@@ -0,0 +1,175 @@
+# model_store.py - versioned model directories with an atomic "current" pointer
+#
+# Every publish also increments a generation counter kept in a small file
+# that each process maps into memory, so a worker can tell on every request
+# (with a plain memory read) whether the live artifacts changed under it.
+import mmap
+import os
+import pickle
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: publishes are not serialized across processes
+    fcntl = None
+
+OUTPUT_DIR = "output"
+MODELS_DIR = os.path.join(OUTPUT_DIR, "models")
+# Holds the name of the live directory under MODELS_DIR
+CURRENT_FILE = os.path.join(OUTPUT_DIR, "CURRENT")
+# Published versions kept on disk besides the live one
+KEEP_VERSIONS = 3
+# 8-byte little-endian generation counter, shared through mmap
+GENERATION_FILE = os.path.join(OUTPUT_DIR, "GENERATION")
+# Out-of-band array buffers of save_shared() pickles are aligned to this many bytes
+BUFFER_ALIGN = 64
+
+_generation_map = None
+
+
+def current_model_dir():
+    """Directory with the live recognizer artifacts.
+
+    Falls back to output/ itself for models trained before versioning.
+    """
+    try:
+        with open(CURRENT_FILE, "r", encoding="utf-8") as f:
+            name = f.read().strip()
+    except OSError:
+        return OUTPUT_DIR
+    path = os.path.join(MODELS_DIR, name)
+    return path if name and os.path.isdir(path) else OUTPUT_DIR
+
+
+def new_version_dir():
+    """Create an empty, not yet published version directory."""
+    name = time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:6]
+    path = os.path.join(MODELS_DIR, name)
+    os.makedirs(path)
+    return path
+
+
+def publish(version_dir):
+    """Point CURRENT at version_dir; readers see either the old or the new version."""
+    name = os.path.basename(os.path.normpath(version_dir))
+    with _publish_lock():
+        tmp_path = CURRENT_FILE + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(name)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, CURRENT_FILE)
+        _increment_generation()
+    prune_versions(keep=name)
+
+
+def _counter():
+    global _generation_map
+    if _generation_map is None:
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        fd = os.open(GENERATION_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < 8:
+                os.ftruncate(fd, 8)  # zero filled: generation 0
+            _generation_map = mmap.mmap(fd, 8)
+        finally:
+            os.close(fd)
+    return _generation_map
+
+
+def generation():
+    """Generation of the live artifacts; changes with every publish or in-place update."""
+    return int.from_bytes(_counter()[:8], "little")
+
+
+def _increment_generation():
+    m = _counter()
+    gen = int.from_bytes(m[:8], "little") + 1
+    m[:8] = gen.to_bytes(8, "little")
+    m.flush()
+    return gen
+
+
+def bump_generation():
+    """Announce an in-place change to the live directory (e.g. enrolling one user)."""
+    with _publish_lock():
+        return _increment_generation()
+
+
+@contextmanager
+def _publish_lock():
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    with open(GENERATION_FILE + ".lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def training_lock():
+    """Held for a whole rebuild or gallery enrollment, so gunicorn workers never change the model at the same time."""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    with open(os.path.join(OUTPUT_DIR, "TRAIN.lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def save_shared(obj, path):
+    """Pickle obj with its array buffers out of band in path + ".buf", for load_shared()."""
+    buffers = []
+    data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    layout = []
+    with open(path + ".buf.tmp", "wb") as f:
+        for buf in buffers:
+            raw = buf.raw()
+            f.write(b"\0" * (-f.tell() % BUFFER_ALIGN))
+            layout.append((f.tell(), raw.nbytes))
+            f.write(raw)
+        f.flush()
+        os.fsync(f.fileno())
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump({"layout": layout, "pickle": data}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".buf.tmp", path + ".buf")
+    os.replace(path + ".tmp", path)
+
+
+def load_shared(path):
+    """Unpickle a save_shared() file with its arrays backed by a mapping of the .buf file.
+
+    The mapping is copy-on-write: pages come from the page cache, shared by
+    every process that loads the same file, and are only copied if written.
+    """
+    with open(path, "rb") as f:
+        header = pickle.load(f)
+    if not header["layout"]:
+        return pickle.loads(header["pickle"])
+    with open(path + ".buf", "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:  # only empty arrays; mmap refuses empty files
+            view = memoryview(bytearray())
+        else:
+            view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+    return pickle.loads(header["pickle"], buffers=[view[off:off + n] for off, n in header["layout"]])
+
+
+def prune_versions(keep=None):
+    if not os.path.isdir(MODELS_DIR):
+        return
+    names = sorted(n for n in os.listdir(MODELS_DIR) if n != keep)
+    for name in names[:max(0, len(names) - KEEP_VERSIONS)]:
+        shutil.rmtree(os.path.join(MODELS_DIR, name), ignore_errors=True)
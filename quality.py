@@ -0,0 +1,109 @@
+# quality.py - cheap frame / face quality checks run before the embedder
+#
+# Blurred, dark or overexposed frames almost always end up "Low confidence"
+# after the full detect -> embed -> classify pass. These checks cost a
+# fraction of a millisecond and let the client re-capture straight away.
+# Every check returns (reason, measures): reason is None for a usable frame,
+# otherwise one of the REASONS codes.
+import os
+
+import cv2
+import numpy as np
+
+# Set FACEATM_QUALITY_GATE=0 to send every frame to the embedder
+QUALITY_GATE_ENABLED = os.environ.get("FACEATM_QUALITY_GATE", "1") == "1"
+# Mean gray level (0-255) bounds, for the whole frame and for the face crop
+FRAME_MIN_BRIGHTNESS = float(os.environ.get("FACEATM_QUALITY_FRAME_MIN_BRIGHTNESS", "20"))
+FRAME_MAX_BRIGHTNESS = float(os.environ.get("FACEATM_QUALITY_FRAME_MAX_BRIGHTNESS", "235"))
+FACE_MIN_BRIGHTNESS = float(os.environ.get("FACEATM_QUALITY_FACE_MIN_BRIGHTNESS", "40"))
+FACE_MAX_BRIGHTNESS = float(os.environ.get("FACEATM_QUALITY_FACE_MAX_BRIGHTNESS", "220"))
+# Largest fraction of the frame crushed to black (< 16) or clipped to white (> 239)
+MAX_CLIPPED = float(os.environ.get("FACEATM_QUALITY_MAX_CLIPPED", "0.5"))
+# Variance of the Laplacian of the face crop scaled to SHARPNESS_SIDE px;
+# dataset faces measure 34-500, a 9x9 Gaussian or 15 px motion blur about 7-80
+MIN_SHARPNESS = float(os.environ.get("FACEATM_QUALITY_MIN_SHARPNESS", "25"))
+SHARPNESS_SIDE = 128
+# Smallest face side in frame pixels
+MIN_FACE_SIDE = int(os.environ.get("FACEATM_QUALITY_MIN_FACE", "40"))
+# Largest distance of the face centre from the frame centre, per axis, as a fraction of the frame
+MAX_CENTER_OFFSET = float(os.environ.get("FACEATM_QUALITY_MAX_OFFSET", "0.35"))
+# Frame statistics are taken on a copy this wide
+STATS_WIDTH = 160
+
+REASONS = {
+    "too_dark": "Frame too dark",
+    "overexposed": "Frame overexposed",
+    "face_too_small": "Face too small, move closer",
+    "face_cut_off": "Face cut off by the frame edge",
+    "face_off_center": "Face not centered",
+    "face_too_dark": "Face too dark",
+    "face_overexposed": "Face overexposed",
+    "blurry": "Frame too blurry, hold still",
+}
+
+
+def _gray(image, width=None):
+    if width and image.shape[1] > width:
+        height = max(1, int(round(image.shape[0] * width / image.shape[1])))
+        image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+
+
+def check_frame(frame):
+    """Whole-frame exposure, checked before detection."""
+    gray = _gray(frame, STATS_WIDTH)
+    hist = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel() / gray.size
+    measures = {
+        "brightness": float(np.dot(hist, np.arange(256))),
+        "dark_fraction": float(hist[:16].sum()),
+        "bright_fraction": float(hist[240:].sum()),
+    }
+    if measures["brightness"] < FRAME_MIN_BRIGHTNESS or measures["dark_fraction"] > MAX_CLIPPED:
+        return "too_dark", measures
+    if measures["brightness"] > FRAME_MAX_BRIGHTNESS or measures["bright_fraction"] > MAX_CLIPPED:
+        return "overexposed", measures
+    return None, measures
+
+
+def check_face(frame, box):
+    """Face size, position, exposure and sharpness, checked before the embedder."""
+    (h, w) = frame.shape[:2]
+    x1, y1, x2, y2 = box
+    measures = {
+        "face_side": int(min(x2 - x1, y2 - y1)),
+        "center_offset": float(max(abs((x1 + x2) / 2.0 / w - 0.5), abs((y1 + y2) / 2.0 / h - 0.5))),
+    }
+    if measures["face_side"] < MIN_FACE_SIDE:
+        return "face_too_small", measures
+    if x1 <= 0 or y1 <= 0 or x2 >= w or y2 >= h:
+        return "face_cut_off", measures
+    if measures["center_offset"] > MAX_CENTER_OFFSET:
+        return "face_off_center", measures
+    face = cv2.resize(_gray(frame[y1:y2, x1:x2]), (SHARPNESS_SIDE, SHARPNESS_SIDE), interpolation=cv2.INTER_AREA)
+    measures["face_brightness"] = float(face.mean())
+    measures["sharpness"] = float(cv2.Laplacian(face, cv2.CV_64F).var())
+    if measures["face_brightness"] < FACE_MIN_BRIGHTNESS:
+        return "face_too_dark", measures
+    if measures["face_brightness"] > FACE_MAX_BRIGHTNESS:
+        return "face_overexposed", measures
+    if measures["sharpness"] < MIN_SHARPNESS:
+        return "blurry", measures
+    return None, measures
+
+
+def face_score(face):
+    """0-1 usefulness of an accepted face crop as an enrollment sample.
+
+    Sharpness counts up to four times MIN_SHARPNESS, exposure by how far the
+    mean gray level is from mid-gray; enrollment prefers high scores when
+    two samples add equally new views.
+    """
+    gray = cv2.resize(_gray(face), (SHARPNESS_SIDE, SHARPNESS_SIDE), interpolation=cv2.INTER_AREA)
+    sharpness = min(1.0, cv2.Laplacian(gray, cv2.CV_64F).var() / (4 * MIN_SHARPNESS))
+    exposure = 1.0 - min(1.0, abs(float(gray.mean()) - 128.0) / 128.0)
+    return float(sharpness * exposure)
+
+
+def rejection(reason, measures):
+    """Fields added to a recognition result for a frame the gate turned away."""
+    return {"error": REASONS[reason], "reason": reason, "quality": measures}
@@ -1,4 +1,5 @@
 import os
+import time
 from typing import Dict, List
 import warnings
 
@@ -25,10 +26,10 @@ from sklearn.decomposition import PCA
 from sklearn.manifold import TSNE
 from sklearn.calibration import calibration_curve
 
+from embedding_store import ensure_store, load_names, open_store
+
 
 REPORTS_DIR = "reports"
-OUTPUT_DIR = "output"
-EMBEDDINGS_PKL = os.path.join(OUTPUT_DIR, "embeddings.pickle")
 
 
 def ensure_reports_dir() -> None:
@@ -43,16 +44,12 @@ def save_fig(path: str, tight: bool = True) -> None:
 
 
 def load_embeddings():
-    if not os.path.exists(EMBEDDINGS_PKL):
+    if not ensure_store():
         return None, None
-    import pickle
-    with open(EMBEDDINGS_PKL, "rb") as f:
-        data = pickle.load(f)
-    X = np.array(data.get("embeddings", []))
-    y_names = np.array(data.get("names", []))
-    if X.size == 0 or y_names.size == 0:
+    X, labels, meta = open_store()
+    if X.size == 0:
         return None, None
-    return X, y_names
+    return X, load_names(labels, meta)
 
 
 def evaluate_model_with_cv(X: np.ndarray, y_names: np.ndarray) -> Dict[str, float]:
@@ -326,6 +323,139 @@ def plot_calibration_from_embeddings(X: np.ndarray, y_names: np.ndarray) -> Dict
     return stats
 
 
+def compare_gallery_with_svc(X: np.ndarray, y_names: np.ndarray) -> Dict[str, float]:
+    """Stratified CV accuracy of the SVC against the centroid gallery on the same folds."""
+    from gallery import FaceGallery
+
+    stats: Dict[str, float] = {}
+    label_encoder = LabelEncoder()
+    y = label_encoder.fit_transform(y_names)
+    _, class_counts = np.unique(y, return_counts=True)
+    if len(class_counts) < 2 or class_counts.min() < 2:
+        return stats
+
+    cv = StratifiedKFold(n_splits=min(5, class_counts.min()), shuffle=True, random_state=42)
+    clf = SVC(C=1.0, kernel="linear", probability=True, random_state=42)
+
+    svc_top1 = svc_correct = svc_accepted = 0
+    gal_top1 = gal_correct = gal_accepted = 0
+    svc_fit_s = gal_fit_s = 0.0
+    for train_idx, test_idx in cv.split(X, y):
+        start = time.perf_counter()
+        clf.fit(X[train_idx], y[train_idx])
+        svc_fit_s += time.perf_counter() - start
+        proba = clf.predict_proba(X[test_idx])
+        pred = proba.argmax(axis=1)
+        ok = proba.max(axis=1) >= 0.5
+        svc_top1 += int(np.sum(pred == y[test_idx]))
+        svc_correct += int(np.sum(ok & (pred == y[test_idx])))
+        svc_accepted += int(np.sum(ok))
+
+        start = time.perf_counter()
+        gallery = FaceGallery.from_embeddings(X[train_idx], y_names[train_idx])
+        gal_fit_s += time.perf_counter() - start
+        sims = gallery.similarities(X[test_idx])
+        gal_top1 += int(np.sum(gallery.classes_[sims.argmax(axis=1)] == y_names[test_idx]))
+        for (name, _), true_name in zip(gallery.match_batch(X[test_idx]), y_names[test_idx]):
+            gal_accepted += int(name is not None)
+            gal_correct += int(name == true_name)
+
+    n = len(y)
+    stats["svc_top1_accuracy"] = svc_top1 / n
+    stats["svc_accuracy"] = svc_correct / n
+    stats["svc_accept_rate"] = svc_accepted / n
+    stats["svc_fit_seconds"] = round(svc_fit_s, 4)
+    stats["gallery_top1_accuracy"] = gal_top1 / n
+    stats["gallery_accuracy"] = gal_correct / n
+    stats["gallery_accept_rate"] = gal_accepted / n
+    stats["gallery_fit_seconds"] = round(gal_fit_s, 4)
+    return stats
+
+
+def compare_enrollment_budgets(X: np.ndarray, y_names: np.ndarray) -> Dict[str, float]:
+    """Accuracy, impostor acceptance and gallery size when every user keeps at most K training samples.
+
+    Per CV fold, each user's training samples are cut to K by k-center
+    greedy selection (selection.py) and, as a baseline, by a random draw;
+    the SVC and the centroid gallery are refit on what is left and scored
+    on the held-out fold. The gallery thresholds follow all of a user's
+    training samples, as in train.py. Its false accept rate is the share
+    of 1:1 claims of a held-out sample for another user's account that
+    reach that user's threshold.
+    """
+    from gallery import FaceGallery
+    from selection import select_per_user
+
+    stats: Dict[str, float] = {}
+    label_encoder = LabelEncoder()
+    y = label_encoder.fit_transform(y_names)
+    _, class_counts = np.unique(y, return_counts=True)
+    if len(class_counts) < 2 or class_counts.min() < 2:
+        return stats
+
+    cv = StratifiedKFold(n_splits=min(5, class_counts.min()), shuffle=True, random_state=42)
+    folds = list(cv.split(X, y))
+    largest = max(int(np.bincount(y[train_idx]).max()) for train_idx, _ in folds)
+    budgets = sorted({k for k in (1, 2, 3, 5, 8, 10, 15, 20) if k < largest} | {largest})
+    rng = np.random.default_rng(42)
+
+    def random_per_user(rows, k):
+        keep = [rng.choice(rows[y[rows] == c], min(k, int(np.sum(y[rows] == c))), replace=False)
+                for c in np.unique(y[rows])]
+        return np.sort(np.concatenate(keep))
+
+    curves: Dict[str, List[float]] = {"diverse_svc": [], "diverse_gallery": [], "random_svc": [], "random_gallery": []}
+    far_curves: Dict[str, List[float]] = {"diverse_gallery": [], "random_gallery": []}
+    sizes: List[float] = []
+    for k in budgets:
+        correct = {name: 0 for name in curves}
+        false_accepts = {name: 0 for name in far_curves}
+        claims = 0
+        kept = 0
+        for train_idx, test_idx in folds:
+            spread = {name: X[train_idx][y_names[train_idx] == name] for name in np.unique(y_names[train_idx])}
+            chosen = {
+                "diverse": train_idx[select_per_user(X[train_idx], y_names[train_idx], k)],
+                "random": random_per_user(train_idx, k),
+            }
+            kept += len(chosen["diverse"])
+            for strategy, rows in chosen.items():
+                # Without probabilities: Platt scaling cannot be fit on one sample per class
+                clf = SVC(C=1.0, kernel="linear", random_state=42).fit(X[rows], y[rows])
+                correct[f"{strategy}_svc"] += int(np.sum(clf.predict(X[test_idx]) == y[test_idx]))
+                gallery = FaceGallery.from_embeddings(X[rows], y_names[rows], spread=spread)
+                sims = gallery.similarities(X[test_idx])
+                correct[f"{strategy}_gallery"] += int(np.sum(gallery.classes_[sims.argmax(axis=1)] == y_names[test_idx]))
+                impostor = gallery.classes_[None, :] != y_names[test_idx][:, None]
+                false_accepts[f"{strategy}_gallery"] += int(np.sum((sims >= gallery.class_thresholds()) & impostor))
+            claims += int(np.sum(impostor))
+        for name in curves:
+            curves[name].append(correct[name] / len(y))
+            stats[f"k{k:02d}_{name}_accuracy"] = round(correct[name] / len(y), 4)
+        for name in far_curves:
+            far_curves[name].append(false_accepts[name] / max(claims, 1))
+            stats[f"k{k:02d}_{name}_far"] = round(false_accepts[name] / max(claims, 1), 4)
+        sizes.append(kept / len(folds))
+        stats[f"k{k:02d}_gallery_rows"] = round(kept / len(folds), 1)
+
+    fig, ax = plt.subplots(figsize=(7, 5))
+    for name, values in curves.items():
+        ax.plot(budgets, values, marker="o", linestyle="-" if name.startswith("diverse") else "--",
+                label=name.replace("_", " "))
+    for name, values in far_curves.items():
+        ax.plot(budgets, values, marker="x", linestyle=":", label=name.replace("_", " ") + " FAR")
+    ax.set_xlabel("Samples kept per user (K)")
+    ax.set_ylabel("Held-out accuracy / false accept rate")
+    ax.set_ylim(0, 1.05)
+    ax2 = ax.twinx()
+    ax2.bar(budgets, sizes, alpha=0.15, color="gray", width=0.6)
+    ax2.set_ylabel("Training samples (gallery rows)")
+    ax.legend(loc="lower right")
+    plt.title("Accuracy, FAR and gallery size vs enrollment budget K")
+    save_fig(os.path.join(REPORTS_DIR, "enrollment_budget.png"))
+    return stats
+
+
 def write_summary_file(sections: Dict[str, Dict]) -> None:
     path = os.path.join(REPORTS_DIR, "summary.txt")
     with open(path, "w", encoding="utf-8") as f:
@@ -361,6 +491,8 @@ def main() -> None:
     sections["learning_curve"] = plot_learning_curve_from_embeddings(X, y_names)
     sections["roc_per_class"] = plot_per_class_roc_from_embeddings(X, y_names)
     sections["calibration"] = plot_calibration_from_embeddings(X, y_names)
+    sections["gallery_vs_svc"] = compare_gallery_with_svc(X, y_names)
+    sections["enrollment_budget"] = compare_enrollment_budgets(X, y_names)
 
     write_summary_file(sections)
 
@@ -0,0 +1,59 @@
+# selection.py - pick the most diverse enrollment samples of a user
+#
+# Webcam enrollment produces runs of near-identical frames. Each one costs
+# a row in the embedding store, the gallery and the SVC training set, but
+# after the first few they add almost nothing a probe can match. k-center
+# greedy keeps at most k samples that cover the user's embeddings best:
+# every pick is the sample farthest (cosine distance) from all samples
+# kept so far.
+import numpy as np
+
+from gallery import normalize
+
+
+def cosine_distances(vecs, others):
+    """(len(vecs), len(others)) cosine distances."""
+    return 1.0 - normalize(vecs) @ normalize(others).T
+
+
+def select_diverse(vecs, k, quality=None):
+    """Sorted indices of at most k samples chosen by k-center greedy.
+
+    The first pick is the best-quality sample, or without scores the one
+    nearest the user's mean. Each further pick maximizes its distance to
+    the nearest kept sample, weighted by 0.5 + 0.5 * quality so that of
+    two equally new views the sharper, better exposed one is kept.
+    """
+    vecs = normalize(np.asarray(vecs, dtype=np.float32).reshape(len(vecs), -1))
+    n = len(vecs)
+    if n <= k:
+        return np.arange(n)
+    if k <= 0:
+        return np.arange(0)
+    if quality is None:
+        weight = np.ones(n)
+        first = int(np.argmax(vecs @ normalize(vecs.mean(axis=0))))
+    else:
+        quality = np.clip(np.asarray(quality, dtype=np.float64), 0.0, 1.0)
+        weight = 0.5 + 0.5 * quality
+        first = int(np.argmax(quality))
+    chosen = [first]
+    nearest = 1.0 - vecs @ vecs[first]
+    while len(chosen) < k:
+        score = nearest * weight
+        score[chosen] = -np.inf
+        i = int(np.argmax(score))
+        chosen.append(i)
+        nearest = np.minimum(nearest, 1.0 - vecs @ vecs[i])
+    return np.sort(np.asarray(chosen))
+
+
+def select_per_user(vecs, names, k, quality=None):
+    """Row indices keeping at most k diverse samples of every user, in the original order."""
+    names = np.asarray(names)
+    keep = []
+    for name in np.unique(names):
+        rows = np.flatnonzero(names == name)
+        scores = None if quality is None else np.asarray(quality)[rows]
+        keep.append(rows[select_diverse(np.asarray(vecs)[rows], k, scores)])
+    return np.sort(np.concatenate(keep)) if keep else np.arange(0)
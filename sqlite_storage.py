@@ -0,0 +1,197 @@
+# sqlite_storage.py - accounts and ledger in one SQLite database (WAL mode)
+#
+# Selected with FACEATM_STORAGE=sqlite. A deposit or withdrawal is a single
+# UPDATE guarded by the balance check plus the INSERT into transactions,
+# inside one BEGIN IMMEDIATE transaction: no read-modify-write in Python,
+# so concurrent requests (threads or gunicorn workers) cannot lose updates.
+# WAL lets readers run while a write commits. Each thread (and each forked
+# process) opens its own connection.
+import os
+import sqlite3
+import threading
+
+import pandas as pd
+
+from metrics import timed
+from storage import (ACCOUNT_COLUMNS, ACCOUNTS_CSV, TXN_CSV, AccountExists, AccountNotFound, InsufficientFunds,
+                     format_history, timestamp)
+
+DB_PATH = os.environ.get("FACEATM_DB", "faceatm.db")
+# Seconds a writer waits for another writer's lock before failing
+BUSY_TIMEOUT = float(os.environ.get("FACEATM_DB_BUSY_TIMEOUT", "5"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    unique_id TEXT PRIMARY KEY,
+    account_number TEXT NOT NULL,
+    name TEXT,
+    bank TEXT,
+    password TEXT,
+    account_balance INTEGER NOT NULL DEFAULT 0 CHECK (account_balance >= 0)
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transactions_user ON transactions (user_id, id);
+"""
+
+
+class SQLiteStorage:
+    """Same interface as storage.CSVStorage, backed by a WAL SQLite database.
+
+    A fresh database is filled from the CSV files when they exist, so
+    switching FACEATM_STORAGE to sqlite keeps every account and its history.
+    """
+
+    def __init__(self, path=DB_PATH, accounts_csv=ACCOUNTS_CSV, txn_csv=TXN_CSV):
+        self.path = path
+        self._local = threading.local()
+        conn = self.connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        with self.transaction() as conn:
+            # user_version marks a migrated database; checked under the write
+            # lock so workers starting together migrate exactly once
+            if conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+                migrate_csv(conn, accounts_csv, txn_csv)
+                conn.execute("PRAGMA user_version = 1")
+
+    def connection(self):
+        """This thread's connection; connections are never shared across threads or a fork."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            # Autocommit mode: transactions are opened explicitly with BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")  # fsync at checkpoints only; safe with WAL
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def transaction(self):
+        return _Transaction(self.connection())
+
+    def read_accounts(self):
+        with timed("db_read"):
+            return pd.read_sql_query(f"SELECT {', '.join(ACCOUNT_COLUMNS)} FROM accounts ORDER BY rowid",
+                                     self.connection())
+
+    def write_accounts(self, df):
+        """Replace every account with the rows of df (the CSV backend's contract)."""
+        rows = [tuple(_account_values(r)) for r in df[ACCOUNT_COLUMNS].to_dict("records")]
+        with timed("db_write"), self.transaction() as conn:
+            conn.execute("DELETE FROM accounts")
+            conn.executemany("INSERT INTO accounts VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def get_account(self, user_id):
+        with timed("db_read"):
+            cur = self.connection().execute(
+                f"SELECT {', '.join(ACCOUNT_COLUMNS)} FROM accounts WHERE unique_id = ?", (str(user_id),))
+            row = cur.fetchone()
+        return None if row is None else dict(zip(ACCOUNT_COLUMNS, row))
+
+    def create_account(self, account):
+        try:
+            with timed("db_write"), self.transaction() as conn:
+                conn.execute("INSERT INTO accounts VALUES (?, ?, ?, ?, ?, ?)", _account_values(account))
+        except sqlite3.IntegrityError as e:
+            if "accounts.unique_id" not in str(e):
+                raise
+            raise AccountExists(account["unique_id"]) from None
+
+    def deposit(self, user_id, amount):
+        return self._update_balance(user_id, amount, "Deposit")
+
+    def withdraw(self, user_id, amount):
+        return self._update_balance(user_id, -amount, "Withdraw")
+
+    def _update_balance(self, user_id, delta, txn_type):
+        user_id = str(user_id)
+        with timed("db_write"), self.transaction() as conn:
+            cur = conn.execute("UPDATE accounts SET account_balance = account_balance + ? "
+                               "WHERE unique_id = ? AND account_balance + ? >= 0", (delta, user_id, delta))
+            row = conn.execute("SELECT account_balance FROM accounts WHERE unique_id = ?", (user_id,)).fetchone()
+            if cur.rowcount == 0:
+                raise InsufficientFunds(user_id) if row else AccountNotFound(user_id)
+            conn.execute("INSERT INTO transactions (user_id, type, amount, timestamp) VALUES (?, ?, ?, ?)",
+                         (user_id, txn_type, abs(delta), timestamp()))
+        return row[0]
+
+    def log_transaction(self, user_id, txn_type, amount):
+        with timed("db_write"), self.transaction() as conn:
+            conn.execute("INSERT INTO transactions (user_id, type, amount, timestamp) VALUES (?, ?, ?, ?)",
+                         (str(user_id), txn_type, int(amount), timestamp()))
+
+    def get_history(self, user_id, limit=None, cursor=None):
+        """The cursor is the id of the oldest transaction already shown."""
+        # One extra row tells whether an older page exists
+        with timed("db_read"):
+            rows = self.connection().execute(
+                "SELECT id, timestamp, type, amount FROM transactions WHERE user_id = ? AND id < ? "
+                "ORDER BY id DESC LIMIT ?",
+                (str(user_id), int(cursor) if cursor is not None else 2 ** 63 - 1,
+                 int(limit) + 1 if limit is not None else -1)).fetchall()
+        more = limit is not None and len(rows) > limit
+        rows = rows[:limit] if limit is not None else rows
+        return format_history(r[1:] for r in rows), (rows[-1][0] if more else None)
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT, rolled back if the block raises."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+def _account_values(account):
+    values = [account.get(c) for c in ACCOUNT_COLUMNS]
+    values[:5] = [None if v is None or pd.isna(v) else str(v) for v in values[:5]]
+    values[5] = int(values[5] or 0)
+    return values
+
+
+def migrate_csv(conn, accounts_csv=ACCOUNTS_CSV, txn_csv=TXN_CSV, chunk_size=100000):
+    """Copy the CSV accounts and transactions in, inside the caller's transaction.
+
+    Returns (accounts, transactions) copied. Rows are read in chunks so
+    large ledgers are never fully in memory.
+    """
+    counts = [0, 0]
+    if os.path.exists(accounts_csv):
+        for chunk in pd.read_csv(accounts_csv, dtype=str, chunksize=chunk_size):
+            chunk["account_balance"] = pd.to_numeric(chunk["account_balance"], errors="coerce").fillna(0)
+            conn.executemany("INSERT OR REPLACE INTO accounts VALUES (?, ?, ?, ?, ?, ?)",
+                             [_account_values(r) for r in chunk[ACCOUNT_COLUMNS].to_dict("records")])
+            counts[0] += len(chunk)
+    if os.path.exists(txn_csv):
+        for chunk in pd.read_csv(txn_csv, dtype=str, chunksize=chunk_size):
+            amounts = pd.to_numeric(chunk["amount"], errors="coerce").fillna(0).astype(int)
+            conn.executemany("INSERT INTO transactions (user_id, type, amount, timestamp) VALUES (?, ?, ?, ?)",
+                             zip(chunk["user_id"], chunk["type"], amounts.tolist(), chunk["timestamp"]))
+            counts[1] += len(chunk)
+    return tuple(counts)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Create the SQLite database from bank_details.csv and transactions.csv")
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--accounts", default=ACCOUNTS_CSV)
+    parser.add_argument("--transactions", default=TXN_CSV)
+    args = parser.parse_args()
+    # Opening a database migrates it unless that was already done once
+    conn = SQLiteStorage(args.db, args.accounts, args.transactions).connection()
+    accounts = conn.execute("SELECT COUNT(*) FROM accounts").fetchone()[0]
+    txns = conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+    print(f"✅ {args.db}: {accounts} accounts, {txns} transactions")
@@ -11,20 +11,28 @@ navigator.mediaDevices.getUserMedia({video:true, audio:false})
   resultDiv.innerText = "Camera error: " + err;
 });
 
-snapBtn.addEventListener("click", async () => {
+function grabFrame() {
   const canvas = document.createElement("canvas");
   canvas.width = video.videoWidth || 640;
   canvas.height = video.videoHeight || 480;
   const ctx = canvas.getContext("2d");
   ctx.drawImage(video, 0, 0, canvas.width, canvas.height);
-  const dataURL = canvas.toDataURL("image/jpeg");
+  return new Promise(resolve => canvas.toBlob(resolve, "image/jpeg", 0.8));
+}
+
+snapBtn.addEventListener("click", async () => {
+  // A short burst of frames is verified in one request
+  const frames = [];
+  for (let i = 0; i < 3; i++) {
+    if (i) await new Promise(r => setTimeout(r, 150));
+    frames.push(await grabFrame());
+  }
   resultDiv.innerText = "Verifying...";
+  // Binary JPEG parts, no base64 inflation
+  const form = new FormData();
+  frames.forEach((blob, i) => form.append("images", blob, `frame_${i}.jpg`));
   try {
-    const res = await fetch("/api/verify", {
-      method: "POST",
-      headers: {"Content-Type":"application/json"},
-      body: JSON.stringify({image: dataURL})
-    });
+    const res = await fetch("/api/verify/burst", {method: "POST", body: form});
     const j = await res.json();
     if(j.name && j.name !== "unknown") {
       resultDiv.innerHTML = `Recognized: <b>${j.name}</b> (${(j.proba*100).toFixed(1)}%)<br>
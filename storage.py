@@ -1,35 +1,198 @@
-# storage.py
+# storage.py - accounts and transaction ledger behind a pluggable backend
+#
+# FACEATM_STORAGE picks the backend: "csv" (bank_details.csv +
+# transactions.csv, the default) or "sqlite" (sqlite_storage.py, one WAL
+# database). app.py only calls the module-level functions below, which
+# forward to the backend of this process.
 import os
-import pandas as pd
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 
+import pandas as pd
+
+from accounts import AccountRepository
+from ledger import TransactionLog
+from metrics import timed
+
+try:
+    import fcntl
+except ImportError:  # Windows: CSV updates are only serialized within one process
+    fcntl = None
+
 ACCOUNTS_CSV = "bank_details.csv"
 TXN_CSV = "transactions.csv"
+ACCOUNT_COLUMNS = ["unique_id", "account_number", "name", "bank", "password", "account_balance"]
+STORAGE_BACKEND = os.environ.get("FACEATM_STORAGE", "csv").lower()
+
+
+class AccountNotFound(LookupError):
+    pass
+
+
+class InsufficientFunds(ValueError):
+    pass
+
+
+class AccountExists(ValueError):
+    pass
+
+
+def timestamp():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def format_history(rows):
+    """Dashboard lines for (timestamp, type, amount) rows."""
+    return [f"{ts}: {txn_type} ₹{amount}" for ts, txn_type, amount in rows]
+
+
+class CSVStorage:
+    """The original CSV files.
+
+    Accounts are served from an in-memory index of bank_details.csv
+    (accounts.py) and every update rewrites the file; transactions.csv is
+    an append-only log with a per-user index (ledger.py).
+
+    Every read-modify-write runs under a lock (a flock on a side file where
+    available, so gunicorn workers serialize too); concurrent withdrawals
+    can no longer both spend the same balance.
+    """
+
+    def __init__(self, accounts_csv=ACCOUNTS_CSV, txn_csv=TXN_CSV):
+        self.accounts_csv = accounts_csv
+        self.txn_csv = txn_csv
+        self.accounts = AccountRepository(accounts_csv, ACCOUNT_COLUMNS)
+        self.ledger = TransactionLog(txn_csv)
+        self._lock = threading.RLock()
+        self._depth = 0
+
+    @contextmanager
+    def locked(self):
+        with self._lock:
+            # flock() on a second descriptor would wait on our own lock, so only
+            # the outermost level takes it
+            if fcntl is None or self._depth:
+                self._depth += 1
+                try:
+                    yield
+                finally:
+                    self._depth -= 1
+                return
+            with open(self.accounts_csv + ".lock", "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                self._depth += 1
+                try:
+                    yield
+                finally:
+                    self._depth -= 1
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read_accounts(self):
+        if not os.path.exists(self.accounts_csv):
+            return pd.DataFrame(columns=ACCOUNT_COLUMNS)
+        with timed("csv_read"):
+            df = pd.read_csv(self.accounts_csv)
+        if "account_balance" in df.columns:
+            df["account_balance"] = pd.to_numeric(df["account_balance"], errors="coerce").fillna(0).astype(int)
+        return df
+
+    def write_accounts(self, df):
+        # The account index notices the new file and reloads on its next lookup
+        with timed("csv_write"):
+            tmp_path = self.accounts_csv + ".tmp"
+            df.to_csv(tmp_path, index=False)
+            os.replace(tmp_path, self.accounts_csv)
+
+    def get_account(self, user_id):
+        return self.accounts.get(user_id)
+
+    def create_account(self, account):
+        with self.locked():
+            if not self.accounts.add(account):
+                raise AccountExists(account["unique_id"])
+
+    def _update_balance(self, user_id, delta, txn_type):
+        with self.locked():
+            try:
+                balance = self.accounts.add_to_balance(user_id, delta)
+            except ValueError:
+                raise InsufficientFunds(user_id) from None
+            if balance is None:
+                raise AccountNotFound(user_id)
+            self.log_transaction(user_id, txn_type, abs(delta))
+        return balance
+
+    def deposit(self, user_id, amount):
+        return self._update_balance(user_id, amount, "Deposit")
+
+    def withdraw(self, user_id, amount):
+        return self._update_balance(user_id, -amount, "Withdraw")
+
+    def log_transaction(self, user_id, txn_type, amount):
+        with timed("ledger_append"):
+            self.ledger.append(user_id, txn_type, amount, timestamp())
+
+    def get_history(self, user_id, limit=None, cursor=None):
+        with timed("ledger_read"):
+            entries, next_cursor = self.ledger.history(user_id, limit, cursor)
+        return format_history(entries), next_cursor
+
+
+def open_backend(name=STORAGE_BACKEND):
+    if name == "csv":
+        return CSVStorage()
+    if name == "sqlite":
+        from sqlite_storage import SQLiteStorage
+        return SQLiteStorage()
+    raise ValueError(f"Unknown storage backend: {name}")
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = open_backend()
+    return _backend
+
 
 def read_accounts():
-    if not os.path.exists(ACCOUNTS_CSV):
-        return pd.DataFrame(columns=["unique_id","account_number","name","bank","password","account_balance"])
-    df = pd.read_csv(ACCOUNTS_CSV)
-    if "account_balance" in df.columns:
-        df["account_balance"] = pd.to_numeric(df["account_balance"], errors="coerce").fillna(0).astype(int)
-    return df
+    return get_backend().read_accounts()
 
 def write_accounts(df):
-    df.to_csv(ACCOUNTS_CSV, index=False)
+    get_backend().write_accounts(df)
+
+def get_account(user_id):
+    """The account row as a dict, or None."""
+    return get_backend().get_account(user_id)
+
+def create_account(account):
+    """Raises AccountExists, and writes nothing, when account["unique_id"] is taken."""
+    get_backend().create_account(account)
+
+def deposit(user_id, amount):
+    """Credit the account and log it atomically; returns the new balance."""
+    return get_backend().deposit(user_id, amount)
+
+def withdraw(user_id, amount):
+    """Debit the account and log it atomically; returns the new balance.
+
+    Raises AccountNotFound or InsufficientFunds and changes nothing then.
+    """
+    return get_backend().withdraw(user_id, amount)
 
 def log_transaction(user_id, txn_type, amount):
-    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    entry = {"user_id": user_id, "type": txn_type, "amount": amount, "timestamp": ts}
-    if not os.path.exists(TXN_CSV):
-        pd.DataFrame([entry]).to_csv(TXN_CSV, index=False)
-    else:
-        df = pd.read_csv(TXN_CSV)
-        df = pd.concat([df, pd.DataFrame([entry])], ignore_index=True)
-        df.to_csv(TXN_CSV, index=False)
-
-def get_history(user_id):
-    if not os.path.exists(TXN_CSV):
-        return []
-    df = pd.read_csv(TXN_CSV)
-    df = df[df["user_id"].astype(str) == str(user_id)]
-    return [f"{row['timestamp']}: {row['type']} ₹{row['amount']}" for _, row in df.iterrows()]
+    get_backend().log_transaction(user_id, txn_type, amount)
+
+def get_history(user_id, limit=None, cursor=None):
+    """(history lines newest first, cursor of the next older page or None).
+
+    Without a limit the whole history is returned; cursors are opaque
+    values of the backend in use.
+    """
+    return get_backend().get_history(user_id, limit, cursor)
@@ -0,0 +1,247 @@
+# streaming.py - session-based verification over a stream of frames
+#
+# A StreamSession holds the state of one continuous capture. Between frames
+# the face box is followed with template matching in a small window around
+# the last box (a fraction of a millisecond), and the Haar detector only runs
+# when the match is lost or every REDETECT_EVERY frames. The embedder only
+# runs once the track has been still for STABLE_FRAMES frames, and then at
+# most every EMBED_EVERY frames. Scores accumulate, the same way a burst is
+# scored, until a decision is reached.
+import os
+import secrets
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from face_utils import decide_frames, detect_faces, extract_embeddings, gate_face, gate_frame, models_ready, score_frames
+from metrics import timed
+
+# Tracking runs on a gray copy of the frame scaled to this width
+TRACK_WIDTH = int(os.environ.get("FACEATM_STREAM_TRACK_WIDTH", "320"))
+# Template match score (TM_CCOEFF_NORMED) below which the track counts as lost
+TRACK_MIN_SCORE = float(os.environ.get("FACEATM_STREAM_TRACK_MIN_SCORE", "0.6"))
+# Search window around the last box, as a fraction of the box side per side
+TRACK_MARGIN = 0.5
+# Re-run detection at least this often to correct drift and scale changes
+REDETECT_EVERY = int(os.environ.get("FACEATM_STREAM_REDETECT_EVERY", "15"))
+# A track is stable after this many frames moving less than STABLE_SHIFT of the box side
+STABLE_FRAMES = int(os.environ.get("FACEATM_STREAM_STABLE_FRAMES", "3"))
+STABLE_SHIFT = float(os.environ.get("FACEATM_STREAM_STABLE_SHIFT", "0.08"))
+# Frames between two embeddings of a stable track
+EMBED_EVERY = int(os.environ.get("FACEATM_STREAM_EMBED_EVERY", "3"))
+# Embeddings needed before deciding, and after which an undecided session gives up
+MIN_EMBEDS = 2
+MAX_EMBEDS = 8
+# Idle sessions are dropped after this many seconds
+SESSION_TTL = float(os.environ.get("FACEATM_STREAM_TTL", "60"))
+
+
+class StreamSession:
+    """Tracking and score accumulation for one continuous capture."""
+
+    def __init__(self, claimed_id=None, voting="mean", min_proba=0.5):
+        self.id = secrets.token_urlsafe(16)
+        self.claimed_id = str(claimed_id) if claimed_id else None
+        self.voting = voting
+        self.min_proba = min_proba
+        self.created = self.last_seen = time.time()
+        self.lock = threading.Lock()
+        self.status = "searching"  # searching -> tracking -> decided | rejected
+        self.name = "unknown"
+        self.proba = 0.0
+        self.box = None
+        self.template = None
+        self.stable = 0
+        self.since_detect = 0
+        self.since_embed = EMBED_EVERY
+        self.scores = []
+        self.classes = None
+        self.thresholds = None
+        self.stats = {"frames": 0, "detections": 0, "tracked": 0, "embeddings": 0, "rejected_frames": 0}
+
+    @property
+    def done(self):
+        return self.status in ("decided", "rejected")
+
+    def to_dict(self):
+        res = {"session_id": self.id, "status": self.status, "name": self.name, "proba": self.proba,
+               "box": self.box, "stable": self.stable >= STABLE_FRAMES, "stats": dict(self.stats)}
+        if self.claimed_id:
+            res.update({"claimed_id": self.claimed_id, "mode": "1:1"})
+        return res
+
+    def process(self, frame, embedder, recognizer, le, gallery):
+        """Advance the session by one BGR frame and return its state."""
+        with self.lock:
+            self.last_seen = time.time()
+            if self.done:
+                return self.to_dict()
+            self.stats["frames"] += 1
+            rejected = gate_frame(frame)
+            if rejected:
+                self.stats["rejected_frames"] += 1
+                self._lose_track()
+                return dict(self.to_dict(), **rejected)
+            box = self._locate(frame)
+            if box is None:
+                self._lose_track()
+                return dict(self.to_dict(), error="No faces detected")
+            self.since_embed += 1
+            if self.stable < STABLE_FRAMES or self.since_embed < EMBED_EVERY:
+                return self.to_dict()
+            rejected = gate_face(frame, box)
+            if rejected:
+                self.stats["rejected_frames"] += 1
+                return dict(self.to_dict(), **rejected)
+            self._embed(frame, box, embedder, recognizer, le, gallery)
+            return self.to_dict()
+
+    def _lose_track(self):
+        self.status = "searching"
+        self.template = None
+        self.stable = 0
+        # Without this the next detection would be narrowed to where the face used to be
+        self.box = None
+
+    def _locate(self, frame):
+        """The face box in this frame, tracked from the last one when possible."""
+        scale = min(1.0, TRACK_WIDTH / float(frame.shape[1]))
+        gray = None
+        box = None
+        if self.template is not None and self.since_detect < REDETECT_EVERY:
+            with timed("track"):
+                gray = self._gray(frame, scale)
+                box = self._track(gray, scale)
+            if box is not None:
+                self.stats["tracked"] += 1
+                self.since_detect += 1
+        if box is None:
+            boxes = detect_faces(frame, roi=self.box)
+            self.stats["detections"] += 1
+            self.since_detect = 0
+            if not boxes:
+                return None
+            box = list(max(boxes, key=lambda b: (b[2]-b[0])*(b[3]-b[1])))
+            gray = gray if gray is not None else self._gray(frame, scale)
+            x1, y1, x2, y2 = [int(round(v * scale)) for v in box]
+            self.template = gray[y1:y2, x1:x2].copy() if x2 - x1 >= 8 and y2 - y1 >= 8 else None
+        box = [int(v) for v in box]
+        if self.box is not None:
+            side = max(1, box[2] - box[0])
+            shift = max(abs(box[0] - self.box[0]), abs(box[1] - self.box[1]),
+                        abs(box[2] - self.box[2]), abs(box[3] - self.box[3])) / float(side)
+            self.stable = self.stable + 1 if shift < STABLE_SHIFT else 0
+        self.box = box
+        if self.status == "searching":
+            self.status = "tracking"
+        return box
+
+    @staticmethod
+    def _gray(frame, scale):
+        if scale < 1.0:
+            frame = cv2.resize(frame, (max(1, int(frame.shape[1] * scale)), max(1, int(frame.shape[0] * scale))),
+                               interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+    def _track(self, gray, scale):
+        th, tw = self.template.shape[:2]
+        x1, y1 = int(round(self.box[0] * scale)), int(round(self.box[1] * scale))
+        mx, my = int(tw * TRACK_MARGIN), int(th * TRACK_MARGIN)
+        sx1, sy1 = max(0, x1 - mx), max(0, y1 - my)
+        sx2, sy2 = min(gray.shape[1], x1 + tw + mx), min(gray.shape[0], y1 + th + my)
+        window = gray[sy1:sy2, sx1:sx2]
+        if window.shape[0] < th or window.shape[1] < tw:
+            return None
+        _, score, _, (dx, dy) = cv2.minMaxLoc(cv2.matchTemplate(window, self.template, cv2.TM_CCOEFF_NORMED))
+        if score < TRACK_MIN_SCORE:
+            return None
+        nx1, ny1 = (sx1 + dx) / scale, (sy1 + dy) / scale
+        return [nx1, ny1, nx1 + (self.box[2] - self.box[0]), ny1 + (self.box[3] - self.box[1])]
+
+    def _embed(self, frame, box, embedder, recognizer, le, gallery):
+        x1, y1, x2, y2 = box
+        with timed("embed"):
+            vecs = extract_embeddings(embedder, [frame[y1:y2, x1:x2]])
+        self.stats["embeddings"] += 1
+        self.since_embed = 0
+        with timed("classify"):
+            rows, classes, self.thresholds = score_frames(vecs, recognizer, le, gallery,
+                                                          self.claimed_id, self.min_proba)
+        if self.classes is not None and not np.array_equal(np.asarray(self.classes), np.asarray(classes)):
+            # The models were swapped mid-session: earlier score columns belong to other classes
+            self.scores = []
+        self.classes = classes
+        self.scores.append(rows[0])
+        j, score = decide_frames(np.vstack(self.scores), self.thresholds, self.voting, MIN_EMBEDS)
+        self.proba = score
+        if j is not None and len(self.scores) >= MIN_EMBEDS:
+            self.status = "decided"
+            self.name = self.classes[j]
+        elif len(self.scores) >= MAX_EMBEDS:
+            self.status = "rejected"
+
+
+class StreamSessions:
+    """In-process registry of open stream sessions, expired after SESSION_TTL idle seconds."""
+
+    def __init__(self, ttl=SESSION_TTL, max_sessions=1000):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def create(self, **kwargs):
+        session = StreamSession(**kwargs)
+        with self._lock:
+            self._expire()
+            if len(self._sessions) >= self.max_sessions:
+                raise RuntimeError("Too many open stream sessions")
+            self._sessions[session.id] = session
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            self._expire()
+            return self._sessions.get(session_id)
+
+    def close(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None)
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        for sid in [sid for sid, s in self._sessions.items() if s.last_seen < cutoff]:
+            del self._sessions[sid]
+
+
+def check_models(session, embedder, recognizer, le, gallery):
+    """Error message when the loaded models cannot serve this session, else None."""
+    if session.claimed_id:
+        if embedder is None or gallery is None:
+            return "Models not loaded"
+        if gallery.centroid(session.claimed_id) is None:
+            return "Unknown account"
+        return None
+    return None if models_ready(embedder, recognizer, le) else "Models not loaded"
+
+
+def read_length_prefixed(stream, max_frame_bytes):
+    """Yield frames from a body of [4-byte big-endian length][encoded image] records."""
+    while True:
+        header = stream.read(4)
+        if not header:
+            return
+        if len(header) < 4:
+            raise ValueError("truncated frame header")
+        size = int.from_bytes(header, "big")
+        if size > max_frame_bytes:
+            raise ValueError("frame too large")
+        data = bytearray()
+        while len(data) < size:
+            chunk = stream.read(size - len(data))
+            if not chunk:
+                raise ValueError("truncated frame")
+            data += chunk
+        yield bytes(data)
@@ -0,0 +1,90 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from gallery import MAX_THRESHOLD, MIN_THRESHOLD, FaceGallery, normalize
+
+SAMPLE_EMBEDDINGS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                 "output", "embeddings.pickle")
+
+
+@pytest.fixture(scope="module")
+def samples():
+    with open(SAMPLE_EMBEDDINGS, "rb") as f:
+        data = pickle.load(f)
+    return np.asarray(data["embeddings"], dtype=np.float32), np.asarray(data["names"]).astype(str)
+
+
+def claim_scores(gallery, vecs):
+    """Similarity of every sample to every user's centroid, as verify_claim_from_frame computes it."""
+    vecs = vecs / np.linalg.norm(vecs, axis=1, keepdims=True)
+    return np.stack([vecs @ gallery.centroid(name) for name in gallery.classes_], axis=1)
+
+
+def calibrated_floor(scores, impostor):
+    """The rule DEFAULT_THRESHOLD was set by: the highest impostor score, rounded up to 0.01."""
+    return float(np.ceil(scores[impostor].max() * 100) / 100)
+
+
+def test_floor_calibrated_on_other_users_rejects_held_out_impostors(samples, monkeypatch):
+    """Leave one user out: the floor comes from the other users' impostor scores only,
+    and every claim by or for the held-out user is checked against it."""
+    vecs, names = samples
+    users = np.unique(names)
+    claims = false_accepts = 0
+    for held_out in users:
+        calibration = users[users != held_out]
+        rows = np.isin(names, calibration)
+        calib_gallery = FaceGallery.from_embeddings(vecs[rows], names[rows])
+        calib_scores = claim_scores(calib_gallery, vecs[rows])
+        floor = calibrated_floor(calib_scores, names[rows][:, None] != calib_gallery.classes_[None, :])
+        monkeypatch.setattr("gallery.MIN_THRESHOLD", floor)
+        gallery = FaceGallery.from_embeddings(vecs, names)
+        scores = claim_scores(gallery, vecs)
+        thresholds = np.array([gallery.threshold_for(n) for n in gallery.classes_])
+        # The held-out user claiming anyone, and anyone claiming the held-out user
+        involved = (names == held_out)[:, None] | (gallery.classes_ == held_out)[None, :]
+        impostor = (names[:, None] != gallery.classes_[None, :]) & involved
+        claims += int(impostor.sum())
+        false_accepts += int(((scores >= thresholds) & impostor).sum())
+    assert claims == 480
+    assert false_accepts == 0
+
+
+def test_no_impostor_claim_accepted_on_sample_users(samples):
+    """Regression pin, not a false accept rate: DEFAULT_THRESHOLD was fitted to these same samples."""
+    vecs, names = samples
+    gallery = FaceGallery.from_embeddings(vecs, names)
+    scores = claim_scores(gallery, vecs)
+    thresholds = np.array([gallery.threshold_for(n) for n in gallery.classes_])
+    impostor = names[:, None] != gallery.classes_[None, :]
+    accepted = (scores >= thresholds) & impostor
+    assert impostor.sum() == 240
+    assert calibrated_floor(scores, impostor) == pytest.approx(MIN_THRESHOLD)
+    assert not accepted.any(), [(names[i], gallery.classes_[j]) for i, j in zip(*np.nonzero(accepted))]
+
+
+def test_thresholds_never_below_floor(samples):
+    vecs, names = samples
+    gallery = FaceGallery.from_embeddings(vecs, names)
+    assert min(gallery.threshold_for(n) for n in gallery.classes_) >= MIN_THRESHOLD - 1e-6
+    # A user with very spread-out samples still gets the floor, not less
+    spread = FaceGallery()
+    spread.add("wide", np.eye(4, dtype=np.float32))
+    assert spread.threshold_for("wide") == pytest.approx(MIN_THRESHOLD)
+
+
+def test_threshold_follows_spread_samples():
+    rng = np.random.default_rng(0)
+    accepted = normalize(rng.standard_normal(128) + 0.3 * rng.standard_normal((20, 128)))
+    kept = accepted[:3]
+    gallery = FaceGallery()
+    gallery.add("u", kept, spread=accepted)
+    sims = accepted @ gallery.centroid("u")
+    expected = np.clip(sims.mean() - 2 * sims.std(), MIN_THRESHOLD, MAX_THRESHOLD)
+    assert gallery.threshold_for("u") == pytest.approx(expected)
+    assert MIN_THRESHOLD < expected < MAX_THRESHOLD
+    # The centroid is still that of the kept samples only
+    assert np.allclose(gallery.centroid("u"), normalize(kept.sum(axis=0)), atol=1e-6)
@@ -0,0 +1,51 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+pytest.importorskip("sklearn")
+from sklearn.preprocessing import LabelEncoder
+from sklearn.svm import SVC
+
+from linear_scorer import SCORER_FILE, LinearScorer, export_svc
+
+SAMPLE_EMBEDDINGS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                 "output", "embeddings.pickle")
+# sklearn stops libsvm's coupling iterations at an optimality error of 0.005 / k,
+# short of the exact optimum the scorer solves for; two classes start furthest off
+TWO_CLASS_TOLERANCE = 1e-2
+MULTICLASS_TOLERANCE = 2e-3
+
+
+@pytest.fixture(scope="module")
+def samples():
+    with open(SAMPLE_EMBEDDINGS, "rb") as f:
+        data = pickle.load(f)
+    return np.asarray(data["embeddings"], dtype=np.float32), np.asarray(data["names"]).astype(str)
+
+
+def fit_and_export(vecs, names, tmp_path):
+    le = LabelEncoder()
+    svc = SVC(C=1.0, kernel="linear", probability=True, random_state=0).fit(vecs, le.fit_transform(names))
+    path = str(tmp_path / SCORER_FILE)
+    export_svc(svc, le, path)
+    return svc, LinearScorer.load(path)
+
+
+@pytest.mark.parametrize("k", [2, 3, 7])
+def test_predict_proba_matches_sklearn(samples, tmp_path, k):
+    vecs, names = samples
+    users = np.unique(names)[:k]
+    train = np.isin(names, users)
+    svc, scorer = fit_and_export(vecs[train], names[train], tmp_path)
+    # Every sample, enrolled or not, as a probe
+    ours, theirs = scorer.predict_proba(vecs), svc.predict_proba(vecs)
+    tolerance = TWO_CLASS_TOLERANCE if k == 2 else MULTICLASS_TOLERANCE
+    np.testing.assert_allclose(ours, theirs, atol=tolerance, rtol=0)
+    np.testing.assert_allclose(ours.sum(axis=1), 1.0, atol=1e-9)
+    # The argmax only differs for probes sklearn scores within the tolerance of a tie
+    top = np.sort(theirs, axis=1)
+    clear = top[:, -1] - top[:, -2] > 2 * tolerance
+    assert (ours.argmax(axis=1) == theirs.argmax(axis=1))[clear].all()
+    assert list(scorer.classes_) == list(users)
@@ -0,0 +1,27 @@
+import os
+
+import pytest
+
+from sqlite_storage import SQLiteStorage
+from storage import ACCOUNT_COLUMNS, AccountExists, CSVStorage
+
+
+def make_backend(kind, directory):
+    accounts, txns = os.path.join(directory, "bank_details.csv"), os.path.join(directory, "transactions.csv")
+    with open(accounts, "w", encoding="utf-8") as f:
+        f.write(",".join(ACCOUNT_COLUMNS) + "\n")
+    if kind == "csv":
+        return CSVStorage(accounts, txns)
+    return SQLiteStorage(os.path.join(directory, "faceatm.db"), accounts, txns)
+
+
+@pytest.mark.parametrize("kind", ["csv", "sqlite"])
+def test_create_account_rejects_a_taken_id(tmp_path, kind):
+    store = make_backend(kind, str(tmp_path))
+    account = {"unique_id": "42", "account_number": "42", "name": "a", "bank": "FaceATM",
+               "password": "1234", "account_balance": 10}
+    store.create_account(account)
+    with pytest.raises(AccountExists):
+        store.create_account(dict(account, name="b", account_balance=99))
+    assert store.get_account("42")["name"] == "a"
+    assert int(store.get_account("42")["account_balance"]) == 10
@@ -0,0 +1,101 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import train
+from embedding_store import load_names, open_store, write_store
+from enrollment import save_crop
+from gallery import FaceGallery, load_gallery, save_gallery
+
+
+def enroll_crops(user_id, vecs, model_version):
+    user_dir = os.path.join(train.DATASET_DIR, user_id)
+    os.makedirs(user_dir)
+    for vec in vecs:
+        # A crop of its own per sample: crops are stored under their content hash
+        crop = np.resize(np.clip((np.asarray(vec) + 3) * 40, 0, 255).astype(np.uint8), (16, 16, 3))
+        save_crop(user_dir, crop, vec, model_version)
+
+
+def test_concurrent_enrollments_keep_both_users(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open(train.EMBEDDER_MODEL, "wb") as f:
+        f.write(b"embedder")
+    model_version = train.file_digest(train.EMBEDDER_MODEL)
+    rng = np.random.default_rng(0)
+    # A live model with one user already in it
+    existing = rng.standard_normal((3, 128)).astype(np.float32)
+    os.makedirs(train.OUTPUT_DIR)
+    write_store(train.OUTPUT_DIR, existing, ["u0"] * 3, train.EMBEDDER_MODEL)
+    save_gallery(FaceGallery.from_embeddings(existing, ["u0"] * 3), train.OUTPUT_DIR)
+    for user_id in ("u1", "u2"):
+        enroll_crops(user_id, rng.standard_normal((3, 128)), model_version)
+
+    # Widen the window between reading the live gallery and saving it back
+    real_load = train.load_gallery
+    def slow_load(*args, **kwargs):
+        gallery = real_load(*args, **kwargs)
+        time.sleep(0.2)
+        return gallery
+    monkeypatch.setattr(train, "load_gallery", slow_load)
+
+    errors = []
+    def enroll(user_id):
+        try:
+            train.enroll_user(user_id)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=enroll, args=(u,)) for u in ("u1", "u2")]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert not errors
+    gallery = load_gallery(train.OUTPUT_DIR, mapped=False)
+    assert sorted(gallery.classes_) == ["u0", "u1", "u2"]
+    _, labels, meta = open_store(train.OUTPUT_DIR)
+    assert sorted(load_names(labels, meta)) == ["u0"] * 3 + ["u1"] * 3 + ["u2"] * 3
+
+
+class BatchSensitiveEmbedder:
+    """Stand-in net whose output depends on the other crops in the forward pass, as float32 sums do."""
+
+    def setInput(self, blob):
+        self.blob = blob
+
+    def forward(self):
+        flat = self.blob.reshape(len(self.blob), -1)
+        return flat[:, :128] + flat.mean() * 1e-3
+
+
+def fake_init_worker(model_path=None):
+    train._worker_embedder = BatchSensitiveEmbedder()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="the worker pool inherits the stand-in net by fork")
+def test_parallel_training_matches_serial(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open(train.EMBEDDER_MODEL, "wb") as f:
+        f.write(b"embedder")
+    rng = np.random.default_rng(1)
+    # Crops tagged with another embedder are embedded again, straight from the crop
+    for user_id in ("u1", "u2", "u3"):
+        enroll_crops(user_id, rng.standard_normal((5, 128)), "older-embedder")
+    monkeypatch.setattr(train, "_init_worker", fake_init_worker)
+    monkeypatch.setattr(train, "MAX_SAMPLES", 10)
+
+    stores = []
+    for workers in (1, 2):
+        if os.path.exists(train.EMBEDDING_CACHE):
+            os.remove(train.EMBEDDING_CACHE)
+        output_dir = os.path.join(tmp_path, f"workers-{workers}")
+        res = train.train_model(workers=workers, batch_size=4, output_dir=output_dir)
+        assert res["cache"]["misses"] == 15
+        matrix, labels, meta = open_store(output_dir)
+        stores.append((np.array(matrix), load_names(labels, meta)))
+    assert list(stores[0][1]) == list(stores[1][1])
+    assert np.array_equal(stores[0][0], stores[1][0])
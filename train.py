@@ -1,75 +1,298 @@
 # train.py
+import argparse
 import os
 import cv2
+import hashlib
+import multiprocessing
 import pickle
-from sklearn.preprocessing import LabelEncoder
-from sklearn.svm import SVC
+import numpy as np
+from face_utils import EMBED_BATCH_SIZE, extract_embeddings
+from gallery import FaceGallery, load_gallery, save_gallery
+from linear_scorer import SCORER_FILE, export_svc
+from model_store import bump_generation, current_model_dir, new_version_dir, publish, save_shared, training_lock
+from embedding_store import append_store, ensure_store, load_names, open_store, write_store
+from enrollment import MAX_SAMPLES, is_crop, read_accepted, read_embedding
+from selection import select_diverse, select_per_user
 
 DATASET_DIR = "dataset"
 OUTPUT_DIR = "output"
 EMBEDDER_MODEL = "nn4.small2.v1.t7"
+# Embeddings are cached per image content hash so a retrain only runs
+# detection + the embedder forward pass on new or changed images
+EMBEDDING_CACHE = os.path.join(OUTPUT_DIR, "embedding_cache.pickle")
 
-def train_model():
+def file_digest(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def load_embedding_cache(model_version):
+    """Return {image digest: [vec, ...]} for the given embedder version."""
+    if not os.path.exists(EMBEDDING_CACHE):
+        return {}
+    try:
+        with open(EMBEDDING_CACHE, "rb") as f:
+            data = pickle.load(f)
+    except Exception:
+        return {}
+    # A different embedder produces incompatible vectors, start over
+    if data.get("model_version") != model_version:
+        return {}
+    return data.get("entries", {})
+
+def save_embedding_cache(model_version, entries):
+    os.makedirs(os.path.dirname(EMBEDDING_CACHE), exist_ok=True)
+    tmp_path = EMBEDDING_CACHE + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(pickle.dumps({"model_version": model_version, "entries": entries}))
+    os.replace(tmp_path, EMBEDDING_CACHE)
+
+# Per-process detector/embedder, loaded once by _init_worker
+_worker_embedder = None
+_worker_cascade = None
+
+def _init_worker(model_path=EMBEDDER_MODEL):
+    global _worker_embedder, _worker_cascade
+    # Each worker already runs on its own core, keep OpenCV from spawning more threads
+    if multiprocessing.current_process().name != "MainProcess":
+        cv2.setNumThreads(1)
+    _worker_embedder = cv2.dnn.readNetFromTorch(model_path)
+    # Use OpenCV's Haar cascade as a fallback detector
+    _worker_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+    if _worker_cascade.empty():
+        raise RuntimeError("Failed to load Haar cascade for face detection")
+
+def _detect_image(imagePath):
+    """Return the usable face crops in one image, or None if unreadable."""
+    image = cv2.imread(imagePath)
+    if image is None:
+        return None
+    if is_crop(imagePath):
+        # Stored by enrollment.py as the face itself, nothing to detect
+        return [image]
+
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    rects = _worker_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
+
+    faces = []
+    for (x, y, w, h) in rects:
+        x2 = x + w
+        y2 = y + h
+        face = image[y:y2, x:x2]
+        if face.size == 0:
+            continue
+        (fH, fW) = face.shape[:2]
+        if fW < 20 or fH < 20:
+            continue
+        faces.append(face)
+    return faces
+
+def _embed_images(imagePaths, batch_size=EMBED_BATCH_SIZE):
+    """Detect faces in each image and return per-image embedding lists.
+
+    Crops from all images are embedded together, batch_size per forward pass.
+    """
+    crops = [_detect_image(p) for p in imagePaths]
+    vecs = extract_embeddings(_worker_embedder, [f for faces in crops if faces for f in faces], batch_size)
+    results = []
+    i = 0
+    for faces in crops:
+        if faces is None:
+            results.append(None)
+            continue
+        results.append(list(vecs[i:i + len(faces)]))
+        i += len(faces)
+    return results
+
+def train_model(workers=1, batch_size=EMBED_BATCH_SIZE, output_dir=None):
+    """Rebuild the recognizer from dataset/.
+
+    Artifacts go to output_dir; by default a fresh version directory that is
+    published as the live model only once everything has been written.
+
+    workers > 1 spreads detection + embedding of uncached images over that
+    many processes, one chunk of batch_size images at a time. The chunks
+    and their order are those of the serial path, so the result is
+    identical to it. batch_size is the most images per chunk and faces per
+    embedder forward pass. Each user keeps at most MAX_SAMPLES samples,
+    the most diverse ones (selection.py).
+    """
     if not os.path.exists(EMBEDDER_MODEL):
         raise FileNotFoundError(f"Missing embedder file: {EMBEDDER_MODEL}")
-    embedder = cv2.dnn.readNetFromTorch(EMBEDDER_MODEL)
-    imagePaths = [
+    imagePaths = sorted(
         os.path.join(root, file)
         for root, _, files in os.walk(DATASET_DIR)
         for file in files
         if file.lower().endswith(('.png', '.jpg', '.jpeg'))
-    ]
+    )
     if not imagePaths:
         raise FileNotFoundError("No images in dataset to train.")
     knownEmbeddings = []
     knownNames = []
     total = 0
-    # Use OpenCV's Haar cascade as a fallback detector
-    faceCascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
-    if faceCascade.empty():
-        raise RuntimeError("Failed to load Haar cascade for face detection")
 
-    for imagePath in imagePaths:
-        name = imagePath.split(os.path.sep)[-2]
-        image = cv2.imread(imagePath)
-        if image is None:
-            continue
+    model_version = file_digest(EMBEDDER_MODEL)
+    cache = load_embedding_cache(model_version)
+    digests = [file_digest(p) for p in imagePaths]
+    # Enrollment crops come with their embedding
+    for imagePath, digest in zip(imagePaths, digests):
+        if digest not in cache:
+            vec = read_embedding(imagePath, model_version)
+            if vec is not None:
+                cache[digest] = [vec]
 
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        rects = faceCascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
+    # Only the first path of each uncached digest needs detection + embedding
+    pending = {}
+    for imagePath, digest in zip(imagePaths, digests):
+        if digest not in cache and digest not in pending:
+            pending[digest] = imagePath
+    missPaths = list(pending.values())
 
-        for (x, y, w, h) in rects:
-            x2 = x + w
-            y2 = y + h
-            face = image[y:y2, x:x2]
-            if face.size == 0:
-                continue
-            (fH, fW) = face.shape[:2]
-            if fW < 20 or fH < 20:
+    # Images are handled batch_size at a time so only one chunk of decoded frames is held
+    # at a time. The chunks do not depend on the worker count: the embedder sees the same
+    # batches either way, and workers only decide who runs which chunk.
+    chunks = [(missPaths[i:i + batch_size], batch_size) for i in range(0, len(missPaths), batch_size)]
+    workers = max(1, min(workers, len(chunks)))
+    if chunks and workers > 1:
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(EMBEDDER_MODEL,)) as pool:
+            # One chunk per task keeps the pool balanced
+            results = [r for chunk in pool.starmap(_embed_images, chunks, chunksize=1) for r in chunk]
+    elif chunks:
+        _init_worker(EMBEDDER_MODEL)
+        results = [r for chunk in chunks for r in _embed_images(*chunk)]
+    else:
+        results = []
+    fresh = dict(zip(pending.keys(), results))
+
+    entries = {}
+    hits = misses = 0
+    for imagePath, digest in zip(imagePaths, digests):
+        name = imagePath.split(os.path.sep)[-2]
+        if digest in fresh and digest not in entries:
+            vecs = fresh[digest]
+            if vecs is None:
                 continue
-            faceBlob = cv2.dnn.blobFromImage(face, 1.0/255, (96,96), (0,0,0), swapRB=True, crop=False)
-            embedder.setInput(faceBlob)
-            vec = embedder.forward()
+            misses += 1
+        else:
+            vecs = entries[digest] if digest in entries else cache[digest]
+            hits += 1
+        # Images without a usable face are cached too so they aren't re-detected
+        entries[digest] = vecs
+
+        for vec in vecs:
             knownNames.append(name)
-            knownEmbeddings.append(vec.flatten())
+            knownEmbeddings.append(vec)
             total += 1
+    # Anything not seen in this walk belongs to a deleted image or user directory
+    evicted = len(set(cache) - set(entries))
+    save_embedding_cache(model_version, entries)
     if total == 0:
         raise ValueError("No valid faces found.")
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-    data = {"embeddings": knownEmbeddings, "names": knownNames}
-    with open(os.path.join(OUTPUT_DIR, "embeddings.pickle"), "wb") as f:
-        f.write(pickle.dumps(data))
+    # Gallery thresholds follow every accepted sample, pruned enrollment crops included
+    spread = {}
+    for name, vec in zip(knownNames, knownEmbeddings):
+        spread.setdefault(name, []).append(vec)
+    spread = {name: accepted_samples(name, vecs, model_version) for name, vecs in spread.items()}
+    # At most MAX_SAMPLES per user, the most diverse ones
+    keep = select_per_user(knownEmbeddings, knownNames, MAX_SAMPLES)
+    knownEmbeddings = [knownEmbeddings[i] for i in keep]
+    knownNames = [knownNames[i] for i in keep]
+    version_dir = output_dir or new_version_dir()
+    write_store(version_dir, knownEmbeddings, knownNames, os.path.basename(EMBEDDER_MODEL))
+    # sklearn is only needed for the refit; gallery-only enrollment never imports it
+    from sklearn.preprocessing import LabelEncoder
+    from sklearn.svm import SVC
+    # Fit straight from the memory-mapped store instead of the Python lists
+    matrix, _, _ = open_store(version_dir)
     le = LabelEncoder()
     labels = le.fit_transform(knownNames)
     recognizer = SVC(C=1.0, kernel="linear", probability=True)
-    recognizer.fit(knownEmbeddings, labels)
-    with open(os.path.join(OUTPUT_DIR, "recognizer.pickle"), "wb") as f:
+    recognizer.fit(matrix, labels)
+
+    with open(os.path.join(version_dir, "recognizer.pickle"), "wb") as f:
         f.write(pickle.dumps(recognizer))
-    with open(os.path.join(OUTPUT_DIR, "le.pickle"), "wb") as f:
+    # The same SVC with its support vectors in a flat file workers map and share
+    save_shared(recognizer, os.path.join(version_dir, "recognizer.shared"))
+    # ...and as plain arrays, scored without sklearn (linear_scorer.py)
+    export_svc(recognizer, le, os.path.join(version_dir, SCORER_FILE))
+    with open(os.path.join(version_dir, "le.pickle"), "wb") as f:
         f.write(pickle.dumps(le))
-    return {"trained": total}
+    save_gallery(FaceGallery.from_embeddings(matrix, knownNames, spread=spread), version_dir)
+    if output_dir is None:
+        publish(version_dir)
+    return {"trained": len(knownNames), "faces": total, "cache": {"hits": hits, "misses": misses, "evicted": evicted},
+            "model_dir": version_dir}
+
+def accepted_samples(user_id, vecs, model_version):
+    """The user's current samples vecs plus the pruned enrollment crops recorded in dataset/<user_id>/.
+
+    Kept crops are both on disk and in the record; their embeddings are
+    identical, so they are counted once.
+    """
+    own = [np.asarray(v, dtype=np.float32) for v in vecs]
+    seen = {v.tobytes() for v in own}
+    extra = [v for v in read_accepted(os.path.join(DATASET_DIR, user_id), model_version).values()
+             if v.tobytes() not in seen]
+    return np.asarray(own + extra, dtype=np.float32)
+
+def enroll_user(user_id, batch_size=EMBED_BATCH_SIZE):
+    """Add or replace one user in the face gallery without touching anyone else.
+
+    Only dataset/<user_id>/ is read and embedded; the SVC is not refit, so this
+    is meant for FACEATM_RECOGNIZER=gallery deployments.
+    """
+    user_id = str(user_id)
+    user_dir = os.path.join(DATASET_DIR, user_id)
+    imagePaths = sorted(
+        os.path.join(user_dir, file)
+        for file in (os.listdir(user_dir) if os.path.isdir(user_dir) else [])
+        if file.lower().endswith(('.png', '.jpg', '.jpeg'))
+    )
+    if not imagePaths:
+        raise FileNotFoundError(f"No images for user {user_id}.")
+    if not os.path.exists(EMBEDDER_MODEL):
+        raise FileNotFoundError(f"Missing embedder file: {EMBEDDER_MODEL}")
+    # Enrollment crops come with their embedding; only other images are detected + embedded
+    model_version = file_digest(EMBEDDER_MODEL)
+    stored = {p: read_embedding(p, model_version) for p in imagePaths}
+    per_image = {p: [vec] for p, vec in stored.items() if vec is not None}
+    pending = [p for p in imagePaths if p not in per_image]
+    if pending:
+        _init_worker(EMBEDDER_MODEL)
+        per_image.update(zip(pending, _embed_images(pending, batch_size)))
+    vecs = [v for p in imagePaths if per_image[p] for v in per_image[p]]
+    if not vecs:
+        raise ValueError("No valid faces found.")
+    spread = accepted_samples(user_id, vecs, model_version)
+    # At most MAX_SAMPLES, the most diverse ones, as in train_model()
+    vecs = [vecs[i] for i in select_diverse(vecs, MAX_SAMPLES)]
+    # Read-modify-write of the live model: another worker's enrollment or a retrain's
+    # publish in between would otherwise be overwritten or write into a replaced directory
+    with training_lock():
+        model_dir = current_model_dir()
+        gallery = load_gallery(model_dir) or FaceGallery()
+        gallery.remove(user_id)
+        gallery.add(user_id, vecs, spread)
+        save_gallery(gallery, model_dir)
+        if ensure_store(model_dir):
+            matrix, labels, meta = open_store(model_dir)
+            if user_id in meta["classes"] and np.any(labels == meta["classes"].index(user_id)):
+                # Re-enrollment: the old rows have to go, which needs a rewrite
+                keep = labels != meta["classes"].index(user_id)
+                write_store(model_dir, matrix[keep], load_names(labels[keep], meta), meta["model"])
+            append_store(model_dir, vecs, [user_id] * len(vecs))
+        bump_generation()
+    return {"trained": len(vecs), "model_dir": model_dir}
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the face recognizer from dataset/")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="processes used for face detection + embedding (default: 1)")
+    parser.add_argument("-b", "--batch-size", type=int, default=EMBED_BATCH_SIZE,
+                        help=f"faces per embedder forward pass (default: {EMBED_BATCH_SIZE})")
+    args = parser.parse_args()
     print("Training... this may take a while")
-    res = train_model()
+    res = train_model(workers=max(1, args.workers), batch_size=max(1, args.batch_size))
     print("Trained:", res)
@@ -0,0 +1,96 @@
+# training_jobs.py - background retraining with request collapsing
+import threading
+import time
+import traceback
+import uuid
+
+# Fields of a training result shown by /train/status; the rest (model_dir) stays internal
+PUBLIC_RESULT_FIELDS = ("trained", "faces", "cache")
+
+
+class TrainingJob:
+    def __init__(self):
+        self.id = uuid.uuid4().hex[:12]
+        self.status = "queued"  # queued -> running -> done | failed
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "result": None if self.result is None else
+                      {k: v for k, v in self.result.items() if k in PUBLIC_RESULT_FIELDS},
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class TrainingQueue:
+    """Runs train_fn on a single background thread.
+
+    Requests arriving while a job is still queued join that job, so any
+    burst of /register or /train calls costs at most one rebuild after the
+    one already running. That collapsing is per process: with several
+    gunicorn workers each may queue its own rebuild, and they run one
+    after another (model_store.training_lock). on_done(result) runs on the worker thread once a
+    job succeeds, before the job is reported as done.
+    """
+
+    def __init__(self, train_fn, on_done=None, keep_jobs=100):
+        self.train_fn = train_fn
+        self.on_done = on_done
+        self.keep_jobs = keep_jobs
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._jobs = {}
+        self._pending = None
+        self._thread = None
+
+    def submit(self):
+        """Queue a rebuild, or return the already queued one."""
+        with self._lock:
+            if self._pending is None:
+                self._pending = TrainingJob()
+                self._jobs[self._pending.id] = self._pending
+                self._forget_old_jobs()
+            job = self._pending
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="training-queue", daemon=True)
+                self._thread.start()
+            self._wakeup.notify()
+            return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _forget_old_jobs(self):
+        finished = [j for j in self._jobs.values() if j.status in ("done", "failed")]
+        for job in sorted(finished, key=lambda j: j.created)[:max(0, len(self._jobs) - self.keep_jobs)]:
+            del self._jobs[job.id]
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while self._pending is None:
+                    self._wakeup.wait()
+                job, self._pending = self._pending, None
+                job.status = "running"
+                job.started = time.time()
+            try:
+                result = self.train_fn()
+                if self.on_done is not None:
+                    self.on_done(result)
+                job.result = result
+                job.status = "done"
+            except Exception as e:
+                traceback.print_exc()
+                job.error = str(e)
+                job.status = "failed"
+            job.finished = time.time()
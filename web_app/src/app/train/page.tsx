@@ -21,8 +21,16 @@ export default function TrainModel() {
         },
       })
 
-      const data = await response.json()
-      
+      let data = await response.json()
+
+      // Training runs in the background, poll the job until it finishes
+      while (data.ok && data.status !== 'done') {
+        setTrainingStatus(`Training ${data.status}...`)
+        await new Promise((resolve) => setTimeout(resolve, 1500))
+        const status = await fetch(`http://localhost:5000/train/status/${data.job_id}`)
+        data = { job_id: data.job_id, ...(await status.json()) }
+      }
+
       if (data.ok) {
         setTrainedCount(data.trained || 0)
         setTrainingStatus(`✅ Training completed successfully! ${data.trained} face(s) trained.`)